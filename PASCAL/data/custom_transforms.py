@@ -141,6 +141,125 @@ class FixedResize(object):
         return 'FixedResize:'+str(self.resolutions)
 
 
+class ScaleNRotateResize(object):
+    """ScaleNRotate (optional), FixedResize and AddIgnoreRegions in a single transform.
+    The 2-D maps that share a shape, dtype and interpolation flag (edge, semseg, human_parts, sal) are
+    stacked into one multi-channel array, so every geometric step is one cv2 call per group instead of
+    one per element. cv2 interpolates the channels independently and the same random numbers are drawn,
+    so the output is byte-identical to ScaleNRotate + FixedResize + AddIgnoreRegions.
+    Args:
+        resolutions, flagvals: as in FixedResize
+        rots, scales: as in ScaleNRotate, None for no rotation / scaling
+        compose (bool): fold the scale / rotation and the resize into one affine warp to the final
+            resolution, one resampling instead of two: faster, but no longer byte-identical
+        ignore_regions (bool): apply AddIgnoreRegions at the end
+    """
+    max_channels = 4
+
+    def __init__(self, resolutions, flagvals, rots=None, scales=None, compose=False, ignore_regions=True):
+        assert (rots is None) == (scales is None)
+        assert (rots is None or isinstance(rots, type(scales)))
+        self.resolutions = resolutions
+        self.flagvals = flagvals
+        self.rots = rots
+        self.scales = scales
+        self.compose = compose
+        self.add_ignore_regions = AddIgnoreRegions() if ignore_regions else None
+
+    def _draw(self):
+        # same draws as ScaleNRotate
+        if type(self.rots) == tuple:
+            rot = (self.rots[1] - self.rots[0]) * random.random() - \
+                  (self.rots[1] - self.rots[0])/2
+
+            sc = (self.scales[1] - self.scales[0]) * random.random() - \
+                 (self.scales[1] - self.scales[0]) / 2 + 1
+        else:
+            rot = self.rots[random.randint(0, len(self.rots))]
+            sc = self.scales[random.randint(0, len(self.scales))]
+        return rot, sc
+
+    @staticmethod
+    def _resolution(resolution, shape):
+        # as helpers.fixed_resize: an int brings the smaller side to resolution
+        if isinstance(resolution, int):
+            tmp = [resolution, resolution]
+            tmp[int(np.argmax(shape[:2]))] = int(round(float(resolution) / np.min(shape[:2]) * np.max(shape[:2])))
+            resolution = tuple(tmp)
+        return resolution
+
+    def _groups(self, sample, elems):
+        groups = {}
+        for elem in elems:
+            tmp = sample[elem]
+            # multi-channel maps and depth (divided by the scale between warp and resize) stay alone
+            alone = tmp.ndim != 2 or elem == 'depth'
+            key = (elem if alone else '', tmp.shape, tmp.dtype.str, self.flagvals[elem], str(self.resolutions[elem]))
+            groups.setdefault(key, []).append(elem)
+        for key, group in groups.items():
+            for i in range(0, len(group), self.max_channels):
+                yield key[3], group[i:i + self.max_channels]
+
+    def __call__(self, sample):
+        elems = []
+        for elem in list(sample.keys()):
+            if 'meta' in elem or 'bbox' in elem:
+                continue
+            if elem in self.resolutions:
+                elems.append(elem)
+            else:
+                del sample[elem]
+
+        if self.rots is not None:
+            rot, sc = self._draw()
+            if 'normals' in elems:
+                # Rotate Normals properly
+                tmp = sample['normals']
+                in_plane = np.arctan2(tmp[:, :, 0], tmp[:, :, 1])
+                nrm_0 = np.sqrt(tmp[:, :, 0] ** 2 + tmp[:, :, 1] ** 2)
+                rot_rad= rot * 2 * math.pi / 360
+                tmp[:, :, 0] = np.sin(in_plane + rot_rad) * nrm_0
+                tmp[:, :, 1] = np.cos(in_plane + rot_rad) * nrm_0
+
+        for flagval, group in self._groups(sample, elems):
+            tmp = sample[group[0]] if len(group) == 1 else np.stack([sample[elem] for elem in group], axis=2)
+            h, w = tmp.shape[:2]
+            resolution = self._resolution(self.resolutions[group[0]], tmp.shape)
+
+            if self.rots is not None:
+                M = cv2.getRotationMatrix2D((w / 2, h / 2), rot, sc)
+                if self.compose and resolution is not None:
+                    M = np.diag([resolution[1] / w, resolution[0] / h]).dot(M)
+                    tmp = cv2.warpAffine(tmp, M, tuple(resolution[::-1]), flags=flagval)
+                else:
+                    tmp = cv2.warpAffine(tmp, M, (w, h), flags=flagval)
+                if group[0] == 'depth':
+                    tmp = tmp / sc
+
+            if resolution is not None and not (self.rots is not None and self.compose):
+                tmp = cv2.resize(tmp, resolution[::-1], interpolation=flagval)
+
+            if len(group) == 1:
+                sample[group[0]] = tmp
+            else:
+                for i, elem in enumerate(group):
+                    sample[elem] = np.ascontiguousarray(tmp[:, :, i])
+
+            if group[0] == 'normals' and resolution is not None:
+                tmp = sample['normals']
+                N1, N2, N3 = tmp[:, :, 0], tmp[:, :, 1], tmp[:, :, 2]
+                Nn = np.sqrt(N1 ** 2 + N2 ** 2 + N3 ** 2) + np.finfo(np.float32).eps
+                tmp[:, :, 0], tmp[:, :, 1], tmp[:, :, 2] = N1/Nn, N2/Nn, N3/Nn
+
+        if self.add_ignore_regions is not None:
+            sample = self.add_ignore_regions(sample)
+
+        return sample
+
+    def __str__(self):
+        return 'ScaleNRotateResize:(rot='+str(self.rots)+',scale='+str(self.scales)+',resolutions='+str(self.resolutions)+')'
+
+
 class FixedResizeRatio(object):
     """Fixed resize for the image and the ground truth to specified scale.
     Args:
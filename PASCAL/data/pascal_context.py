@@ -10,6 +10,7 @@ import os
 import sys
 import tarfile
 import json
+import hashlib
 import cv2
 
 import numpy as np
@@ -107,14 +108,16 @@ class PASCALContext(data.Dataset):
         image_dir = os.path.join(self.root, 'JPEGImages')
         self.aug = aug
         
+        # ScaleNRotate + FixedResize + AddIgnoreRegions, with the label maps warped together
         self.transform = []
         if self.aug:
-            self.transform.extend([tr.RandomHorizontalFlip(), tr.ScaleNRotate(rots=(-20, 20), scales=(.75, 1.25),
-                                  flagvals=FLAGVALS)])
-
-        self.transform.extend([tr.FixedResize(resolutions={x: (512, 512) for x in FLAGVALS.keys()},
-                                             flagvals=FLAGVALS)])
-        self.transform.extend([tr.AddIgnoreRegions(), tr.ToTensor(),
+            self.transform.extend([tr.RandomHorizontalFlip(),
+                                   tr.ScaleNRotateResize(resolutions={x: (512, 512) for x in FLAGVALS.keys()},
+                                                         flagvals=FLAGVALS, rots=(-20, 20), scales=(.75, 1.25))])
+        else:
+            self.transform.extend([tr.ScaleNRotateResize(resolutions={x: (512, 512) for x in FLAGVALS.keys()},
+                                                         flagvals=FLAGVALS)])
+        self.transform.extend([tr.ToTensor(),
                               tr.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
         self.transform = transforms.Compose(self.transform)
         
@@ -151,19 +154,19 @@ class PASCALContext(data.Dataset):
         self.do_normals = do_normals
         _normal_gt_dir = os.path.join(self.root, 'normals_distill')
         self.normals = []
-        if self.do_normals:
-            with open(os.path.join(PROJECT_ROOT_DIR, 'data/db_info/nyu_classes.json')) as f:
-                cls_nyu = json.load(f)
-            with open(os.path.join(PROJECT_ROOT_DIR, 'data/db_info/context_classes.json')) as f:
-                cls_context = json.load(f)
+        # loaded with or without normals: it is part of the source manifest of the packed cache
+        with open(os.path.join(PROJECT_ROOT_DIR, 'data/db_info/nyu_classes.json')) as f:
+            cls_nyu = json.load(f)
+        with open(os.path.join(PROJECT_ROOT_DIR, 'data/db_info/context_classes.json')) as f:
+            cls_context = json.load(f)
 
-            self.normals_valid_classes = []
-            for cl_nyu in cls_nyu:
-                if cl_nyu in cls_context and cl_nyu != 'unknown':
-                    self.normals_valid_classes.append(cls_context[cl_nyu])
+        self.normals_valid_classes = []
+        for cl_nyu in cls_nyu:
+            if cl_nyu in cls_context and cl_nyu != 'unknown':
+                self.normals_valid_classes.append(cls_context[cl_nyu])
 
-            # Custom additions due to incompatibilities
-            self.normals_valid_classes.append(cls_context['tvmonitor'])
+        # Custom additions due to incompatibilities
+        self.normals_valid_classes.append(cls_context['tvmonitor'])
 
         # Saliency
         self.do_sal = do_sal
@@ -387,6 +390,15 @@ class PASCALContext(data.Dataset):
 
         return _sal
 
+    def _source_files(self, im_id):
+        # every file the ground truths of a sample are rendered from
+        return [os.path.join(self.root, 'JPEGImages', im_id + '.jpg'),
+                os.path.join(self.root, 'pascal-context', 'trainval', im_id + '.mat'),
+                self._get_semseg_fname(im_id),
+                os.path.join(self.root, 'human_parts', im_id + '.mat'),
+                os.path.join(self.root, 'normals_distill', im_id + '.png'),
+                os.path.join(self.root, 'sal_distill', im_id + '.png')]
+
     def _get_semseg_fname(self, fname):
         fname_voc = os.path.join(self.root, 'semseg', 'VOC12', fname + '.png')
         fname_context = os.path.join(self.root, 'semseg', 'pascal-context', fname + '.png')
@@ -473,6 +485,107 @@ class PASCALContext(data.Dataset):
         return 'PASCAL_MT(split=' + str(self.split) + ')'
 
 
+def source_manifest(db, im_ids):
+    """
+    checksum of what a packed cache was rendered from: the name, size and mtime of every source file
+    of im_ids, and the settings that change the rendered labels
+    """
+    h = hashlib.sha1()
+    for im_id in im_ids:
+        for fname in db._source_files(im_id):
+            st = os.stat(fname)
+            h.update('{} {} {}\n'.format(os.path.relpath(fname, db.root), st.st_size, st.st_mtime_ns).encode())
+    settings = {'human_parts': db.cat_part['15'],
+                'area_thres': db.area_thres,
+                'normals_valid_classes': sorted(db.normals_valid_classes)}
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class PASCALContextPacked(PASCALContext):
+    """
+    PASCALContext reading the ground truths pre-rendered by pack_dataset.py instead of decoding the
+    .mat/.png sources and re-deriving edges, human parts and normals for every sample.
+    packed_root/<split>/ holds one flat uint8/uint16 file per task and an index.json with the per-sample
+    offsets and shapes. With check_manifest, its source manifest is compared with the current sources
+    (a stat of every source file) so a stale cache raises instead of silently serving old labels.
+    Samples are decoded to exactly what the per-file loaders return, the transforms are unchanged.
+    """
+    tasks = {'image': 'uint8', 'edge': 'uint8', 'semseg': 'uint8', 'human_parts': 'uint8',
+             'normals': 'uint16', 'sal': 'uint8'}
+
+    def __init__(self, packed_root=None, check_manifest=False, **kwargs):
+        super(PASCALContextPacked, self).__init__(**kwargs)
+        self.packed_root = os.path.expanduser(packed_root or os.path.join(self.root, 'packed'))
+        self.index = {}
+        self.location = {}
+        for splt in self.split:
+            with open(os.path.join(self.packed_root, splt, 'index.json')) as f:
+                self.index[splt] = json.load(f)
+            if check_manifest and self.index[splt]['manifest'] != source_manifest(self, self.index[splt]['ids']):
+                raise RuntimeError('The packed PASCAL-Context cache in {} is stale, re-run pack_dataset.py'
+                                   .format(os.path.join(self.packed_root, splt)))
+            for i, im_id in enumerate(self.index[splt]['ids']):
+                self.location[im_id] = (splt, i)
+        missing = [im_id for im_id in self.im_ids if im_id not in self.location]
+        assert not missing, '{} images are missing from the packed cache'.format(len(missing))
+        # mapped on first access, so every DataLoader worker opens its own mapping
+        self.arrays = None
+
+    def _open(self):
+        return {splt: {t: np.memmap(os.path.join(self.packed_root, splt, t + '.bin'), dtype=dtype, mode='r')
+                       for t, dtype in self.tasks.items()} for splt in self.split}
+
+    def _read(self, task, index):
+        if self.arrays is None:
+            self.arrays = self._open()
+        splt, i = self.location[self.im_ids[index]]
+        info = self.index[splt]['tasks'][task]
+        offset, shape = info['offsets'][i], info['shapes'][i]
+        return np.asarray(self.arrays[splt][task][offset:offset + int(np.prod(shape))]).reshape(shape)
+
+    def _load_img(self, index):
+        return self._read('image', index).astype(np.float32)
+
+    def _load_edge(self, index):
+        return self._read('edge', index).astype(np.float32)
+
+    def _load_human_parts(self, index):
+        # the instance mask is not used by __getitem__
+        return self._read('human_parts', index).astype(np.float32), None
+
+    def _load_semseg(self, index):
+        return self._read('semseg', index).astype(np.float32)
+
+    def _load_normals_distilled(self, index):
+        return decode_normals(self._read('normals', index))
+
+    def _load_sal_distilled(self, index):
+        return self._read('sal', index).astype(np.float32)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+
+def encode_normals(normals):
+    # 0: masked-out pixel (normal 0), v > 0: 8-bit distilled normal v - 1
+    valid = np.any(normals != 0, axis=2, keepdims=True)
+    code = np.rint((normals + 1.0) * 255.0 / 2.0) + 1
+    return np.where(valid, code, 0).astype(np.uint16)
+
+
+def decode_normals(code):
+    # same arithmetic as _load_normals_distilled, so the result is bit-identical
+    _tmp = (code.astype(np.float32) - 1)
+    _tmp = 2.0 * _tmp / 255.0 - 1.0
+    _normals = np.zeros(code.shape, dtype=np.float64)
+    valid = code[..., 0] > 0
+    _normals[valid, :] = _tmp[valid, :]
+    return _normals
+
+
 def test_all():
     import matplotlib.pyplot as plt
     import torch
@@ -0,0 +1,90 @@
+import math
+import torch
+
+
+class AngularErrorHistogram(object):
+    """
+    Streaming statistics of the angular error (in degrees) of surface normal predictions.
+    Errors are counted in a fixed histogram over [0, 180] and their sum / sum of squares are kept
+    exactly, so the memory does not grow with the number of pixels seen. Everything stays on the
+    device of the first update until get_metrics().
+    - mean, rmse: exact
+    - 11.25 / 22.5 / 30: exact (fraction of errors below the threshold), the thresholds fall on bin
+      edges since bins_per_degree is a multiple of 4
+    - median: interpolated inside its bin, off by at most 1 / bins_per_degree degree
+    Histograms of several batches, loaders or processes are combined by merge() or all_reduce().
+    """
+    thresholds = [11.25, 22.5, 30]
+
+    def __init__(self, bins_per_degree=20):
+        assert bins_per_degree % 4 == 0, 'the accuracy thresholds must fall on bin edges'
+        self.bins_per_degree = bins_per_degree
+        self.num_bins = 180 * bins_per_degree
+        self.reset()
+
+    def reset(self):
+        # created lazily on the device of the first update
+        self.hist = None
+        self.sums = None
+
+    def _init(self, device):
+        self.hist = torch.zeros(self.num_bins, dtype=torch.int64, device=device)
+        self.sums = torch.zeros(2, dtype=torch.float64, device=device)
+
+    @torch.no_grad()
+    def update(self, error, mask=None):
+        """
+        error: angular errors in degrees, any shape
+        mask: bool tensor of the same shape selecting the valid pixels, None for all
+        """
+        if self.hist is None:
+            self._init(error.device)
+        error = error.reshape(-1).float()
+        if mask is None:
+            mask = torch.ones_like(error, dtype=torch.bool)
+        mask = mask.reshape(-1) & torch.isfinite(error)
+        error = error.masked_fill(~mask, 0)
+        # invalid pixels go to an extra bin that is dropped, no boolean indexing / host sync
+        inds = (error * self.bins_per_degree).long().clamp(0, self.num_bins - 1)
+        inds = inds.masked_fill(~mask, self.num_bins)
+        counts = torch.zeros(self.num_bins + 1, dtype=torch.int64, device=error.device)
+        counts.scatter_add_(0, inds, torch.ones_like(inds))
+        self.hist += counts[:self.num_bins]
+        error = error.double()
+        self.sums += torch.stack([error.sum(), (error * error).sum()])
+
+    def update_cos(self, cos, mask=None):
+        # cos: cosine similarity between the (normalized) prediction and ground truth
+        self.update(torch.rad2deg(torch.acos(torch.clamp(cos.float(), -1, 1))), mask)
+
+    def merge(self, other):
+        if other.hist is None:
+            return self
+        assert other.bins_per_degree == self.bins_per_degree
+        if self.hist is None:
+            self._init(other.hist.device)
+        self.hist += other.hist.to(self.hist.device)
+        self.sums += other.sums.to(self.sums.device)
+        return self
+
+    def all_reduce(self):
+        # sum the histograms of all processes in the default group, every process must have updated once
+        torch.distributed.all_reduce(self.hist)
+        torch.distributed.all_reduce(self.sums)
+        return self
+
+    def get_metrics(self):
+        """return {'mean', 'median', 'rmse', '11.25', '22.5', '30'}, the accuracies as fractions in [0, 1]"""
+        hist = None if self.hist is None else self.hist.double().cpu()
+        if hist is None or hist.sum().item() == 0:
+            return {k: float('nan') for k in ['mean', 'median', 'rmse'] + [str(t) for t in self.thresholds]}
+        sums = self.sums.cpu()
+        n = hist.sum().item()
+        cdf = torch.cumsum(hist, 0)
+        metrics = {'mean': sums[0].item() / n, 'rmse': math.sqrt(sums[1].item() / n)}
+        b = int(torch.searchsorted(cdf, torch.tensor([n / 2], dtype=torch.float64))[0])
+        below = cdf[b - 1].item() if b > 0 else 0.
+        metrics['median'] = (b + (n / 2 - below) / max(hist[b].item(), 1.)) / self.bins_per_degree
+        for t in self.thresholds:
+            metrics[str(t)] = cdf[int(t * self.bins_per_degree) - 1].item() / n
+        return metrics
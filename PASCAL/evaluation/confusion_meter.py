@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+
+
+class ConfusionMatrixMeter(object):
+    """
+    Segmentation confusion matrix (rows: ground truth, columns: prediction) accumulated on the
+    device of the predictions.
+    Each update is a single bincount: ignored, masked-out and out-of-range pixels are sent to an
+    extra bin that is dropped, so there is no per-class loop and no boolean indexing. The matrix
+    is only copied to the host when the metrics are derived at the end.
+    """
+    def __init__(self, num_classes, ignore_index=255):
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.reset()
+
+    def reset(self):
+        # created lazily on the device of the first update
+        self.mat = None
+
+    @torch.no_grad()
+    def update(self, pred, gt, valid=None):
+        """
+        pred, gt: predicted and ground-truth labels, any shapes with the same number of elements
+        valid: optional mask of the pixels to count, on top of ignore_index
+        """
+        n = self.num_classes
+        pred = pred.reshape(-1).long()
+        gt = gt.reshape(-1).long()
+        if self.mat is None:
+            self.mat = torch.zeros((n, n), dtype=torch.int64, device=pred.device)
+        mask = (gt != self.ignore_index) & (gt >= 0) & (gt < n) & (pred >= 0) & (pred < n)
+        if valid is not None:
+            mask = mask & valid.reshape(-1).bool()
+        inds = torch.where(mask, gt * n + pred, torch.full_like(gt, n * n))
+        self.mat += torch.bincount(inds, minlength=n * n + 1)[:n * n].view(n, n)
+
+    def get_confusion_matrix(self):
+        if self.mat is None:
+            return np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+        return self.mat.cpu().numpy()
+
+    def get_metrics(self):
+        """
+        return (class_iou, pixel_acc)
+        class_iou: numpy array of tp / (tp + fp + fn) per class, 0 for classes that never occur
+        pixel_acc: fraction of the counted pixels that are classified correctly
+        """
+        mat = self.get_confusion_matrix().astype(np.float64)
+        tp = np.diag(mat)
+        fp = mat.sum(0) - tp
+        fn = mat.sum(1) - tp
+        class_iou = tp / np.maximum(tp + fp + fn, 1e-8)
+        pixel_acc = tp.sum() / max(mat.sum(), 1e-8)
+        return class_iou, pixel_acc
@@ -14,6 +14,7 @@ import os.path
 import numpy as np
 import torch
 from PIL import Image
+from evaluation.confusion_meter import ConfusionMatrixMeter
 
 PART_CATEGORY_NAMES = ['background', 'head', 'torso', 'uarm', 'larm', 'uleg', 'lleg']
 
@@ -81,31 +82,17 @@ class HumanPartsMeter(object):
         self.database = database
         self.cat_names = PART_CATEGORY_NAMES
         self.n_parts = 6
-        self.tp = [0] * (self.n_parts + 1)
-        self.fp = [0] * (self.n_parts + 1)
-        self.fn = [0] * (self.n_parts + 1)
+        self.conf_meter = ConfusionMatrixMeter(self.n_parts + 1, ignore_index=255)
 
     @torch.no_grad() 
     def update(self, pred, gt):
-        pred, gt = pred.squeeze(), gt.squeeze()
-        valid = (gt != 255)
-        
-        for i_part in range(self.n_parts + 1):
-            tmp_gt = (gt == i_part)
-            tmp_pred = (pred == i_part)
-            self.tp[i_part] += torch.sum(tmp_gt & tmp_pred & (valid)).item()
-            self.fp[i_part] += torch.sum(~tmp_gt & tmp_pred & (valid)).item()
-            self.fn[i_part] += torch.sum(tmp_gt & ~tmp_pred & (valid)).item()
+        self.conf_meter.update(pred, gt)
 
     def reset(self):
-        self.tp = [0] * (self.n_parts + 1)
-        self.fp = [0] * (self.n_parts + 1)
-        self.fn = [0] * (self.n_parts + 1)
+        self.conf_meter.reset()
  
     def get_score(self, verbose=True):
-        jac = [0] * (self.n_parts + 1)
-        for i_part in range(0, self.n_parts + 1):
-            jac[i_part] = float(self.tp[i_part]) / max(float(self.tp[i_part] + self.fp[i_part] + self.fn[i_part]), 1e-8)
+        jac, _ = self.conf_meter.get_metrics()
 
         eval_result = dict()
 #         eval_result['jaccards_all_categs'] = jac
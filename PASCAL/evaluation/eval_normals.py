@@ -14,6 +14,7 @@ import glob
 import math
 import torch
 import json
+from evaluation.angular_error import AngularErrorHistogram
 
 
 def normal_ize(arr):
@@ -23,7 +24,7 @@ def normal_ize(arr):
 
 def eval_normals(loader, folder):
 
-    deg_diff = []
+    angle_hist = AngularErrorHistogram()
     for i, sample in enumerate(loader):
         if i % 500 == 0:
             print('Evaluating Surface Normals: {} of {} objects'.format(i, len(loader)))
@@ -49,25 +50,23 @@ def eval_normals(loader, folder):
         label = normal_ize(label)
 
         deg_diff_tmp = np.rad2deg(np.arccos(np.clip(np.sum(pred * label, axis=2), a_min=-1, a_max=1)))
-        deg_diff.extend(deg_diff_tmp[valid_mask])
+        angle_hist.update(torch.from_numpy(deg_diff_tmp), torch.from_numpy(valid_mask))
 
-    deg_diff = np.array(deg_diff)
+    angles = angle_hist.get_metrics()
     eval_result = dict()
-    eval_result['mean'] = np.mean(deg_diff)
-    eval_result['median'] = np.median(deg_diff)
-    eval_result['rmse'] = np.mean(deg_diff ** 2) ** 0.5
-    eval_result['11.25'] = np.mean(deg_diff < 11.25) * 100
-    eval_result['22.5'] = np.mean(deg_diff < 22.5) * 100
-    eval_result['30'] = np.mean(deg_diff < 30) * 100
-
-    eval_result = {x: eval_result[x].tolist() for x in eval_result}
+    eval_result['mean'] = angles['mean']
+    eval_result['median'] = angles['median']
+    eval_result['rmse'] = angles['rmse']
+    eval_result['11.25'] = angles['11.25'] * 100
+    eval_result['22.5'] = angles['22.5'] * 100
+    eval_result['30'] = angles['30'] * 100
 
     return eval_result
 
 
 class NormalsMeter(object):
     def __init__(self):
-        self.eval_dict = {'mean': 0., 'rmse': 0., '11.25': 0., '22.5': 0., '30': 0., 'n': 0}
+        self.angle_hist = AngularErrorHistogram()
 
     @torch.no_grad()
     def update(self, pred, gt):
@@ -83,29 +82,20 @@ class NormalsMeter(object):
         
         # Calculate difference expressed in degrees 
         deg_diff_tmp = (180 / math.pi) * (torch.acos(torch.clamp(torch.sum(pred * gt, 1), min=-1, max=1)))
-        deg_diff_tmp = torch.masked_select(deg_diff_tmp, valid_mask[:,0])
-        
-#         print(deg_diff_tmp.shape)
-        self.eval_dict['mean'] += torch.sum(deg_diff_tmp).item()
-#         self.eval_dict['median'].append(deg_diff_tmp)
-        self.eval_dict['rmse'] += torch.sum(torch.pow(deg_diff_tmp, 2)).item()
-#         self.eval_dict['rmse'] += torch.sum(torch.sqrt(torch.pow(deg_diff_tmp, 2))).item()
-        self.eval_dict['11.25'] += torch.sum((deg_diff_tmp < 11.25).float()).item() * 100
-        self.eval_dict['22.5'] += torch.sum((deg_diff_tmp < 22.5).float()).item() * 100
-        self.eval_dict['30'] += torch.sum((deg_diff_tmp < 30).float()).item() * 100
-        self.eval_dict['n'] += deg_diff_tmp.numel()
+        self.angle_hist.update(deg_diff_tmp, valid_mask[:,0])
 
     def reset(self):
-        self.eval_dict = {'mean': 0., 'rmse': 0., '11.25': 0., '22.5': 0., '30': 0., 'n': 0}
+        self.angle_hist.reset()
 
     def get_score(self, verbose=True):
+        angles = self.angle_hist.get_metrics()
         eval_result = dict()
-        eval_result['mean'] = self.eval_dict['mean'] / self.eval_dict['n']
-#         eval_result['median'] = torch.median(torch.cat(self.eval_dict['median'])).item()
-        eval_result['rmse'] = np.sqrt(self.eval_dict['rmse'] / self.eval_dict['n'])
-        eval_result['11.25'] = self.eval_dict['11.25'] / self.eval_dict['n']
-        eval_result['22.5'] = self.eval_dict['22.5'] / self.eval_dict['n']
-        eval_result['30'] = self.eval_dict['30'] / self.eval_dict['n']
+        eval_result['mean'] = angles['mean']
+        eval_result['median'] = angles['median']
+        eval_result['rmse'] = angles['rmse']
+        eval_result['11.25'] = angles['11.25'] * 100
+        eval_result['22.5'] = angles['22.5'] * 100
+        eval_result['30'] = angles['30'] * 100
 
         if verbose:
             print('Results for Surface Normal Estimation')
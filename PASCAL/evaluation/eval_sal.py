@@ -15,18 +15,47 @@ import json
 import torch
 from PIL import Image
 
-import evaluation.jaccard as evaluation
+def saliency_scores(pred, gt, thresholds):
+    """
+    Jaccard, precision and recall of the masks (pred > t) of every image for all thresholds t at once,
+    the same values as evaluation.jaccard / evaluation.precision_recall per (image, threshold) pair.
+    pred: [B, ...] saliency in [0, 1], gt: [B, ...] binary ground truth, thresholds: increasing [T] tensor
+    return three [B, T] tensors on the device of pred
+    """
+    b, t = gt.size(0), thresholds.numel()
+    pred = pred.reshape(b, -1).float().contiguous()
+    gt = (gt.reshape(b, -1) != 0).long()
+    # bin k holds thresholds[k-1] < pred <= thresholds[k], so pred > thresholds[j] <=> bin > j
+    bins = torch.bucketize(pred, thresholds.to(pred))
+    # one histogram per image and ground-truth class, all from a single bincount
+    inds = (torch.arange(b, device=pred.device).view(b, 1) * 2 + gt) * (t + 1) + bins
+    hist = torch.bincount(inds.view(-1), minlength=b * 2 * (t + 1)).view(b, 2, t + 1)
+    # reversed cumulative histograms: background / salient pixels above each threshold
+    above = hist.flip(2).cumsum(2).flip(2)[:, :, 1:].double()
+    fp, tp = above[:, 0], above[:, 1]
+    fn = hist[:, 1].sum(1, keepdim=True).double() - tp
+    union = tp + fp + fn
+    # empty prediction of an empty ground truth counts as a perfect match
+    jaccard = torch.where(union > 0, tp / union.clamp(min=1), torch.ones_like(union))
+    prec = tp / (tp + fp + 1e-12)
+    rec = tp / (tp + fn + 1e-12)
+    return jaccard, prec, rec
+
+
+def get_sal_result(jaccard, prec, rec):
+    # mean over the images for each threshold, then the maximum over the thresholds
+    m_prec, m_rec = prec.mean(0), rec.mean(0)
+    f = 2 * m_prec * m_rec / (m_prec + m_rec + 1e-12)
+    return {'mIoU': jaccard.mean(0).max().item(),
+            'maxF': f.max().item()}
 
 
 def eval_sal(loader, folder, mask_thres=None):
     if mask_thres is None:
         mask_thres = [0.5]
+    mask_thres = torch.tensor(mask_thres, dtype=torch.float32)
 
-    eval_result = dict()
-    eval_result['all_jaccards'] = np.zeros((len(loader), len(mask_thres)))
-    eval_result['prec'] = np.zeros((len(loader), len(mask_thres)))
-    eval_result['rec'] = np.zeros((len(loader), len(mask_thres)))
-
+    jaccards, prec, rec = [], [], []
     for i, sample in enumerate(loader):
 
         if i % 500 == 0:
@@ -42,89 +71,39 @@ def eval_sal(loader, folder, mask_thres=None):
             warnings.warn('Prediction and ground truth have different size. Resizing Prediction..')
             mask = cv2.resize(mask, gt.shape[::-1], interpolation=cv2.INTER_NEAREST)
         
-        for j, thres in enumerate(mask_thres):
-            #gt = (gt > thres).astype(np.float32) # Removed this from ASTMT code. GT is already binarized. 
-            mask_eval = (mask > thres).astype(np.float32)
-            eval_result['all_jaccards'][i, j] = evaluation.jaccard(gt, mask_eval)
-            eval_result['prec'][i, j], eval_result['rec'][i, j] = evaluation.precision_recall(gt, mask_eval)
-
-    # Average for each thresholds
-    eval_result['mIoUs'] = np.mean(eval_result['all_jaccards'], 0)
-
-    eval_result['mPrec'] = np.mean(eval_result['prec'], 0)
-    eval_result['mRec'] = np.mean(eval_result['rec'], 0)
-    eval_result['F'] = 2 * eval_result['mPrec'] * eval_result['mRec'] / \
-                       (eval_result['mPrec'] + eval_result['mRec'] + 1e-12)
+        #gt = (gt > thres).astype(np.float32) # Removed this from ASTMT code. GT is already binarized. 
+        scores = saliency_scores(torch.from_numpy(mask)[None], torch.from_numpy(np.asarray(gt))[None], mask_thres)
+        jaccards.append(scores[0])
+        prec.append(scores[1])
+        rec.append(scores[2])
 
-    # Maximum of averages (maxF, maxmIoU)
-    eval_result['mIoU'] = np.max(eval_result['mIoUs'])
-    eval_result['maxF'] = np.max(eval_result['F'])
-
-#     eval_result = {x: eval_result[x].tolist() for x in eval_result}
-    eval_result = {'mIoU': eval_result['mIoU'].tolist(),
-                   'maxF': eval_result['maxF'].tolist()}
-
-    return eval_result
+    return get_sal_result(torch.cat(jaccards), torch.cat(prec), torch.cat(rec))
 
 
 class SaliencyMeter(object):
     def __init__(self):
-        self.mask_thres = np.linspace(0.2, 0.9, 15) # As below
-        self.all_jacards = []
-        self.prec = []
-        self.rec = []    
+        self.mask_thres = torch.tensor(np.linspace(0.2, 0.9, 15), dtype=torch.float32) # As below
+        self.reset()
     
     @torch.no_grad()
     def update(self, pred, gt):
-        # Predictions and ground-truth
-        b = pred.size(0)
-        pred = pred.float().squeeze() / 255.
-        gt = gt.squeeze().cpu().numpy()
-
-        # Allocate memory for batch results 
-        jaccards = np.zeros((b, len(self.mask_thres)))
-        prec = np.zeros((b, len(self.mask_thres)))
-        rec = np.zeros((b, len(self.mask_thres)))
-
-        for j, thres in enumerate(self.mask_thres):
-            #gt_eval = (gt > thres).cpu().numpy() # Removed this from ASTMT code. GT is already binarized.
-            mask_eval = (pred > thres).cpu().numpy()
-            for i in range(b):
-                jaccards[i, j] = evaluation.jaccard(gt[i], mask_eval[i])
-                prec[i, j], rec[i, j] = evaluation.precision_recall(gt[i], mask_eval[i])
-
-        self.all_jacards.append(jaccards)
-        self.prec.append(prec)
-        self.rec.append(rec)
+        # per-image scores stay on the device, only summed over the images
+        #gt_eval = (gt > thres) # Removed this from ASTMT code. GT is already binarized.
+        self.mask_thres = self.mask_thres.to(pred.device)
+        scores = torch.stack(saliency_scores(pred.float() / 255., gt, self.mask_thres))
+        if self.sums is None:
+            self.sums = torch.zeros_like(scores[:, 0])
+        self.sums += scores.sum(1)
+        self.num_images += scores.size(1)
 
     def reset(self):
-        self.all_jacards = []
-        self.prec = []
-        self.rec = []
+        self.sums = None
+        self.num_images = 0
 
     def get_score(self, verbose=True):
-        eval_result = dict()
-        
-        # Concatenate batched results
-        eval_result['all_jaccards'] = np.concatenate(self.all_jacards)
-        eval_result['prec'] = np.concatenate(self.prec)
-        eval_result['rec'] = np.concatenate(self.rec)
-
-        # Average for each threshold
-        eval_result['mIoUs'] = np.mean(eval_result['all_jaccards'], 0)
-
-        eval_result['mPrec'] = np.mean(eval_result['prec'], 0)
-        eval_result['mRec'] = np.mean(eval_result['rec'], 0)
-        eval_result['F'] = 2 * eval_result['mPrec'] * eval_result['mRec'] / \
-                           (eval_result['mPrec'] + eval_result['mRec'] + 1e-12)
-
-        # Maximum of averages (maxF, maxmIoU)
-        eval_result['mIoU'] = np.max(eval_result['mIoUs'])
-        eval_result['maxF'] = np.max(eval_result['F'])
-
-#         eval_result = {x: eval_result[x].tolist() for x in eval_result}
-        eval_result = {'mIoU': eval_result['mIoU'].tolist(),
-                   'maxF': eval_result['maxF'].tolist()}
+        # Average for each threshold, maximum of averages (maxF, maxmIoU)
+        jaccard, prec, rec = (self.sums / self.num_images).cpu()
+        eval_result = get_sal_result(jaccard[None], prec[None], rec[None])
 
         if verbose:
             # Print the results 
@@ -14,6 +14,7 @@ import json
 import numpy as np
 import torch
 from PIL import Image
+from evaluation.confusion_meter import ConfusionMatrixMeter
 
 VOC_CATEGORY_NAMES = ['background',
                       'aeroplane', 'bicycle', 'bird', 'boat', 'bottle',
@@ -94,47 +95,26 @@ class SemsegMeter(object):
         
         self.n_classes = n_classes + int(has_bg)
         self.cat_names = cat_names
-        self.tp = [0] * self.n_classes
-        self.fp = [0] * self.n_classes
-        self.fn = [0] * self.n_classes
-        
-        self.pixAcc = 0
+        self.conf_meter = ConfusionMatrixMeter(self.n_classes, ignore_index=255)
 
     @torch.no_grad()
     def update(self, pred, gt):
-        pred = pred.squeeze()
-        gt = gt.squeeze()
-        valid = (gt != 255)
-    
-        for i_part in range(0, self.n_classes):
-            tmp_gt = (gt == i_part)
-            tmp_pred = (pred == i_part)
-            self.tp[i_part] += torch.sum(tmp_gt & tmp_pred & valid).item()
-            self.fp[i_part] += torch.sum(~tmp_gt & tmp_pred & valid).item()
-            self.fn[i_part] += torch.sum(tmp_gt & ~tmp_pred & valid).item()
-        
-        self.pixAcc = (gt == pred).float().mean()
+        self.conf_meter.update(pred, gt)
 
     def reset(self):
-        self.tp = [0] * self.n_classes
-        self.fp = [0] * self.n_classes
-        self.fn = [0] * self.n_classes
-        
-        self.pixAcc = 0
+        self.conf_meter.reset()
             
     def get_score(self, verbose=True):
-        jac = [0] * self.n_classes
-        for i_part in range(self.n_classes):
-            jac[i_part] = float(self.tp[i_part]) / max(float(self.tp[i_part] + self.fp[i_part] + self.fn[i_part]), 1e-8)
+        jac, pixel_acc = self.conf_meter.get_metrics()
 
         eval_result = dict()
 #         eval_result['jaccards_all_categs'] = jac
         eval_result['mIoU'] = np.mean(jac)
-        eval_result['pixelAccs'] = self.pixAcc
+        eval_result['pixelAccs'] = pixel_acc
 
         if verbose:
             print('\nSemantic Segmentation mIoU: {0:.4f}\n'.format(100 * eval_result['mIoU']))
-            class_IoU = eval_result['jaccards_all_categs']
+            class_IoU = jac
             for i in range(len(class_IoU)):
                 spaces = ''
                 for j in range(0, 20 - len(self.cat_names[i])):
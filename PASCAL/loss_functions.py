@@ -11,6 +11,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.module import Module
 import numpy as np
+from masked_losses import masked_mean, masked_cross_entropy
 
 
 def get_loss(task):
@@ -47,14 +48,13 @@ class SoftMaxwithLoss(Module):
     def __init__(self):
         super(SoftMaxwithLoss, self).__init__()
         self.softmax = nn.LogSoftmax(dim=1)
-        self.criterion = nn.NLLLoss(ignore_index=255)
 
     def forward(self, out, label):
         assert not label.requires_grad
         # out shape  batch_size x channels x h x w
         # label shape batch_size x 1 x h x w
         label = label[:, 0, :, :].long()
-        loss = self.criterion(self.softmax(out), label)
+        loss = masked_cross_entropy(self.softmax(out), label, ignore_index=255, log_probs=True)
 
         return loss
 
@@ -156,14 +156,14 @@ class DepthLoss(nn.Module):
     def __init__(self, loss='l1'):
         super(DepthLoss, self).__init__()
         if loss == 'l1':
-            self.loss = nn.L1Loss()
+            self.loss = F.l1_loss
 
         else:
             raise NotImplementedError('Loss {} currently not supported in DepthLoss'.format(loss))
 
     def forward(self, out, label):
         mask = (label != 255)
-        return self.loss(torch.masked_select(out, mask), torch.masked_select(label, mask))
+        return masked_mean(self.loss(out, label, reduction='none'), mask)
 
 
 class Normalize(nn.Module):
@@ -204,20 +204,17 @@ class NormalsLoss(Module):
     def forward(self, out, label, ignore_label=255):
         assert not label.requires_grad
         mask = (label != ignore_label)
-        n_valid = torch.sum(mask).item()
 
         if self.normalize is not None:
-            out_norm = self.normalize(out)
-            loss = self.loss_func(torch.masked_select(out_norm, mask), torch.masked_select(label, mask), reduction='sum')
-        else:
-            loss = self.loss_func(torch.masked_select(out, mask), torch.masked_select(label, mask), reduction='sum')
+            out = self.normalize(out)
+        loss_pix = self.loss_func(out, label, reduction='none')
 
         if self.size_average:
             if ignore_label:
-                ret_loss = torch.div(loss, max(n_valid, 1e-6))
+                ret_loss = masked_mean(loss_pix, mask, eps=1e-6)
                 return ret_loss
             else:
-                ret_loss = torch.div(loss, float(np.prod(label.size())))
+                ret_loss = torch.div(torch.sum(loss_pix * mask), float(np.prod(label.size())))
                 return ret_loss
 
-        return loss
+        return torch.sum(loss_pix * mask)
@@ -0,0 +1,35 @@
+import torch
+import torch.nn.functional as F
+
+# Masked reductions for dense losses: the invalid pixels are multiplied out and the sum is divided by
+# the number of valid elements counted on the device, so no compacted tensor is allocated and the
+# backward pass can be queued without a host round trip (masked_select / nonzero / .item()).
+
+
+def masked_mean(x, mask, eps=1):
+    """sum(x * mask) / number of valid elements of mask broadcast to x (at least eps)"""
+    mask = mask.to(x.dtype)
+    return torch.sum(x * mask) / torch.sum(mask.expand_as(x)).clamp(min=eps)
+
+
+def masked_l1_loss(pred, target, mask, eps=1):
+    return masked_mean(torch.abs(pred - target), mask, eps)
+
+
+def masked_l2_loss(pred, target, mask, eps=1):
+    return masked_mean((pred - target) ** 2, mask, eps)
+
+
+def masked_cosine_loss(pred, target, mask, dim=1):
+    """1 - mean of <pred, target> over the valid pixels, the vectors are expected to be normalized"""
+    return 1 - masked_mean(torch.sum(pred * target, dim=dim, keepdim=True), mask)
+
+
+def masked_cross_entropy(pred, target, ignore_index=-1, weight=None, log_probs=False):
+    """
+    mean cross entropy over the pixels whose target is not ignore_index
+    log_probs: pred already holds log-probabilities (e.g. log_softmax outputs), otherwise logits
+    """
+    if log_probs:
+        return F.nll_loss(pred, target, weight=weight, ignore_index=ignore_index)
+    return F.cross_entropy(pred, target, weight=weight, ignore_index=ignore_index)
@@ -0,0 +1,128 @@
+import os, time, json, hashlib
+import numpy as np
+import torch
+from data.pascal_context import PASCALContext, PASCALContextPacked, source_manifest, encode_normals
+from data.custom_collate import collate_mil
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Pre-render the PASCAL-Context ground truths into a packed cache')
+    parser.add_argument('--root', default='/data/dataset/PASCAL_MT/', type=str, help='dataset root')
+    parser.add_argument('--packed_root', default=None, type=str, help='output directory, default root/packed')
+    parser.add_argument('--force', action='store_true', default=False, help='re-pack splits whose cache is up to date')
+    parser.add_argument('--verify', action='store_true', default=False, help='check the sha1 of the packed files')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare the packed and per-file loaders')
+    parser.add_argument('--batch_size', default=8, type=int, help='batch size of the benchmark')
+    parser.add_argument('--num_workers', default=4, type=int, help='loader workers of the benchmark')
+    parser.add_argument('--num_batches', default=100, type=int, help='batches read per loader in the benchmark')
+    return parser.parse_args()
+
+
+def render(db, index):
+    # the ground truths of a sample as returned by the per-file loaders, before any resize / transform
+    return {'image': db._load_img(index),
+            'edge': db._load_edge(index),
+            'semseg': db._load_semseg(index),
+            'human_parts': db._load_human_parts(index)[0],
+            'normals': encode_normals(db._load_normals_distilled(index)),
+            'sal': db._load_sal_distilled(index)}
+
+
+def pack_split(db, dst):
+    os.makedirs(dst, exist_ok=True)
+    tasks = PASCALContextPacked.tasks
+    files = {t: open(os.path.join(dst, t + '.bin'), 'wb') for t in tasks}
+    sha1 = {t: hashlib.sha1() for t in tasks}
+    info = {t: {'dtype': dtype, 'offsets': [], 'shapes': []} for t, dtype in tasks.items()}
+    offsets = {t: 0 for t in tasks}
+    for index in range(len(db)):
+        if index % 500 == 0:
+            print('Packing: {} of {} images'.format(index, len(db)))
+        sample = render(db, index)
+        for t, dtype in tasks.items():
+            arr = np.ascontiguousarray(sample[t]).astype(dtype)
+            # the labels are integer valued, the cast must not change them
+            assert t == 'normals' or np.array_equal(arr, sample[t]), '{} of {} is not {}'.format(t, db.im_ids[index], dtype)
+            buf = arr.tobytes()
+            files[t].write(buf)
+            sha1[t].update(buf)
+            info[t]['offsets'].append(offsets[t])
+            info[t]['shapes'].append(list(arr.shape))
+            offsets[t] += arr.size
+    for t in tasks:
+        files[t].close()
+        info[t]['sha1'] = sha1[t].hexdigest()
+    return info
+
+
+def pack(root, packed_root, split, force=False):
+    dst = os.path.join(packed_root, split)
+    db = PASCALContext(root=root, split=split, aug=False, do_edge=True, do_human_parts=True,
+                       do_semseg=True, do_normals=True, do_sal=True)
+    manifest = source_manifest(db, db.im_ids)
+    index_file = os.path.join(dst, 'index.json')
+    if not force and os.path.isfile(index_file):
+        with open(index_file) as f:
+            if json.load(f)['manifest'] == manifest:
+                print('{} is up to date'.format(dst))
+                return
+    # the .bin files are rewritten in place, the old index must not point into half-written files
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    s_t = time.time()
+    index = {'ids': db.im_ids, 'manifest': manifest, 'tasks': pack_split(db, dst)}
+    # index.json is written last and removed before the rewrite, so an interrupted conversion is never picked up
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    print('packed {}: {} images in {:.1f}s'.format(split, len(db), time.time()-s_t))
+
+
+def verify(packed_root, split):
+    dst = os.path.join(packed_root, split)
+    with open(os.path.join(dst, 'index.json')) as f:
+        index = json.load(f)
+    ok = True
+    for t, info in index['tasks'].items():
+        h = hashlib.sha1()
+        with open(os.path.join(dst, t + '.bin'), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        if h.hexdigest() != info['sha1']:
+            print('{}/{}.bin does not match its checksum'.format(dst, t))
+            ok = False
+    return ok
+
+
+def benchmark(dataset, batch_size, num_workers, num_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        collate_fn=collate_mil,
+        drop_last=True)
+    num_samples = 0
+    s_t = time.time()
+    for k, batch in enumerate(loader):
+        num_samples += batch['image'].size(0)
+        if k + 1 == num_batches:
+            break
+    return num_samples / (time.time() - s_t)
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    packed_root = params.packed_root or os.path.join(params.root, 'packed')
+    for split in ['train', 'val']:
+        pack(params.root, packed_root, split, force=params.force)
+        if params.verify:
+            print('{}: {}'.format(split, 'ok' if verify(packed_root, split) else 'CORRUPTED'))
+    if params.benchmark:
+        kwargs = dict(root=params.root, split=['train'], aug=True, do_edge=True, do_human_parts=True,
+                      do_semseg=True, do_normals=True, do_sal=True)
+        for name, dataset in [('per-file', PASCALContext(**kwargs)),
+                              ('packed', PASCALContextPacked(packed_root=packed_root, **kwargs))]:
+            speed = benchmark(dataset, params.batch_size, params.num_workers, params.num_batches)
+            print('{}: {:.1f} samples/s'.format(name, speed))
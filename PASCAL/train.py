@@ -1,18 +1,24 @@
-import torch, time, os, random
+import torch, time, os, random, sys
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import numpy as np
+from functools import partial
 
-from data.pascal_context import PASCALContext
+from data.pascal_context import PASCALContext, PASCALContextPacked
 from data.custom_collate import collate_mil
+from prefetcher import CUDAPrefetcher
 from loss_functions import get_loss
 from evaluation.evaluate_utils import PerformanceMeter, get_output
 
 from backbone import DeepLabv3, Cross_Stitch, MTANDeepLabv3, AdaShare, SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
 from nddr_cnn import NDDRCNN
 from afa import AFANet
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 import argparse
 
 torch.set_num_threads(2)
@@ -29,6 +35,9 @@ def parse_args():
     parser.add_argument('--model', default='DMTL', type=str, help='DMTL, CROSS, MTAN, AdaShare, NDDRCNN, AFA, SMTL, SMTL_new')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the ground truths pre-rendered by pack_dataset.py')
+    parser.add_argument('--check_packed', action='store_true', default=False, help='stat the sources to make sure the packed cache is not stale')
     return parser.parse_args()
 
 params = parse_args()
@@ -50,6 +59,7 @@ if params.task_index < len(tasks):
     tasks = [tasks[params.task_index]]
 
 
+build_t = time.time()
 if params.model == 'DMTL':
     batch_size = 40
     model = DeepLabv3(tasks=tasks).cuda()
@@ -77,24 +87,30 @@ elif params.model == 'SMTL_new':
 else:
     print("No correct model parameter!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
 
-train_database = PASCALContext(split=['train'], aug=True,
+if params.packed:
+    dataset_class = partial(PASCALContextPacked, check_manifest=params.check_packed)
+else:
+    dataset_class = PASCALContext
+train_database = dataset_class(split=['train'], aug=True,
                                do_edge='edge' in tasks,
                                do_human_parts='human_parts' in tasks,
                                do_semseg='semseg' in tasks,
                                do_normals='normals' in tasks,
                                do_sal='sal' in tasks)
-test_database = PASCALContext(split=['val'], aug=False,
+test_database = dataset_class(split=['val'], aug=False,
                               do_edge='edge' in tasks,
                               do_human_parts='human_parts' in tasks,
                               do_semseg='semseg' in tasks,
                               do_normals='normals' in tasks,
                               do_sal='sal' in tasks)
 
-trainloader = DataLoader(train_database, batch_size=batch_size, shuffle=True, drop_last=True,
-                 num_workers=4, collate_fn=collate_mil)
-testloader = DataLoader(test_database, batch_size=batch_size, shuffle=False, drop_last=False,
-                 num_workers=4)
+trainloader = CUDAPrefetcher(DataLoader(train_database, batch_size=batch_size, shuffle=True, drop_last=True,
+                 num_workers=4, collate_fn=collate_mil))
+testloader = CUDAPrefetcher(DataLoader(test_database, batch_size=batch_size, shuffle=False, drop_last=False,
+                 num_workers=4))
 
 task_num = len(model.tasks)
 
@@ -116,8 +132,8 @@ for epoch in range(total_epoch):
     for batch_index in range(train_batch):
         
         train_batch_data = train_dataset.next()
-        train_data = train_batch_data['image'].cuda(non_blocking=True)
-        targets = {task: train_batch_data[task].cuda(non_blocking=True) for task in tasks}
+        train_data = train_batch_data['image']
+        targets = {task: train_batch_data[task] for task in tasks}
         
         train_pred = model(train_data)
 
@@ -162,8 +178,8 @@ for epoch in range(total_epoch):
         for k in range(val_batch):
 
             val_batch_data = val_dataset.next()
-            val_data = val_batch_data['image'].cuda(non_blocking=True)
-            targets = {task: val_batch_data[task].cuda(non_blocking=True) for task in tasks}
+            val_data = val_batch_data['image']
+            targets = {task: val_batch_data[task] for task in tasks}
 
             val_pred = model.predict(val_data)
             for tk, task in enumerate(tasks):
@@ -176,3 +192,6 @@ for epoch in range(total_epoch):
 
     e_t = time.time()
     print('TIME:', e_t-s_t)
+
+if params.export is not None and (params.model == 'SMTL' or params.model == 'SMTL_new'):
+    export_slim(model, params.export)
@@ -0,0 +1,72 @@
+import os, time, argparse, torch
+from transformers import AdamW
+
+from create_dataset import DataloaderSC, DataloaderTC
+from model import mBert, clear_pretrained_cache
+from utils import get_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Training throughput of the fixed-length and the dynamically padded XTREME loaders')
+    parser.add_argument('--dataset', default='panx', type=str, help='xnli, pawsx, panx, udpos')
+    parser.add_argument('--lang', default='en', type=str, help='language of the train split')
+    parser.add_argument('--gpu_id', default='0', help='gpu_id')
+    parser.add_argument('--batch_size', default=32, type=int, help='batch size')
+    parser.add_argument('--max_tokens', default=None, type=int, help='padded-token budget of the dynamic batches')
+    parser.add_argument('--num_batches', default=100, type=int, help='timed train steps per loader')
+    return parser.parse_args()
+
+
+def throughput(model, optimizer, dataloader, iter_dataloader, lang, num_batches):
+    # real (attended) and padded tokens per second over num_batches train steps, after one warm-up step
+    model.train()
+    real_tokens, padded_tokens = 0, 0
+    for k in range(num_batches + 1):
+        if k == 1:
+            torch.cuda.synchronize()
+            s_t = time.time()
+            real_tokens, padded_tokens = 0, 0
+        inputs = get_data(lang, 'train', dataloader, iter_dataloader)
+        loss, _ = model(inputs, 0)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        real_tokens += inputs['attention_mask'].sum()
+        padded_tokens += inputs['attention_mask'].numel()
+    torch.cuda.synchronize()
+    elapsed = time.time() - s_t
+    return int(real_tokens) / elapsed, padded_tokens / elapsed
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    os.environ["CUDA_VISIBLE_DEVICES"] = params.gpu_id
+
+    root_data = '/data/dataset/XTREME/'
+    model_name_or_path = 'bert-base-multilingual-cased'
+    if params.dataset in ['xnli', 'pawsx']:
+        task_type, Dataloader = 'SC', DataloaderSC
+        data_dir = '{}/{}'.format(root_data, params.dataset)
+    else:
+        task_type, Dataloader = 'TC', DataloaderTC
+        data_dir = '{}/{}/{}_processed_maxlen128/'.format(root_data, params.dataset, params.dataset)
+
+    for name, dynamic_padding in [('fixed 128', False), ('dynamic', True)]:
+        dataloader, iter_dataloader, labels = Dataloader(lang_list=[params.lang],
+                                                         model_name_or_path=model_name_or_path,
+                                                         model_type='bert',
+                                                         mode_list=['train'],
+                                                         data_dir=data_dir,
+                                                         max_seq_length=128,
+                                                         batch_size=params.batch_size,
+                                                         dynamic_padding=dynamic_padding,
+                                                         max_tokens=params.max_tokens)
+        model = mBert(label_num=len(labels), task_num=1, task_type=task_type).cuda()
+        clear_pretrained_cache()
+        optimizer = AdamW(model.parameters(), lr=2e-5, eps=1e-8)
+        real, padded = throughput(model, optimizer, dataloader, iter_dataloader, params.lang, params.num_batches)
+        print('{}: {} batches/epoch, {:.0f} real tokens/s, {:.0f} padded tokens/s'.format(
+            name, len(dataloader[params.lang]['train']), real, padded))
+        del model, optimizer
+        torch.cuda.empty_cache()
@@ -0,0 +1,68 @@
+import os, time, argparse
+import torch
+from torch.utils.data import TensorDataset
+
+from create_dataset import FEATURE_DTYPES, feature_arrays_dir, load_feature_arrays, migrate_feature_cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Convert the torch.save XTREME feature caches to memory-mapped arrays')
+    parser.add_argument('--data_root', default='/data/dataset/XTREME/', type=str, help='searched recursively for cached_feature_* files')
+    parser.add_argument('--max_seq_length', default=128, type=int, help='sequence length of the cached features')
+    parser.add_argument('--force', action='store_true', default=False, help='re-convert the caches that already have arrays')
+    parser.add_argument('--remove_legacy', action='store_true', default=False, help='delete the torch.save files once converted')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare the startup time of both formats')
+    return parser.parse_args()
+
+
+def legacy_caches(data_root):
+    caches = []
+    for root, dirs, files in os.walk(data_root):
+        caches += [os.path.join(root, f) for f in files if f.startswith('cached_feature_')]
+    return sorted(caches)
+
+
+def load_legacy(cached_features_file):
+    # what DataloaderTC/DataloaderSC did before the array cache
+    features = torch.load(cached_features_file)
+    if len(features) > 0 and hasattr(features[0], 'label_ids'):
+        fields = ['input_ids', 'input_mask', 'segment_ids', 'label_ids']
+    else:
+        fields = ['input_ids', 'attention_mask', 'token_type_ids', 'label']
+    return TensorDataset(*[torch.tensor([getattr(f, field) for f in features], dtype=torch.long) for field in fields])
+
+
+def load_arrays(cached_features_file):
+    arrays = load_feature_arrays(cached_features_file)
+    return TensorDataset(*[arrays[key] for key in FEATURE_DTYPES])
+
+
+def startup_time(load, cached_features_file):
+    s_t = time.time()
+    dataset = load(cached_features_file)
+    # the first batch, so the mapped pages it needs are read too
+    dataset[:32]
+    return time.time() - s_t, len(dataset)
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    caches = legacy_caches(params.data_root)
+    for cached_features_file in caches:
+        if params.force or load_feature_arrays(cached_features_file) is None:
+            s_t = time.time()
+            migrate_feature_cache(cached_features_file, params.max_seq_length)
+            print('converted {} in {:.1f}s'.format(cached_features_file, time.time()-s_t))
+        else:
+            print('{} is up to date'.format(feature_arrays_dir(cached_features_file)))
+    if params.benchmark:
+        for cached_features_file in caches:
+            legacy_time, num_features = startup_time(load_legacy, cached_features_file)
+            arrays_time, _ = startup_time(load_arrays, cached_features_file)
+            print('{}: {} features, torch.load {:.3f}s, mmap arrays {:.3f}s'.format(
+                cached_features_file, num_features, legacy_time, arrays_time))
+    if params.remove_legacy:
+        for cached_features_file in caches:
+            os.remove(cached_features_file)
+            print('removed {}'.format(cached_features_file))
@@ -1,9 +1,10 @@
-import random, logging, os
+import random, logging, os, json
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader, TensorDataset
-from torch.utils.data import RandomSampler, SequentialSampler
+from torch.utils.data import RandomSampler, SequentialSampler, Sampler
+from torch.utils.data.dataloader import default_collate
 from processors.utils_tag import convert_examples_to_features_tag, get_labels, read_examples_from_file
 
 from processors.utils_sc import convert_examples_to_features_sc
@@ -12,9 +13,171 @@ from processors.pawsx import PawsxProcessor
 
 from transformers import BertTokenizer
 
+from prefetcher import CUDAPrefetcher
+
 from transformers.data.processors.squad import SquadV1Processor, squad_convert_examples_to_features
 # logger = logging.getLogger(__name__)
 
+
+def trim_collate(batch):
+    """
+    default_collate, then every sequence tensor (input_ids, mask, segment ids and, for TC, the labels) is
+    cut to the longest sequence of the batch. The features are right-padded (pad_on_left is only used for
+    xlnet), so the cut columns are padding only.
+    """
+    batch = default_collate(batch)
+    length = int(batch[1].sum(1).max())
+    return [t[:, :length] if t.dim() == 2 else t for t in batch]
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping the examples of similar length. With shuffle, the indices are shuffled and cut
+    into windows of window x batch_size examples; each window is ordered by length and cut greedily into
+    batches of at most batch_size examples and, if max_tokens is set, at most max_tokens padded tokens
+    (examples x longest length). The order of the batches is then shuffled. Without shuffle, the whole
+    dataset is one window. With drop_last, if the end of the data rather than the limits cuts the last
+    batch of the last window short, as many random examples of that window are left out, so no fixed
+    subset of the examples (e.g. the longest ones) is missed in every epoch.
+    With max_tokens and shuffle, the number of batches varies a little between epochs; len() is the one
+    of the first draw.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=True, drop_last=False, window=50):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.window = window
+        self.num_batches = len(self.batches())
+
+    def full(self, size, length):
+        # a batch of size examples cannot take one more example of the given length
+        return size == self.batch_size or (self.max_tokens is not None and (size + 1) * length > self.max_tokens)
+
+    def cut(self, window):
+        # the batches of a window ordered by length, and whether its last batch was closed by the limits
+        window = window[torch.argsort(self.lengths[window])]
+        order, lengths = window.tolist(), self.lengths[window].tolist()
+        batches, start = [], 0
+        for i, length in enumerate(lengths):
+            # lengths are sorted, so the new example is the longest one of the batch
+            if i > start and self.full(i - start, length):
+                batches.append(order[start:i])
+                start = i
+        if start < len(order):
+            batches.append(order[start:])
+        return batches, len(batches) == 0 or self.full(len(batches[-1]), lengths[-1])
+
+    def batches(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths))
+            size = self.batch_size * self.window
+            windows = [order[k:k + size] for k in range(0, len(order), size)]
+        else:
+            windows = [torch.arange(len(self.lengths))]
+        batches = []
+        for w, window in enumerate(windows):
+            window_batches, full = self.cut(window)
+            if self.drop_last and w == len(windows) - 1:
+                # the last batch is short: drop as many examples of the window, drawn at random before the
+                # window is ordered by length (the short batch itself would always hold the longest ones)
+                while not full:
+                    keep = torch.randperm(len(window))[:len(window) - len(window_batches[-1])]
+                    window = window[keep.sort()[0]]
+                    window_batches, full = self.cut(window)
+            batches += window_batches
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        return self.num_batches
+
+
+def build_dataloader(dataset, mode, batch_size, dynamic_padding=False, max_tokens=None):
+    drop_last = True if mode in ['train'] else False
+    if not dynamic_padding:
+        sampler = RandomSampler(dataset) if mode in ['train'] else SequentialSampler(dataset)
+        loader = DataLoader(dataset, 
+                            sampler=sampler, 
+                            batch_size=batch_size, 
+                            num_workers=2, 
+                            pin_memory=True,
+                            drop_last=drop_last)
+    else:
+        # the token budget only applies to training, eval keeps batch_size examples per batch
+        batch_sampler = LengthBucketSampler(dataset.tensors[1].sum(1), batch_size,
+                                            max_tokens=max_tokens if mode in ['train'] else None,
+                                            shuffle=mode in ['train'], drop_last=drop_last)
+        loader = DataLoader(dataset, 
+                            batch_sampler=batch_sampler, 
+                            collate_fn=trim_collate,
+                            num_workers=2, 
+                            pin_memory=True)
+    return CUDAPrefetcher(loader)
+
+
+# the cached features of a split and language: one contiguous integer array per field, opened via mmap
+FEATURE_DTYPES = {'input_ids': np.int32, 'attention_mask': np.int8, 'token_type_ids': np.int8, 'labels': np.int32}
+
+
+def feature_arrays_dir(cached_features_file):
+    return cached_features_file + '.arrays'
+
+
+def features_to_arrays(features, max_seq_length):
+    # InputFeatures of processors/utils_tag.py (TC) or processors/utils_sc.py (SC)
+    if len(features) > 0 and hasattr(features[0], 'label_ids'):
+        fields = {'input_ids': 'input_ids', 'attention_mask': 'input_mask', 
+                  'token_type_ids': 'segment_ids', 'labels': 'label_ids'}
+    else:
+        fields = {'input_ids': 'input_ids', 'attention_mask': 'attention_mask', 
+                  'token_type_ids': 'token_type_ids', 'labels': 'label'}
+    arrays = {}
+    for key, field in fields.items():
+        arrays[key] = np.array([getattr(f, field) for f in features], dtype=FEATURE_DTYPES[key])
+        if len(features) == 0:
+            arrays[key] = arrays[key].reshape(0, max_seq_length)
+    return arrays
+
+
+def save_feature_arrays(cached_features_file, arrays):
+    path = feature_arrays_dir(cached_features_file)
+    os.makedirs(path, exist_ok=True)
+    # the arrays are overwritten in place, an old meta.json must not validate a half-written cache
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    for key in FEATURE_DTYPES:
+        np.save(os.path.join(path, '{}.npy'.format(key)), arrays[key])
+    # meta.json is written last and removed before the rewrite, so an interrupted conversion is never picked up
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'num_features': len(arrays['input_ids']), 
+                   'shapes': {key: list(arrays[key].shape) for key in FEATURE_DTYPES}}, f)
+
+
+def load_feature_arrays(cached_features_file):
+    """
+    the cached arrays mapped read-only as tensors (copy-on-write mapping, so torch gets writable
+    buffers and nothing is read before the batches are built), None if the cache does not exist
+    """
+    path = feature_arrays_dir(cached_features_file)
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+    return {key: torch.from_numpy(np.load(os.path.join(path, '{}.npy'.format(key)), mmap_mode='c')) 
+            for key in FEATURE_DTYPES}
+
+
+def migrate_feature_cache(cached_features_file, max_seq_length):
+    # converts a torch.save cache of InputFeatures, the old format, to the array cache
+    features = torch.load(cached_features_file)
+    save_feature_arrays(cached_features_file, features_to_arrays(features, max_seq_length))
+
+
 # Token Classification: NER(panx), POS(udpos)
 def DataloaderTC(lang_list,
                 model_name_or_path,
@@ -22,7 +185,7 @@ def DataloaderTC(lang_list,
                 mode_list,
                 data_dir,
                 max_seq_length,
-                batch_size, small_train=None):
+                batch_size, small_train=None, dynamic_padding=False, max_tokens=None):
     lang2id = None # if model_type != 'xlm'
     labels = get_labels(os.path.join(data_dir, 'labels.txt'))
     tokenizer = BertTokenizer.from_pretrained(model_name_or_path, do_lower_case=False)
@@ -43,10 +206,14 @@ def DataloaderTC(lang_list,
                 cached_features_file = os.path.join(data_dir, lang, "cached_feature_{}_{}_{}".format(mode,
                                         list(filter(None, model_name_or_path.split("/"))).pop(),
                                         str(max_seq_length)))
-            try:
-                features_lg = torch.load(cached_features_file)
-                print("Loading features from cached file {}".format(cached_features_file))
-            except:
+            arrays = load_feature_arrays(cached_features_file)
+            if arrays is not None:
+                print("Loading features from cached arrays {}".format(feature_arrays_dir(cached_features_file)))
+            elif os.path.isfile(cached_features_file):
+                print("Converting the cached file {} to arrays".format(cached_features_file))
+                migrate_feature_cache(cached_features_file, max_seq_length)
+                arrays = load_feature_arrays(cached_features_file)
+            else:
                 data_file = os.path.join(data_dir, lang, "{}.{}".format(mode, model_name_or_path))
                 print("Creating features from dataset file at {} in language {}".format(cached_features_file, lang))
                 examples = read_examples_from_file(data_file, lang, lang2id)
@@ -60,27 +227,19 @@ def DataloaderTC(lang_list,
                                         pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
                                         pad_token_segment_id=4 if model_type in ["xlnet"] else 0,
                                         pad_token_label_id=pad_token_label_id,
-                                        lang=lang
+                                        lang=lang,
+                                        num_workers=os.cpu_count()
                                         )
                 if mode == 'train' and small_train is not None:
                     random.shuffle(features_lg)
                     features_lg = features_lg[:small_train]
-                torch.save(features_lg, cached_features_file)
+                save_feature_arrays(cached_features_file, features_to_arrays(features_lg, max_seq_length))
+                arrays = load_feature_arrays(cached_features_file)
                 
             
-            all_input_ids = torch.tensor([f.input_ids for f in features_lg], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in features_lg], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in features_lg], dtype=torch.long)
-            all_label_ids = torch.tensor([f.label_ids for f in features_lg], dtype=torch.long)
-
-            dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-            sampler = RandomSampler(dataset) if mode in ['train'] else SequentialSampler(dataset)
-            drop_last = True if mode in ['train'] else False
-            dataloader[lang][mode] = DataLoader(dataset, sampler=sampler, 
-                                                batch_size=batch_size, 
-                                                num_workers=2, 
-                                                pin_memory=True,
-                                                drop_last=drop_last)
+            # int32/int8 on the host, get_data casts the batches to long on the device
+            dataset = TensorDataset(*[arrays[key] for key in FEATURE_DTYPES])
+            dataloader[lang][mode] = build_dataloader(dataset, mode, batch_size, dynamic_padding, max_tokens)
             iter_dataloader[lang][mode] = iter(dataloader[lang][mode])
     return dataloader, iter_dataloader, labels
 
@@ -92,7 +251,7 @@ def DataloaderSC(lang_list,
                 mode_list,
                 data_dir,
                 max_seq_length,
-                batch_size, small_train=None):
+                batch_size, small_train=None, dynamic_padding=False, max_tokens=None):
     lang2id = None # if model_type != 'xlm'
     if 'pawsx' in data_dir.split('/')[-1]:
         processor = PawsxProcessor()
@@ -119,10 +278,14 @@ def DataloaderSC(lang_list,
                 cached_features_file = os.path.join(data_dir, "cached_feature_{}_{}_{}_{}".format(mode, lang,
                                             list(filter(None, model_name_or_path.split("/"))).pop(),
                                             str(max_seq_length)))
-            try:
-                features_lg = torch.load(cached_features_file)
-                print("Loading features from cached file {}".format(cached_features_file))
-            except:
+            arrays = load_feature_arrays(cached_features_file)
+            if arrays is not None:
+                print("Loading features from cached arrays {}".format(feature_arrays_dir(cached_features_file)))
+            elif os.path.isfile(cached_features_file):
+                print("Converting the cached file {} to arrays".format(cached_features_file))
+                migrate_feature_cache(cached_features_file, max_seq_length)
+                arrays = load_feature_arrays(cached_features_file)
+            else:
                 print("Creating features from dataset file at {} in language {} and mode {}".format(cached_features_file, lang, mode))
                 examples = processor.get_examples(data_dir, language=lang, split=mode)
                 features_lg = convert_examples_to_features_sc(
@@ -135,26 +298,17 @@ def DataloaderSC(lang_list,
                                             pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
                                             pad_token_segment_id=0,
                                             lang2id=lang2id,
+                                            num_workers=os.cpu_count(),
                                         )
                 if mode == 'train' and small_train is not None:
                     random.shuffle(features_lg)
                     features_lg = features_lg[:small_train]
-                torch.save(features_lg, cached_features_file)
+                save_feature_arrays(cached_features_file, features_to_arrays(features_lg, max_seq_length))
+                arrays = load_feature_arrays(cached_features_file)
                 
        
-            all_input_ids = torch.tensor([f.input_ids for f in features_lg], dtype=torch.long)
-            all_attention_mask = torch.tensor([f.attention_mask for f in features_lg], dtype=torch.long)
-            all_token_type_ids = torch.tensor([f.token_type_ids for f in features_lg], dtype=torch.long)
-            all_labels = torch.tensor([f.label for f in features_lg], dtype=torch.long)
-            dataset = TensorDataset(all_input_ids, all_attention_mask, all_token_type_ids, all_labels)
-
-            sampler = RandomSampler(dataset) if mode in ['train'] else SequentialSampler(dataset)
-            drop_last = True if mode in ['train'] else False
-            dataloader[lang][mode] = DataLoader(dataset, 
-                                                sampler=sampler, 
-                                                batch_size=batch_size, 
-                                                num_workers=2, 
-                                                pin_memory=True,
-                                                drop_last=drop_last)
+            # int32/int8 on the host, get_data casts the batches to long on the device
+            dataset = TensorDataset(*[arrays[key] for key in FEATURE_DTYPES])
+            dataloader[lang][mode] = build_dataloader(dataset, mode, batch_size, dynamic_padding, max_tokens)
             iter_dataloader[lang][mode] = iter(dataloader[lang][mode])
     return dataloader, iter_dataloader, label_list
\ No newline at end of file
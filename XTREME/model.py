@@ -1,9 +1,36 @@
-import torch, sys
+import torch, sys, os, copy
 import torch.nn as nn
 import torch.nn.functional as F
 from transformers import BertModel # https://huggingface.co/docs/transformers/model_doc/bert
 from transformers.models.bert.modeling_bert import BertLayer
 
+# local directory holding the pretrained models (e.g. ./bert-base-multilingual-cased/ saved with
+# save_pretrained), used instead of the hub cache when present, e.g. on nodes without network access
+PRETRAINED_DIR = os.environ.get('PRETRAINED_DIR')
+
+# pristine copies of the pretrained encoders read in this process
+_pretrained_berts = {}
+
+
+def pretrained_bert(name='bert-base-multilingual-cased', add_pooling_layer=True):
+    """
+    BertModel.from_pretrained(name, add_pooling_layer=...), read from disk once per process: the later
+    calls (the task-specific encoders of the SMTL models, or a second model) get an in-memory copy
+    """
+    key = (name, add_pooling_layer)
+    if key not in _pretrained_berts:
+        path = name
+        if PRETRAINED_DIR and os.path.isdir(os.path.join(PRETRAINED_DIR, name)):
+            path = os.path.join(PRETRAINED_DIR, name)
+        _pretrained_berts[key] = BertModel.from_pretrained(path, add_pooling_layer=add_pooling_layer)
+    return copy.deepcopy(_pretrained_berts[key])
+
+
+def clear_pretrained_cache():
+    # called once the models are built, so the pristine encoders are not kept for the rest of the process
+    _pretrained_berts.clear()
+
+
 class BaseModel(nn.Module):
     def __init__(self, task_num):
         super(BaseModel, self).__init__()
@@ -42,6 +69,35 @@ def compute_loss(logits, data, label_num, task_type=None, task=None):
     else:
         raise('no support')
 
+def concat_batches(data_list, task_type):
+    """
+    the batches of all the languages concatenated along the batch dimension, returned with the slice of
+    every language. The sequences are cut to the longest one of the combined batch: the padding positions
+    are masked out of the attention and of the loss, so the outputs of the real tokens do not change.
+    """
+    seq_keys = ['input_ids', 'attention_mask', 'token_type_ids'] + (['labels'] if task_type == 'TC' else [])
+    max_len = max(d['input_ids'].size(1) for d in data_list)
+    data = {}
+    for key in data_list[0]:
+        values = [d[key] for d in data_list]
+        if key in seq_keys:
+            pad = nn.CrossEntropyLoss().ignore_index if key == 'labels' else 0
+            values = [F.pad(v, (0, max_len - v.size(1)), value=pad) for v in values]
+        data[key] = torch.cat(values)
+    length = int(data['attention_mask'].sum(1).max())
+    for key in seq_keys:
+        data[key] = data[key][:, :length]
+    slices, start = [], 0
+    for d in data_list:
+        slices.append(slice(start, start + d['input_ids'].size(0)))
+        start += d['input_ids'].size(0)
+    return data, slices
+
+
+def split_batch(data, s):
+    return {key: value[s] for key, value in data.items()}
+
+
 class mBert(BaseModel):
     def __init__(self, label_num, task_num, task_type='TC'):
         super(mBert, self).__init__(task_num=task_num)
@@ -51,7 +107,7 @@ class mBert(BaseModel):
         self.task_type = task_type
         
         add_pooling_layer = True if task_type == 'SC' else False
-        self.bert = BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+        self.bert = pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
         
         self.dropout = nn.ModuleList([nn.Dropout(p=0.1, inplace=False) for _ in range(self.task_num)])
         self.fc = nn.ModuleList([nn.Linear(768, self.label_num) for _ in range(self.task_num)])
@@ -83,6 +139,23 @@ class mBert(BaseModel):
     def predict(self, data, task_index):
         return self.forward(data, task_index)
 
+    def forward_multi(self, data_list):
+        """
+        data_list: the batches of all the tasks (languages), in task order
+        The encoder runs once on the concatenated batches, each language slice then goes through its own
+        classifier. Returns the (loss, logits) of every language, as forward() would.
+        """
+        data, slices = concat_batches(data_list, self.task_type)
+        outputs = self.bert(input_ids=data['input_ids'],
+                           attention_mask=data['attention_mask'],
+                           token_type_ids=data['token_type_ids'])
+        rep = outputs[1] if self.task_type=='SC' else outputs[0]
+        results = []
+        for task_index, s in enumerate(slices):
+            logits = self.fc[task_index](self.dropout[task_index](rep[s]))
+            results.append(compute_loss(logits=logits, task_type=self.task_type, data=split_batch(data, s), label_num=self.label_num))
+        return results
+
 
 class STL(BaseModel):
     def __init__(self, label_num, task_num, task_type='TC'):
@@ -95,7 +168,7 @@ class STL(BaseModel):
         add_pooling_layer = True if task_type == 'SC' else False
         
         # self.embedding = BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer).embeddings
-        self.berts = BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+        self.berts = pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
 
         self.dropout = nn.Dropout(p=0.1, inplace=False)
         self.fc = nn.Linear(768, self.label_num)
@@ -129,7 +202,7 @@ class STL(BaseModel):
 
 
 class SMTL_mBert(BaseModel):
-    def __init__(self, label_num, task_num, task_type='TC', version='v1'):
+    def __init__(self, label_num, task_num, task_type='TC', version='v1', pruned=()):
         super(SMTL_mBert, self).__init__(task_num=task_num)
         # task_type: TC(NER, POS), SC(XNIL, PAWSX)
         self.task_num = task_num
@@ -139,10 +212,12 @@ class SMTL_mBert(BaseModel):
         
         add_pooling_layer = True if task_type == 'SC' else False
         
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared encoder
-        self.bert_s = BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+        self.bert_s = None if 'bert_s.' in pruned else pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
         # task-specific encoder
-        self.bert_t = nn.ModuleList([BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer) for _ in range(self.task_num)])
+        self.bert_t = nn.ModuleList([None if 'bert_t.{}.'.format(i) in pruned else pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+                                     for i in range(self.task_num)])
         
         # adaptative parameters
         if self.version == 'v1' or self.version =='v2':
@@ -203,35 +278,88 @@ class SMTL_mBert(BaseModel):
         else:
             raise('no support')
     
-    def predict(self, data, task_index):
-        # shared encoder output
+    def get_train_gate(self):
+        # (shared, specific) weights of all the tasks as drawn by forward(), one gumbel sample per task for SMTL-v3
+        if self.version == 'v1':
+            return F.softmax(self.alpha, 1)     # SMTL-v1,  alpha_1 + alpha_2 = 1
+        elif self.version == 'v2':
+            return torch.exp(self.alpha) / (1 + torch.exp(self.alpha)) # SMTL-v2,  0 <= alpha <=1
+        elif self.version == 'v3':
+            temp = torch.sigmoid(self.alpha)
+            temp_alpha = torch.stack([1-temp, temp], 1)
+            return F.gumbel_softmax(torch.log(temp_alpha), tau=0.1, hard=True)
+        else:
+            print("No correct version parameter!")
+            exit()
+
+    def encode_multi(self, data_list):
+        # shared encoder once on the concatenated batches, every task-specific encoder on its own slice
+        data, slices = concat_batches(data_list, self.task_type)
         outputs_s = self.bert_s(input_ids=data['input_ids'],
                            attention_mask=data['attention_mask'],
                            token_type_ids=data['token_type_ids'])
         rep_s = outputs_s[1] if self.task_type=='SC' else outputs_s[0]
+        rep_t = []
+        for task_index, s in enumerate(slices):
+            outputs_t = self.bert_t[task_index](input_ids=data['input_ids'][s],
+                               attention_mask=data['attention_mask'][s],
+                               token_type_ids=data['token_type_ids'][s])
+            rep_t.append(outputs_t[1] if self.task_type=='SC' else outputs_t[0])
+        return data, slices, rep_s, rep_t
+
+    def forward_multi(self, data_list):
+        """
+        data_list: the batches of all the tasks (languages), in task order
+        The shared encoder runs once on the concatenated batches instead of once per language.
+        Returns the (loss, logits) of every language, as forward() would.
+        """
+        data, slices, rep_s, rep_t = self.encode_multi(data_list)
+        gate = self.get_train_gate()
+        results = []
+        for task_index, s in enumerate(slices):
+            rep = gate[task_index][0] * rep_s[s] + gate[task_index][1] * rep_t[task_index]
+            logits = self.fc[task_index](self.dropout[task_index](rep))
+            results.append(compute_loss(logits=logits, task_type=self.task_type, data=split_batch(data, s), label_num=self.label_num))
+        return results
+    
+    def get_gate(self):
+        # (shared, specific) weights of every task at inference, hard 0/1 decisions for SMTL-v3
+        gate = []
+        for i in range(self.alpha.size(0)):
+            if self.version == 'v1':
+                gate.append(F.softmax(self.alpha[i], 0))     # SMTL-v1,  alpha_1 + alpha_2 = 1
+            elif self.version == 'v2':
+                gate.append(torch.exp(self.alpha[i]) / (1 + torch.exp(self.alpha[i]))) # SMTL-v2,  0 <= alpha <=1
+            elif self.version == 'v3':
+                # SMTL-v3, converged decision of the gumbel softmax gate
+                gate.append([0, 1] if torch.sigmoid(self.alpha[i]) >= 0.5 else [1, 0])
+            else:
+                print("No correct version parameter!")
+                exit()
+        return gate
+
+    def predict(self, data, task_index):
+        # with the hard SMTL-v3 gate only the selected encoder is run
+        temp_alpha = self.get_gate()[task_index]
+        hard = self.version == 'v3'
+        # shared encoder output
+        if not hard or temp_alpha[0]:
+            outputs_s = self.bert_s(input_ids=data['input_ids'],
+                               attention_mask=data['attention_mask'],
+                               token_type_ids=data['token_type_ids'])
+            rep_s = outputs_s[1] if self.task_type=='SC' else outputs_s[0]
         # task-specific encoder output
-        outputs_t = self.bert_t[task_index](input_ids=data['input_ids'],
-                           attention_mask=data['attention_mask'],
-                           token_type_ids=data['token_type_ids'])
-        rep_t = outputs_t[1] if self.task_type=='SC' else outputs_t[0]
+        if not hard or temp_alpha[1]:
+            outputs_t = self.bert_t[task_index](input_ids=data['input_ids'],
+                               attention_mask=data['attention_mask'],
+                               token_type_ids=data['token_type_ids'])
+            rep_t = outputs_t[1] if self.task_type=='SC' else outputs_t[0]
 
         # combine shared encoder output and task-specific encoder output, obtain final hidden feature
-        if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
-        elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
-        elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            if temp >= 0.5:
-                temp_alpha = [0, 1]
-            else:
-                temp_alpha = [1, 0]
+        if hard:
+            rep = rep_t if temp_alpha[1] else rep_s
         else:
-            print("No correct version parameter!")
-            exit()
-
-        rep = temp_alpha[0] * rep_s + temp_alpha[1] * rep_t
+            rep = temp_alpha[0] * rep_s + temp_alpha[1] * rep_t
 
         if self.task_type == 'TC':
             sequence_output = self.dropout[task_index](rep)
@@ -256,7 +384,7 @@ class SMTL_mBert(BaseModel):
 
 
 class SMTL_new_mBert(BaseModel):
-    def __init__(self, label_num, task_num, task_type='TC', version='v1'):
+    def __init__(self, label_num, task_num, task_type='TC', version='v1', pruned=()):
         super(SMTL_new_mBert, self).__init__(task_num=task_num)
         # task_type: TC(NER, POS), SC(XNIL, PAWSX)
         self.task_num = task_num
@@ -266,10 +394,12 @@ class SMTL_new_mBert(BaseModel):
         
         add_pooling_layer = True if task_type == 'SC' else False
         
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared encoder
-        self.bert_s = BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+        self.bert_s = None if 'bert_s.' in pruned else pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
         # task-specific encoder
-        self.bert_t = nn.ModuleList([BertModel.from_pretrained('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer) for _ in range(self.task_num)])
+        self.bert_t = nn.ModuleList([None if 'bert_t.{}.'.format(i) in pruned else pretrained_bert('bert-base-multilingual-cased', add_pooling_layer=add_pooling_layer)
+                                     for i in range(self.task_num)])
         
         # adaptative parameters
         if self.version == 'v1' or self.version =='v2':
@@ -338,48 +468,92 @@ class SMTL_new_mBert(BaseModel):
 
 
     
-    def predict(self, data, task_index):
-        # shared encoder output
-        outputs_s = self.bert_s(input_ids=data['input_ids'],
-                           attention_mask=data['attention_mask'],
-                           token_type_ids=data['token_type_ids'])
-        rep_s = outputs_s[1] if self.task_type=='SC' else outputs_s[0]
-        # task-specific encoder output
-        outputs_t = self.bert_t[task_index](input_ids=data['input_ids'],
-                           attention_mask=data['attention_mask'],
-                           token_type_ids=data['token_type_ids'])
-        rep_t = outputs_t[1] if self.task_type=='SC' else outputs_t[0]
-        
+    def get_train_gate(self):
+        # (shared, specific) weights of all the tasks as drawn by forward(), one gumbel sample per task for SMTL-v3
         if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
+            return F.softmax(self.alpha, 1)     # SMTL-v1,  alpha_1 + alpha_2 = 1
         elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
+            return torch.exp(self.alpha) / (1 + torch.exp(self.alpha)) # SMTL-v2,  0 <= alpha <=1
         elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            if temp >= 0.5:
-                temp_alpha = [0, 1]
-            else:
-                temp_alpha = [1, 0]
+            temp = torch.sigmoid(self.alpha)
+            temp_alpha = torch.stack([1-temp, temp], 1)
+            return F.gumbel_softmax(torch.log(temp_alpha), tau=0.1, hard=True)
         else:
             print("No correct version parameter!")
             exit()
+
+    def encode_multi(self, data_list):
+        # shared encoder once on the concatenated batches, every task-specific encoder on its own slice
+        data, slices = concat_batches(data_list, self.task_type)
+        outputs_s = self.bert_s(input_ids=data['input_ids'],
+                           attention_mask=data['attention_mask'],
+                           token_type_ids=data['token_type_ids'])
+        rep_s = outputs_s[1] if self.task_type=='SC' else outputs_s[0]
+        rep_t = []
+        for task_index, s in enumerate(slices):
+            outputs_t = self.bert_t[task_index](input_ids=data['input_ids'][s],
+                               attention_mask=data['attention_mask'][s],
+                               token_type_ids=data['token_type_ids'][s])
+            rep_t.append(outputs_t[1] if self.task_type=='SC' else outputs_t[0])
+        return data, slices, rep_s, rep_t
+
+    def forward_multi(self, data_list):
+        """
+        data_list: the batches of all the tasks (languages), in task order
+        The shared encoder runs once on the concatenated batches instead of once per language.
+        Returns the (loss, logits) of every language, as forward() would.
+        """
+        data, slices, rep_s, rep_t = self.encode_multi(data_list)
+        gate = self.get_train_gate()
+        results = []
+        for task_index, s in enumerate(slices):
+            logits_s = self.fc_s[task_index](self.dropout[task_index](rep_s[s]))
+            logits_t = self.fc_t[task_index](self.dropout[task_index](rep_t[task_index]))
+            logits = gate[task_index][0] * logits_s + gate[task_index][1] * logits_t
+            results.append(compute_loss(logits=logits, task_type=self.task_type, data=split_batch(data, s), label_num=self.label_num))
+        return results
+    
+    def get_gate(self):
+        # (shared, specific) weights of every task at inference, hard 0/1 decisions for SMTL-v3
+        gate = []
+        for i in range(self.alpha.size(0)):
+            if self.version == 'v1':
+                gate.append(F.softmax(self.alpha[i], 0))     # SMTL-v1,  alpha_1 + alpha_2 = 1
+            elif self.version == 'v2':
+                gate.append(torch.exp(self.alpha[i]) / (1 + torch.exp(self.alpha[i]))) # SMTL-v2,  0 <= alpha <=1
+            elif self.version == 'v3':
+                # SMTL-v3, converged decision of the gumbel softmax gate
+                gate.append([0, 1] if torch.sigmoid(self.alpha[i]) >= 0.5 else [1, 0])
+            else:
+                print("No correct version parameter!")
+                exit()
+        return gate
+
+    def predict(self, data, task_index):
+        # with the hard SMTL-v3 gate only the selected encoder and classifier are run
+        temp_alpha = self.get_gate()[task_index]
+        hard = self.version == 'v3'
+        # shared encoder output
+        if not hard or temp_alpha[0]:
+            outputs_s = self.bert_s(input_ids=data['input_ids'],
+                               attention_mask=data['attention_mask'],
+                               token_type_ids=data['token_type_ids'])
+            rep_s = outputs_s[1] if self.task_type=='SC' else outputs_s[0]
+            logits_s = self.fc_s[task_index](self.dropout[task_index](rep_s))
+        # task-specific encoder output
+        if not hard or temp_alpha[1]:
+            outputs_t = self.bert_t[task_index](input_ids=data['input_ids'],
+                               attention_mask=data['attention_mask'],
+                               token_type_ids=data['token_type_ids'])
+            rep_t = outputs_t[1] if self.task_type=='SC' else outputs_t[0]
+            logits_t = self.fc_t[task_index](self.dropout[task_index](rep_t))
             
-        if self.task_type == 'TC':
-            sequence_output_s = self.dropout[task_index](rep_s)
-            sequence_output_t = self.dropout[task_index](rep_t)
-            logits_s = self.fc_s[task_index](sequence_output_s)
-            logits_t = self.fc_t[task_index](sequence_output_t)
-            logits = temp_alpha[0] * logits_s + temp_alpha[1] * logits_t
-            loss = compute_loss(logits=logits, task_type='TC', data=data, label_num=self.label_num)
-            return loss
-        elif self.task_type == 'SC':
-            pooled_output_s = self.dropout[task_index](rep_s)
-            pooled_output_t = self.dropout[task_index](rep_t)
-            logits_s = self.fc_s[task_index](pooled_output_s)
-            logits_t = self.fc_t[task_index](pooled_output_t)
+        if hard:
+            logits = logits_t if temp_alpha[1] else logits_s
+        else:
             logits = temp_alpha[0] * logits_s + temp_alpha[1] * logits_t
-            loss = compute_loss(logits=logits, task_type='SC', data=data, label_num=self.label_num)
+        if self.task_type in ['TC', 'SC']:
+            loss = compute_loss(logits=logits, task_type=self.task_type, data=data, label_num=self.label_num)
             return loss
         else:
             raise('no support')
@@ -0,0 +1,32 @@
+import multiprocessing
+
+# set in every worker process by _init_worker: the function and its constant keyword arguments (e.g. the
+# tokenizer) are handed to each worker once instead of being pickled with every chunk
+_worker_fn = None
+_worker_kwargs = None
+
+
+def _init_worker(fn, kwargs):
+    global _worker_fn, _worker_kwargs
+    _worker_fn, _worker_kwargs = fn, kwargs
+
+
+def _run_chunk(chunk):
+    return _worker_fn(chunk, **_worker_kwargs)
+
+
+def map_chunks(fn, items, num_workers, kwargs, min_items_per_worker=1000, chunks_per_worker=4):
+    """
+    fn(items[a:b], **kwargs) over contiguous chunks of items in up to num_workers processes, the returned
+    lists concatenated in the order of items, so the result is the one of fn(items, **kwargs). Every worker
+    gets at least min_items_per_worker items, small inputs (e.g. the dev sets) run in this process.
+    """
+    num_workers = min(num_workers or 1, len(items) // min_items_per_worker)
+    if num_workers <= 1:
+        return fn(items, **kwargs)
+    num_chunks = num_workers * chunks_per_worker
+    bounds = [len(items) * k // num_chunks for k in range(num_chunks + 1)]
+    chunks = [items[bounds[k]:bounds[k + 1]] for k in range(num_chunks)]
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(fn, kwargs)) as pool:
+        results = pool.map(_run_chunk, chunks)
+    return [x for result in results for x in result]
@@ -3,6 +3,7 @@ import csv
 import json
 import logging
 from transformers import XLMTokenizer
+from .parallel import map_chunks
 
 logger = logging.getLogger(__name__)
 
@@ -83,6 +84,7 @@ def convert_examples_to_features_sc(
   pad_token_segment_id=0,
   mask_padding_with_zero=True,
   lang2id=None,
+  num_workers=1,
 ):
   """
   Loads a data file into a list of ``InputFeatures``
@@ -99,6 +101,8 @@ def convert_examples_to_features_sc(
     mask_padding_with_zero: If set to ``True``, the attention mask will be filled by ``1`` for actual values
       and by ``0`` for padded values. If set to ``False``, inverts it (``1`` for padded values, ``0`` for
       actual values)
+    num_workers: If greater than 1, contiguous chunks of the examples are converted in as many processes,
+      the features are the same
   Returns:
     If the ``examples`` input is a ``tf.data.Dataset``, will return a ``tf.data.Dataset``
     containing the task-specific features. If the input is a list of ``InputExamples``, will return
@@ -108,6 +112,18 @@ def convert_examples_to_features_sc(
   # if is_tf_available() and isinstance(examples, tf.data.Dataset):
   #   is_tf_dataset = True
 
+  if num_workers > 1:
+    return map_chunks(convert_examples_to_features_sc, examples, num_workers,
+                      dict(tokenizer=tokenizer,
+                           max_length=max_length,
+                           label_list=label_list,
+                           output_mode=output_mode,
+                           pad_on_left=pad_on_left,
+                           pad_token=pad_token,
+                           pad_token_segment_id=pad_token_segment_id,
+                           mask_padding_with_zero=mask_padding_with_zero,
+                           lang2id=lang2id))
+
   label_map = {label: i for i, label in enumerate(label_list)}
 
   features = []
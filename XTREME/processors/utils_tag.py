@@ -22,6 +22,7 @@ import logging
 import os
 from io import open
 from transformers import XLMTokenizer
+from .parallel import map_chunks
 
 logger = logging.getLogger(__name__)
 
@@ -118,15 +119,36 @@ def convert_examples_to_features_tag(examples,
                                  pad_token_label_id=-1,
                                  sequence_a_segment_id=0,
                                  mask_padding_with_zero=True,
-                                 lang='en'):
+                                 lang='en',
+                                 num_workers=1):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `num_workers` > 1 converts contiguous chunks of the examples in as many processes, same features
     """
+    if num_workers > 1:
+        return map_chunks(convert_examples_to_features_tag, examples, num_workers,
+                          dict(label_list=label_list,
+                               max_seq_length=max_seq_length,
+                               tokenizer=tokenizer,
+                               cls_token_at_end=cls_token_at_end,
+                               cls_token=cls_token,
+                               cls_token_segment_id=cls_token_segment_id,
+                               sep_token=sep_token,
+                               sep_token_extra=sep_token_extra,
+                               pad_on_left=pad_on_left,
+                               pad_token=pad_token,
+                               pad_token_segment_id=pad_token_segment_id,
+                               pad_token_label_id=pad_token_label_id,
+                               sequence_a_segment_id=sequence_a_segment_id,
+                               mask_padding_with_zero=mask_padding_with_zero,
+                               lang=lang))
 
     label_map = {label: i for i, label in enumerate(label_list)}
+    # the words repeat a lot across the sentences, each distinct word is tokenized once
+    word_tokens_cache = {}
 
     features = []
     for (ex_index, example) in enumerate(examples):
@@ -136,10 +158,12 @@ def convert_examples_to_features_tag(examples,
         tokens = []
         label_ids = []
         for word, label in zip(example.words, example.labels):
-            if isinstance(tokenizer, XLMTokenizer):
-                word_tokens = tokenizer.tokenize(word, lang=lang)
-            else:
-                word_tokens = tokenizer.tokenize(word)
+            if word not in word_tokens_cache:
+                if isinstance(tokenizer, XLMTokenizer):
+                    word_tokens_cache[word] = tokenizer.tokenize(word, lang=lang)
+                else:
+                    word_tokens_cache[word] = tokenizer.tokenize(word)
+            word_tokens = word_tokens_cache[word]
             if len(word) != 0 and len(word_tokens) == 0:
                 word_tokens = [tokenizer.unk_token]
             tokens.extend(word_tokens)
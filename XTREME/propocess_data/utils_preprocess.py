@@ -23,6 +23,7 @@ import random
 import os
 import shutil
 import json
+import multiprocessing
 
 
 TOKENIZERS = {
@@ -31,50 +32,93 @@ TOKENIZERS = {
     'xlmr': XLMRobertaTokenizer,
 }
 
-def panx_tokenize_preprocess(args):
-    def _preprocess_one_file(infile, outfile, idxfile, tokenizer, max_len):
-        if not os.path.exists(infile):
-            print(f'{infile} not exists')
-            return 0
-        special_tokens_count = 3 if isinstance(tokenizer, XLMRobertaTokenizer) else 2
-        max_seq_len = max_len - special_tokens_count
-        subword_len_counter = idx = 0
-        with open(infile, "rt") as fin, open(outfile, "w") as fout, open(idxfile, "w") as fidx:
-            for line in fin:
-                line = line.strip()
-                if not line:
-                    fout.write('\n')
-                    fidx.write('\n')
-                    idx += 1
-                    subword_len_counter = 0
-                    continue
-
-                items = line.split()
-                token = items[0].strip()
-                if len(items) == 2:
-                    label = items[1].strip()
-                else:
-                    label = 'O'
-                current_subwords_len = len(tokenizer.tokenize(token))
+# set in every worker process by _init_tokenize_worker, so the tokenizer is loaded once per process
+_worker_tokenizer = None
 
-                if (current_subwords_len == 0 or current_subwords_len > max_seq_len) and len(token) != 0:
-                    token = tokenizer.unk_token
-                    current_subwords_len = 1
 
-                if (subword_len_counter + current_subwords_len) > max_seq_len:
-                    fout.write(f"\n{token}\t{label}\n")
-                    fidx.write(f"\n{idx}\n")
-                    subword_len_counter = current_subwords_len
-                else:
-                    fout.write(f"{token}\t{label}\n")
-                    fidx.write(f"{idx}\n")
-                    subword_len_counter += current_subwords_len
-        return 1
-
-    model_type = args.model_type
-    tokenizer = TOKENIZERS[model_type].from_pretrained(args.model_name_or_path,
+def load_tokenizer(args):
+    return TOKENIZERS[args.model_type].from_pretrained(args.model_name_or_path,
                                                        do_lower_case=args.do_lower_case,
                                                        cache_dir=args.cache_dir if args.cache_dir else None)
+
+
+def _init_tokenize_worker(args):
+    global _worker_tokenizer
+    _worker_tokenizer = load_tokenizer(args)
+
+
+def _tokenize_one_file(job):
+    """
+    splits the sentences of a `token<tab>label` file into pieces of at most max_len - special tokens
+    subwords and writes them to outfile, the index of the source sentence of every line to idxfile.
+    The lines are streamed and every distinct token is tokenized once per file.
+    """
+    infile, outfile, idxfile, max_len, default_label = job
+    tokenizer = _worker_tokenizer
+    if not os.path.exists(infile):
+        print(f'{infile} does not exist')
+        return 0
+    special_tokens_count = 3 if isinstance(tokenizer, XLMRobertaTokenizer) else 2
+    max_seq_len = max_len - special_tokens_count
+    subwords_len = {}
+    subword_len_counter = idx = 0
+    with open(infile, "rt") as fin, open(outfile, "w") as fout, open(idxfile, "w") as fidx:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                fout.write('\n')
+                fidx.write('\n')
+                idx += 1
+                subword_len_counter = 0
+                continue
+
+            items = line.split()
+            token = items[0].strip()
+            if len(items) == 2:
+                label = items[1].strip()
+            else:
+                label = default_label
+            if token not in subwords_len:
+                subwords_len[token] = len(tokenizer.tokenize(token))
+            current_subwords_len = subwords_len[token]
+
+            if (current_subwords_len == 0 or current_subwords_len > max_seq_len) and len(token) != 0:
+                token = tokenizer.unk_token
+                current_subwords_len = 1
+
+            if (subword_len_counter + current_subwords_len) > max_seq_len:
+                fout.write(f"\n{token}\t{label}\n")
+                fidx.write(f"\n{idx}\n")
+                subword_len_counter = current_subwords_len
+            else:
+                fout.write(f"{token}\t{label}\n")
+                fidx.write(f"{idx}\n")
+                subword_len_counter += current_subwords_len
+    return 1
+
+
+def run_tokenize_jobs(args, jobs):
+    """
+    _tokenize_one_file over the jobs in args.num_workers processes, the largest input files first.
+    Every file is written by one process only, so the outputs do not depend on the number of workers.
+    """
+    jobs = sorted(jobs, key=lambda job: os.path.getsize(job[0]) if os.path.exists(job[0]) else 0, reverse=True)
+    if args.num_workers <= 1:
+        _init_tokenize_worker(args)
+        results = map(_tokenize_one_file, jobs)
+    else:
+        pool = multiprocessing.Pool(args.num_workers, initializer=_init_tokenize_worker, initargs=(args,))
+        results = pool.imap(_tokenize_one_file, jobs)
+    for job, code in zip(jobs, results):
+        if code > 0:
+            print(f'finish preprocessing {job[1]}')
+    if args.num_workers > 1:
+        pool.close()
+        pool.join()
+
+
+def panx_tokenize_preprocess(args):
+    jobs = []
     for lang in args.languages.split(','):
         out_dir = os.path.join(args.output_dir, lang)
         if not os.path.exists(out_dir):
@@ -90,9 +134,8 @@ def panx_tokenize_preprocess(args):
             if os.path.exists(outfile) and os.path.exists(idxfile):
                 print(f'{outfile} and {idxfile} exist')
             else:
-                code = _preprocess_one_file(infile, outfile, idxfile, tokenizer, args.max_len)
-                if code > 0:
-                    print(f'finish preprocessing {outfile}')
+                jobs.append((infile, outfile, idxfile, args.max_len, 'O'))
+    run_tokenize_jobs(args, jobs)
 
 
 def panx_preprocess(args):
@@ -124,48 +167,7 @@ def panx_preprocess(args):
             _process_one_file(infile, outfile)
 
 def udpos_tokenize_preprocess(args):
-    def _preprocess_one_file(infile, outfile, idxfile, tokenizer, max_len):
-        if not os.path.exists(infile):
-            print(f'{infile} does not exist')
-            return
-        subword_len_counter = idx = 0
-        special_tokens_count = 3 if isinstance(tokenizer, XLMRobertaTokenizer) else 2
-        max_seq_len = max_len - special_tokens_count
-        with open(infile, "rt") as fin, open(outfile, "w") as fout, open(idxfile, "w") as fidx:
-            for line in fin:
-                line = line.strip()
-                if len(line) == 0 or line == '':
-                    fout.write('\n')
-                    fidx.write('\n')
-                    idx += 1
-                    subword_len_counter = 0
-                    continue
-
-                items = line.split()
-                if len(items) == 2:
-                    label = items[1].strip()
-                else:
-                    label = "X"
-                token = items[0].strip()
-                current_subwords_len = len(tokenizer.tokenize(token))
-
-                if (current_subwords_len == 0 or current_subwords_len > max_seq_len) and len(token) != 0:
-                    token = tokenizer.unk_token
-                    current_subwords_len = 1
-
-                if (subword_len_counter + current_subwords_len) > max_seq_len:
-                    fout.write(f"\n{token}\t{label}\n")
-                    fidx.write(f"\n{idx}\n")
-                    subword_len_counter = current_subwords_len
-                else:
-                    fout.write(f"{token}\t{label}\n")
-                    fidx.write(f"{idx}\n")
-                    subword_len_counter += current_subwords_len
-
-    model_type = args.model_type
-    tokenizer = TOKENIZERS[model_type].from_pretrained(args.model_name_or_path,
-                                                       do_lower_case=args.do_lower_case,
-                                                       cache_dir=args.cache_dir if args.cache_dir else None)
+    jobs = []
     for lang in args.languages.split(','):
         if (os.path.exists(os.path.join(args.data_dir, "train-{}.tsv".format(lang)))==False) or \
            (os.path.exists(os.path.join(args.data_dir, "dev-{}.tsv".format(lang)))==False) or \
@@ -185,8 +187,8 @@ def udpos_tokenize_preprocess(args):
             if os.path.exists(outfile) and os.path.exists(idxfile):
                 print(f'{outfile} and {idxfile} exist')
             else:
-                _preprocess_one_file(infile, outfile, idxfile, tokenizer, args.max_len)
-                print(f'finish preprocessing {outfile}')
+                jobs.append((infile, outfile, idxfile, args.max_len, 'X'))
+    run_tokenize_jobs(args, jobs)
 
 def udpos_preprocess(args):
     def _read_one_file(file):
@@ -524,6 +526,8 @@ if __name__ == "__main__":
                                             help="whether to remove the last token")
     parser.add_argument("--remove_test_label", action='store_true',
                                             help="whether to remove test set label")
+    parser.add_argument("--num_workers", default=os.cpu_count(), type=int,
+                                            help="processes tokenizing the files in parallel (panx_tokenize, udpos_tokenize)")
     args = parser.parse_args()
 
     if args.task == 'panx_tokenize':
@@ -13,6 +13,9 @@ from model import *
 from utils import get_data, get_metric
 from torch.utils.tensorboard import SummaryWriter
 from utils import weight_update
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 
 '''
 torch.manual_seed(0)
@@ -27,8 +30,12 @@ def parse_args():
     parser.add_argument('--model', default='DMTL', type=str, help='DMTL, STL, SMTL, SMTL_new')
     parser.add_argument('--lang', default='all', type=str, help='all, en, zh, te, vi, de, es')
     parser.add_argument('--name', default='', type=str, help='name')
+    parser.add_argument('--multi_lang', action='store_true', default=False, help='one shared-encoder pass over the concatenated language batches (DMTL, SMTL, SMTL_new)')
+    parser.add_argument('--dynamic_padding', action='store_true', default=False, help='length-bucketed batches cut to their longest sequence')
+    parser.add_argument('--max_tokens', default=None, type=int, help='padded-token budget of a train batch with --dynamic_padding')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
     return parser.parse_args()
 
 params = parse_args()
@@ -71,7 +78,9 @@ if params.dataset in ['xnli', 'pawsx']:
                                                   mode_list=mode_list,
                                                   data_dir=data_dir,
                                                   max_seq_length=max_seq_length,
-                                                  batch_size=batch_size)
+                                                  batch_size=batch_size,
+                                                  dynamic_padding=params.dynamic_padding,
+                                                  max_tokens=params.max_tokens)
 elif params.dataset in ['panx', 'udpos']:
     task_type = 'TC'
     data_dir = '{}/{}/{}_processed_maxlen128/'.format(root_data, params.dataset, params.dataset)
@@ -81,10 +90,13 @@ elif params.dataset in ['panx', 'udpos']:
                                                   mode_list=mode_list,
                                                   data_dir=data_dir,
                                                   max_seq_length=max_seq_length,
-                                                  batch_size=batch_size)
+                                                  batch_size=batch_size,
+                                                  dynamic_padding=params.dynamic_padding,
+                                                  max_tokens=params.max_tokens)
 else:
     raise('No support dataset!')
     
+build_t = time.time()
 if params.model == 'STL':
     lang_list = [params.lang]
     task_num = len(lang_list)
@@ -98,6 +110,12 @@ elif params.model == 'SMTL_new':
 else:
     print("No support model!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
+
+if params.multi_lang and not hasattr(model, 'forward_multi'):
+    print("--multi_lang needs the DMTL, SMTL or SMTL_new model!")
+    exit()
 
 
 '''
@@ -128,12 +146,17 @@ for epoch in range(total_epoch):
     for batch_index in range(train_batch):
 #         if batch_index > 2:
 #             break
-        loss_train = torch.zeros(task_num).cuda()
-        for lg_index, lg in enumerate(lang_list):
-            inputs = get_data(lg, 'train', dataloader, iter_dataloader)
-            outputs = model(inputs, lg_index)
-            loss_train[lg_index] = outputs[0]
-            results[epoch, 0, lg_index] += outputs[0].item()
+        if params.multi_lang:
+            outputs = model.forward_multi([get_data(lg, 'train', dataloader, iter_dataloader) for lg in lang_list])
+            loss_train = torch.stack([out[0] for out in outputs])
+            results[epoch, 0, :] += loss_train.detach().cpu().numpy()
+        else:
+            loss_train = torch.zeros(task_num).cuda()
+            for lg_index, lg in enumerate(lang_list):
+                inputs = get_data(lg, 'train', dataloader, iter_dataloader)
+                outputs = model(inputs, lg_index)
+                loss_train[lg_index] = outputs[0]
+                results[epoch, 0, lg_index] += outputs[0].item()
                 
         weight_update(loss_train, model, optimizer, epoch, batch_index, task_num, clip_grad=True, scheduler=scheduler, avg_cost=results[:,0,:])
 
@@ -178,4 +201,7 @@ for epoch in range(total_epoch):
     for tn in range(task_num):
         writer.add_scalar('val/{}acc'.format(tn), results[epoch,2,tn], epoch)
         writer.add_scalar('test/{}acc'.format(tn), results[epoch,2,tn], epoch)
-    '''
\ No newline at end of file
+    '''
+
+if params.export is not None and (params.model == 'SMTL' or params.model == 'SMTL_new'):
+    export_slim(model, params.export)
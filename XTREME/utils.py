@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from transformers import BertTokenizer
 from transformers.data.processors.squad import SquadResult
 from transformers.data.metrics.squad_metrics import compute_predictions_logits, squad_evaluate
-from seqeval.metrics import precision_score, recall_score, f1_score
+from seqeval.metrics.sequence_labeling import end_of_chunk, start_of_chunk
 
 from create_dataset import DataloaderSC, DataloaderTC
 from processors.utils_tag import get_labels
@@ -35,7 +35,8 @@ def get_data(task, mode, all_dataloader, all_iter_dataloader):
     except:
         all_iter_dataloader[task][mode] = iter(all_dataloader[task][mode])
         batch = all_iter_dataloader[task][mode].next()
-    batch = tuple(t.cuda(non_blocking=True) for t in batch if t is not None)
+    # the feature cache stores int32/int8 arrays, the embeddings and the loss take long tensors
+    batch = tuple(t.long() for t in batch if t is not None)
     inputs = {"input_ids": batch[0], 
               "attention_mask": batch[1], 
               "token_type_ids": batch[2]}
@@ -43,6 +44,62 @@ def get_data(task, mode, all_dataloader, all_iter_dataloader):
     return inputs
 
 
+class TokenClassificationMetric(object):
+    """
+    Streaming evaluator of the token classification tasks on integer tag ids. update() takes the argmax
+    on the device and keeps only the non-pad tokens, compute() copies them to the host once.
+    The entity-level scores give the precision/recall/F1 of seqeval (micro average, default IOB mode):
+    the sentences are joined with an 'O' in between, as seqeval does, and its start_of_chunk/end_of_chunk
+    rules are evaluated once per pair of tags into lookup tables, so the spans are found without a python
+    loop over the tokens.
+    """
+    def __init__(self, labels, pad_token_label_id=nn.CrossEntropyLoss().ignore_index):
+        self.pad_token_label_id = pad_token_label_id
+        # tag and type of every label as parsed by seqeval, the extra last id is the 'O' between sentences
+        tags = [label[0] for label in labels] + ['O']
+        types = [label[1:].split('-', maxsplit=1)[-1] or '_' for label in labels] + ['_']
+        self.outside = len(labels)
+        type_index = {t: i for i, t in enumerate(sorted(set(types)))}
+        self.types = np.array([type_index[t] for t in types])
+        self.start_table = np.array([[start_of_chunk(tags[a], tags[b], types[a], types[b]) for b in range(len(tags))] 
+                                     for a in range(len(tags))])
+        self.end_table = np.array([[end_of_chunk(tags[a], tags[b], types[a], types[b]) for b in range(len(tags))] 
+                                   for a in range(len(tags))])
+        self.preds, self.label_ids, self.lengths = [], [], []
+
+    def update(self, logits, label_ids):
+        mask = label_ids != self.pad_token_label_id
+        self.preds.append(logits.argmax(-1)[mask])
+        self.label_ids.append(label_ids[mask])
+        self.lengths.append(mask.sum(1))
+
+    def chunks(self, ids, lengths):
+        # the (type, begin, end) spans of seqeval's get_entities, each encoded as one integer
+        seq = np.append(np.insert(ids, np.cumsum(lengths), self.outside), self.outside)
+        prev = np.append(self.outside, seq[:-1])
+        index = np.arange(len(seq))
+        # begin offset of the current chunk after each position
+        begin = np.maximum.accumulate(np.where(self.start_table[prev, seq], index, 0))
+        end = np.nonzero(self.end_table[prev, seq])[0] - 1
+        return np.unique((begin[end] * len(seq) + end) * len(self.types) + self.types[seq[end]])
+
+    def compute(self):
+        if len(self.preds) == 0:
+            return {'precision': 0, 'recall': 0, 'f1': 0, 'accuracy': 0}
+        preds = torch.cat(self.preds).cpu().numpy()
+        label_ids = torch.cat(self.label_ids).cpu().numpy()
+        lengths = torch.cat(self.lengths).cpu().numpy()
+        true_chunks, pred_chunks = self.chunks(label_ids, lengths), self.chunks(preds, lengths)
+        nb_correct = len(np.intersect1d(true_chunks, pred_chunks, assume_unique=True))
+        nb_pred, nb_true = len(pred_chunks), len(true_chunks)
+        precision = nb_correct / nb_pred if nb_pred > 0 else 0
+        recall = nb_correct / nb_true if nb_true > 0 else 0
+        return {'precision': precision,
+                'recall': recall,
+                'f1': 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0,
+                'accuracy': (preds == label_ids).mean() if len(preds) > 0 else 0}
+
+
 def get_metric(root_data, model, task, mode, all_dataloader, all_iter_dataloader, 
                squad_label=None, lg=None, lg_index=None):
     if lg is None:
@@ -50,53 +107,24 @@ def get_metric(root_data, model, task, mode, all_dataloader, all_iter_dataloader
     if lg_index is None:
         lg_index = task
     if task in ['panx', 'udpos']:
+        labels = get_labels('{}/{}/{}_processed_maxlen128/labels.txt'.format(root_data, task, task))
+        metric = TokenClassificationMetric(labels)
         for batch_index in range(len(all_dataloader[lg][mode])):
             inputs = get_data(lg, mode, all_dataloader, all_iter_dataloader)
             _, logits = model.predict(inputs, lg_index)
-            
-            if batch_index == 0:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-                
-        preds = np.argmax(preds, axis=2)
-        
-        labels = get_labels('{}/{}/{}_processed_maxlen128/labels.txt'.format(root_data, task, task))
-        label_map = {i: label for i, label in enumerate(labels)}
-
-        out_label_list = [[] for _ in range(out_label_ids.shape[0])]
-        preds_list = [[] for _ in range(out_label_ids.shape[0])]
-        
-        pad_token_label_id = nn.CrossEntropyLoss().ignore_index
-        for i in range(out_label_ids.shape[0]):
-            for j in range(out_label_ids.shape[1]):
-                if out_label_ids[i, j] != pad_token_label_id:
-                    out_label_list[i].append(label_map[out_label_ids[i][j]])
-                    preds_list[i].append(label_map[preds[i][j]])
-        precision = precision_score(out_label_list, preds_list)
-        recall = recall_score(out_label_list, preds_list)
-        f1 = f1_score(out_label_list, preds_list)
-#         return precision, recall, f1
-        return f1
+            metric.update(logits.detach(), inputs["labels"])
+        scores = metric.compute()
+        # entity-level F1 for NER, token accuracy for POS (the tags have no B-/I- chunks)
+        return scores['f1'] if task == 'panx' else scores['accuracy']
     
     elif task in ['xnli', 'pawsx']:
+        correct, total = 0, 0
         for batch_index in range(len(all_dataloader[lg][mode])):
             inputs = get_data(lg, mode, all_dataloader, all_iter_dataloader)
             _, logits = model.predict(inputs, lg_index)
-            
-            if batch_index==0:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = inputs["labels"].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-                
-        #results[epoch, mode_index+1, lg_index, 0] /= (batch_index+1)
-        preds = np.argmax(preds, axis=1)
-        acc = (preds==out_label_ids).mean()
-        return acc
+            correct += (logits.detach().argmax(1) == inputs["labels"]).sum()
+            total += inputs["labels"].numel()
+        return int(correct) / total
     
     else:
         raise('no support!')
@@ -370,11 +370,12 @@ class AdaShare(nn.Module):
 
 # do selection at hidden layer
 class SMTLmodel(nn.Module):
-    def __init__(self, dataset='CityScape', version='v1'):
+    def __init__(self, dataset='CityScape', version='v1', pruned=()):
         super(SMTLmodel, self).__init__()
         self.version = version
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared encoder
-        self.backbone_s = ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
+        self.backbone_s = None if 'backbone_s.' in pruned else ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
         ch = [256, 512, 1024, 2048]
         
         if dataset == 'NYUv2':
@@ -389,7 +390,8 @@ class SMTLmodel(nn.Module):
             raise('No support {} dataset'.format(dataset))
         
         # task-specific encoder
-        self.backbone_t = nn.ModuleList([ResnetDilated(resnet.__dict__['resnet50'](pretrained=True)) for _ in self.tasks])
+        self.backbone_t = nn.ModuleList([None if 'backbone_t.{}.'.format(i) in pruned else ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
+                                         for i in range(len(self.tasks))])
         
         # adaptative parameters
         if self.version == 'v1' or self.version =='v2':
@@ -443,33 +445,42 @@ class SMTLmodel(nn.Module):
                 out[i] = out[i] / torch.norm(out[i], p=2, dim=1, keepdim=True)
         return out
         
-    def predict(self, x):
-        img_size  = x.size()[-2:]
-        # shared encoder output
-        x_s = self.backbone_s(x)
-        # task-specific encoder output
-        x_t = [0 for _ in self.tasks]
-        for i in range(len(self.tasks)):
-            x_t[i] = self.backbone_t[i](x)
-        # combine shared encoder output and task-specific encoder output, obtain final hidden feature
-        x_h = [0 for _ in self.tasks]
+    def get_gate(self):
+        # (shared, specific) weights of every task at inference, hard 0/1 decisions for SMTL-v3
+        alpha = self.alpha
+        gate = []
         for i in range(len(self.tasks)):
             if self.version == 'v1':
-                temp_alpha = F.softmax(self.alpha[i], 0)     # SMTL-v1, alpha_1 + alpha_2 = 1
+                gate.append(F.softmax(alpha[i], 0))     # SMTL-v1, alpha_1 + alpha_2 = 1
             elif self.version == 'v2':
-                temp_alpha = torch.exp(self.alpha[i]) / (1 + torch.exp(self.alpha[i])) # SMTL-v2, 0 <= alpha <=1
+                gate.append(torch.exp(alpha[i]) / (1 + torch.exp(alpha[i]))) # SMTL-v2, 0 <= alpha <=1
             elif self.version == 'v3':
-                # below for SMTL-v3, gumbel softmax
-                temp = torch.sigmoid(self.alpha[i])
-                if temp >= 0.5:
-                    temp_alpha = [0, 1]
-                else:
-                    temp_alpha = [1, 0]
+                # SMTL-v3, converged decision of the gumbel softmax gate
+                gate.append([0, 1] if torch.sigmoid(alpha[i]) >= 0.5 else [1, 0])
             else:
                 print("No correct version parameter!")
                 exit()
+        return gate
 
-            x_h[i] = temp_alpha[0] * x_s + temp_alpha[1] * x_t[i]
+    def predict(self, x):
+        img_size  = x.size()[-2:]
+        # with the hard SMTL-v3 gate only the selected encoders are run
+        gate = self.get_gate()
+        hard = self.version == 'v3'
+        # shared encoder output, computed once if any task selects it
+        x_s = self.backbone_s(x) if not hard or any(g[0] for g in gate) else 0
+        # task-specific encoder output, skipped for tasks that select the shared encoder
+        x_t = [0 for _ in self.tasks]
+        for i in range(len(self.tasks)):
+            if not hard or gate[i][1]:
+                x_t[i] = self.backbone_t[i](x)
+        # combine shared encoder output and task-specific encoder output, obtain final hidden feature
+        x_h = [0 for _ in self.tasks]
+        for i in range(len(self.tasks)):
+            if hard:
+                x_h[i] = x_t[i] if gate[i][1] else x_s
+            else:
+                x_h[i] = gate[i][0] * x_s + gate[i][1] * x_t[i]
         out = [0 for _ in self.tasks]
         for i, t in enumerate(self.tasks):
             out[i] = F.interpolate(self.decoders[i](x_h[i]), img_size, mode='bilinear', align_corners=True)
@@ -485,11 +496,12 @@ class SMTLmodel(nn.Module):
 
 # do selection at classifier layer
 class SMTLmodel_new(nn.Module):
-    def __init__(self, dataset='CityScape', version='v1'):
+    def __init__(self, dataset='CityScape', version='v1', pruned=()):
         super(SMTLmodel_new, self).__init__()
         self.version = version
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared encoder
-        self.backbone_s = ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
+        self.backbone_s = None if 'backbone_s.' in pruned else ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
         ch = [256, 512, 1024, 2048]
         
         if dataset == 'NYUv2':
@@ -504,7 +516,8 @@ class SMTLmodel_new(nn.Module):
             raise('No support {} dataset'.format(dataset))
         
         # task-specific encoder
-        self.backbone_t = nn.ModuleList([ResnetDilated(resnet.__dict__['resnet50'](pretrained=True)) for _ in self.tasks])
+        self.backbone_t = nn.ModuleList([None if 'backbone_t.{}.'.format(i) in pruned else ResnetDilated(resnet.__dict__['resnet50'](pretrained=True))
+                                         for i in range(len(self.tasks))])
         
         # adaptative parameters
         if self.version == 'v1' or self.version =='v2':
@@ -565,14 +578,35 @@ class SMTLmodel_new(nn.Module):
         
         return out
         
+    def get_gate(self):
+        # (shared, specific) weights of every task at inference, hard 0/1 decisions for SMTL-v3
+        alpha = self.alpha
+        gate = []
+        for i in range(len(self.tasks)):
+            if self.version == 'v1':
+                gate.append(F.softmax(alpha[i], 0))     # SMTL-v1, alpha_1 + alpha_2 = 1
+            elif self.version == 'v2':
+                gate.append(torch.exp(alpha[i]) / (1 + torch.exp(alpha[i]))) # SMTL-v2, 0 <= alpha <=1
+            elif self.version == 'v3':
+                # SMTL-v3, converged decision of the gumbel softmax gate
+                gate.append([0, 1] if torch.sigmoid(alpha[i]) >= 0.5 else [1, 0])
+            else:
+                print("No correct version parameter!")
+                exit()
+        return gate
+
     def predict(self, x):
         img_size  = x.size()[-2:]
-        # shared encoder output
-        x_s = self.backbone_s(x)
-        # task-specific encoder output
+        # with the hard SMTL-v3 gate only the selected encoders are run
+        gate = self.get_gate()
+        hard = self.version == 'v3'
+        # shared encoder output, computed once if any task selects it
+        x_s = self.backbone_s(x) if not hard or any(g[0] for g in gate) else 0
+        # task-specific encoder output, skipped for tasks that select the shared encoder
         x_t = [0 for _ in self.tasks]
         for i in range(len(self.tasks)):
-            x_t[i] = self.backbone_t[i](x)
+            if not hard or gate[i][1]:
+                x_t[i] = self.backbone_t[i](x)
         # shared decoder output
         out_s = [0 for _ in self.tasks]
         # task-specific decoder output
@@ -580,23 +614,14 @@ class SMTLmodel_new(nn.Module):
         # combine shared decoder output and task-specific decoder output, obtain final output
         out = [0 for _ in self.tasks]
         for i, t in enumerate(self.tasks):
-            out_s[i] = F.interpolate(self.decoders_s[i](x_s), img_size, mode='bilinear', align_corners=True)
-            out_t[i] = F.interpolate(self.decoders_t[i](x_t[i]), img_size, mode='bilinear', align_corners=True)
-            if self.version == 'v1':
-                temp_alpha = F.softmax(self.alpha[i], 0)     # SMTL-v1, alpha_1 + alpha_2 = 1
-            elif self.version == 'v2':
-                temp_alpha = torch.exp(self.alpha[i]) / (1 + torch.exp(self.alpha[i])) # SMTL-v2, 0 <= alpha <=1
-            elif self.version == 'v3':
-                # below for SMTL-v3, gumbel softmax
-                temp = torch.sigmoid(self.alpha[i])
-                if temp >= 0.5:
-                    temp_alpha = [0, 1]
-                else:
-                    temp_alpha = [1, 0]
+            if not hard or gate[i][0]:
+                out_s[i] = F.interpolate(self.decoders_s[i](x_s), img_size, mode='bilinear', align_corners=True)
+            if not hard or gate[i][1]:
+                out_t[i] = F.interpolate(self.decoders_t[i](x_t[i]), img_size, mode='bilinear', align_corners=True)
+            if hard:
+                out[i] = out_t[i] if gate[i][1] else out_s[i]
             else:
-                print("No correct version parameter!")
-                exit()
-            out[i] = temp_alpha[0] * out_s[i] + temp_alpha[1] * out_t[i]    
+                out[i] = gate[i][0] * out_s[i] + gate[i][1] * out_t[i]
             
             if t == 'segmentation':
                 out[i] = F.log_softmax(out[i], dim=1)
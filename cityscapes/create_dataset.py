@@ -1,6 +1,7 @@
 from torch.utils.data.dataset import Dataset
 
 import os
+import json
 import torch
 import torch.nn.functional as F
 import fnmatch
@@ -24,6 +25,39 @@ class RandomScaleCrop(object):
         return img_, label_, depth_ / sc
 
 
+class BatchRandomScaleCrop(object):
+    """
+    RandomScaleCrop followed by a random horizontal flip, applied to a whole batch after it is moved to the device.
+    Every sample draws its own scale, crop and flip; the crop-and-resize is one affine grid per sample, so each
+    interpolation mode is a single grid_sample over the batch. Also runs on CPU tensors.
+    """
+    def __init__(self, scale=[1.0, 1.2, 1.5], flip=True):
+        self.scale = scale
+        self.flip = flip
+
+    def __call__(self, img, label, depth):
+        batch_size, _, height, width = img.shape
+        device = img.device
+        sc = torch.tensor(self.scale, device=device)[torch.randint(len(self.scale), (batch_size,), device=device)]
+        h, w = torch.floor(height / sc), torch.floor(width / sc)
+        i = torch.floor(torch.rand(batch_size, device=device) * (height - h + 1))
+        j = torch.floor(torch.rand(batch_size, device=device) * (width - w + 1))
+        # map the output grid onto the crop [i, i+h-1] x [j, j+w-1], in align_corners=True coordinates
+        theta = torch.zeros(batch_size, 2, 3, device=device)
+        theta[:, 0, 0] = (w - 1) / (width - 1)
+        theta[:, 0, 2] = (2 * j + w - 1) / (width - 1) - 1
+        theta[:, 1, 1] = (h - 1) / (height - 1)
+        theta[:, 1, 2] = (2 * i + h - 1) / (height - 1) - 1
+        if self.flip:
+            flip = torch.rand(batch_size, device=device) < 0.5
+            theta[:, 0, 0] = torch.where(flip, -theta[:, 0, 0], theta[:, 0, 0])
+        grid = F.affine_grid(theta, [batch_size, 1, height, width], align_corners=True)
+
+        img_ = F.grid_sample(img, grid, mode='bilinear', align_corners=True)
+        label_, depth_ = F.grid_sample(torch.cat([label[:, None].float(), depth], 1), grid, mode='nearest', align_corners=True).split([1, depth.size(1)], 1)
+        return img_, label_[:, 0].to(label.dtype), depth_ / sc[:, None, None, None]
+
+
 class CityScape(Dataset):
     def __init__(self, root, mode='train', augmentation=False):
         self.mode = mode
@@ -32,7 +66,7 @@ class CityScape(Dataset):
         
         random.seed(688)
         np.random.seed(688)
-        data_len = len(fnmatch.filter(os.listdir(self.root + '/train/image'), '*.npy'))
+        data_len = self._num_samples('train')
         train_index = list(np.random.choice(np.arange(data_len), size=int(data_len*0.8), replace=False))
         val_index = list(set(range(data_len)).difference(set(train_index)))
         # read the data file
@@ -46,17 +80,23 @@ class CityScape(Dataset):
             self.index_list = train_index + val_index
             self.data_path = self.root + '/train'
         elif self.mode == 'test':
-            data_len = len(fnmatch.filter(os.listdir(self.root + '/val/image'), '*.npy'))
+            data_len = self._num_samples('val')
             self.index_list = list(range(data_len))
             self.data_path = self.root + '/val'
 
 
-    def __getitem__(self, i):
-        index = self.index_list[i]
+    def _num_samples(self, split):
+        return len(fnmatch.filter(os.listdir(self.root + '/{}/image'.format(split)), '*.npy'))
+
+    def _load(self, index):
         # load data from the pre-processed npy files
         image = torch.from_numpy(np.moveaxis(np.load(self.data_path + '/image/{:d}.npy'.format(index)), -1, 0))
         semantic = torch.from_numpy(np.load(self.data_path + '/label/{:d}.npy'.format(index)))
         depth = torch.from_numpy(np.moveaxis(np.load(self.data_path + '/depth/{:d}.npy'.format(index)), -1, 0))
+        return image, semantic, depth
+
+    def __getitem__(self, i):
+        image, semantic, depth = self._load(self.index_list[i])
 
         # apply data augmentation if required
         if self.augmentation == 'True':
@@ -70,3 +110,41 @@ class CityScape(Dataset):
 
     def __len__(self):
         return len(self.index_list)
+
+
+class CityScapePacked(CityScape):
+    """
+    CityScape read from the packed layout written by pack_dataset.py: one contiguous .npy array
+    per split and modality, described by index.json, memory-mapped and sliced without copying.
+    """
+    modalities = ['image', 'label', 'depth']
+
+    def __init__(self, root, mode='train', augmentation=False, packed_root=None):
+        self.packed_root = os.path.expanduser(packed_root or os.path.join(root, 'packed'))
+        with open(os.path.join(self.packed_root, 'index.json')) as f:
+            self.index = json.load(f)
+        # mapped on first access, so every DataLoader worker opens its own mapping
+        self.arrays = None
+        super(CityScapePacked, self).__init__(root, mode=mode, augmentation=augmentation)
+
+    def _num_samples(self, split):
+        return self.index[split]['num_samples']
+
+    def _open(self):
+        split = os.path.basename(self.data_path)
+        # copy-on-write mapping: samples are views of the page cache, in-place augmentation stays private
+        return {m: np.load(os.path.join(self.packed_root, split, m + '.npy'), mmap_mode='c') for m in self.modalities}
+
+    def _load(self, index):
+        if self.arrays is None:
+            self.arrays = self._open()
+        arrays = self.arrays
+        image = torch.from_numpy(np.moveaxis(arrays['image'][index], -1, 0))
+        semantic = torch.from_numpy(arrays['label'][index])
+        depth = torch.from_numpy(np.moveaxis(arrays['depth'][index], -1, 0))
+        return image, semantic, depth
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
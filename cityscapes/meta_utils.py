@@ -0,0 +1,110 @@
+import torch
+from contextlib import contextmanager
+
+
+def _owner(model, name):
+    # resolve 'backbone_t.0.layer1.0.conv1.weight' to (conv1 module, 'weight') once
+    names = name.split('.')
+    mod = model
+    for n in names[:-1]:
+        mod = getattr(mod, n)
+    return mod, names[-1]
+
+
+class MetaStep(object):
+    """
+    Stateless one-step unrolling for the bilevel alpha update.
+    The virtual model w' = w - lr * dL_train/dw is never built: the fast weights are
+    passed to a functional forward of the live model, whose parameter slots are
+    swapped for the duration of the call and restored afterwards.
+    """
+    def __init__(self, model, lr=1e-4):
+        self.model = model
+        self.lr = lr
+        self.names = [n for n, _ in model.named_parameters()]
+        self.params = [p for _, p in model.named_parameters()]
+        self.param_slots = [_owner(model, n) for n in self.names]
+        # running statistics are cloned per call so the virtual passes leave the live BN buffers untouched,
+        # as the discarded meta model used to
+        self.buffer_slots = [_owner(model, n) for n, _ in model.named_buffers()]
+
+    @contextmanager
+    def _swap(self, fast_params):
+        saved_params = [mod._parameters[n] for mod, n in self.param_slots]
+        saved_buffers = [mod._buffers[n] for mod, n in self.buffer_slots]
+        try:
+            if fast_params is not None:
+                for (mod, n), p in zip(self.param_slots, fast_params):
+                    mod._parameters[n] = p
+            for (mod, n), b in zip(self.buffer_slots, saved_buffers):
+                mod._buffers[n] = None if b is None else b.clone()
+            yield self.model
+        finally:
+            for (mod, n), p in zip(self.param_slots, saved_params):
+                mod._parameters[n] = p
+            for (mod, n), b in zip(self.buffer_slots, saved_buffers):
+                mod._buffers[n] = b
+
+    def forward(self, fast_params, *inputs):
+        # fast_params=None evaluates the current weights without touching the live buffers
+        with self._swap(fast_params) as model:
+            return model(*inputs)
+
+    def unroll(self, loss, create_graph=True):
+        """
+        return the fast weights after one SGD step on loss, in model.named_parameters() order
+        create_graph=False returns detached fast weights (no path back to alpha or to w)
+        """
+        grads = torch.autograd.grad(loss, self.params, create_graph=create_graph, allow_unused=True)
+        fast_params = []
+        for p, g in zip(self.params, grads):
+            if not create_graph:
+                p = p.detach()
+            if g is None:
+                fast_params.append(p)
+            else:
+                fast_params.append(p - self.lr * g)
+        return fast_params
+
+    def hypergrad(self, h, loss_fn, train_inputs, train_targets, val_inputs, val_targets, mode='second_order', eps=1e-2):
+        """
+        write d L_val(w', alpha) / d alpha into h's .grad, with w' = w - lr * dL_train(w, alpha)/dw
+        mode: second_order (exact, differentiates through the inner step),
+              first_order (treats w' as a constant),
+              finite_difference (DARTS: the second-order term from a central difference of dL_train/dalpha)
+        return the validation loss at w'
+        """
+        alpha = list(h.parameters())
+        loss_train = loss_fn(self.forward(None, *train_inputs), train_targets)
+        if mode == 'second_order':
+            fast_params = self.unroll(loss_train, create_graph=True)
+            loss_val = loss_fn(self.forward(fast_params, *val_inputs), val_targets)
+            grads = torch.autograd.grad(loss_val, alpha)
+        elif mode == 'first_order':
+            fast_params = self.unroll(loss_train, create_graph=False)
+            loss_val = loss_fn(self.forward(fast_params, *val_inputs), val_targets)
+            grads = torch.autograd.grad(loss_val, alpha)
+        elif mode == 'finite_difference':
+            fast_params = [p.requires_grad_() for p in self.unroll(loss_train, create_graph=False)]
+            loss_val = loss_fn(self.forward(fast_params, *val_inputs), val_targets)
+            grads = torch.autograd.grad(loss_val, alpha + fast_params, allow_unused=True)
+            grads, dw = list(grads[:len(alpha)]), grads[len(alpha):]
+            dw = [torch.zeros_like(p) if g is None else g for p, g in zip(fast_params, dw)]
+            del fast_params
+            # w+- = w +- r * dL_val/dw', r = eps / ||dL_val/dw'||
+            r = eps / torch.sqrt(sum(torch.sum(g * g) for g in dw))
+            with torch.no_grad():
+                w_pos = [p + r * g for p, g in zip(self.params, dw)]
+                w_neg = [p - r * g for p, g in zip(self.params, dw)]
+            del dw
+            g_pos = torch.autograd.grad(loss_fn(self.forward(w_pos, *train_inputs), train_targets), alpha)
+            del w_pos
+            g_neg = torch.autograd.grad(loss_fn(self.forward(w_neg, *train_inputs), train_targets), alpha)
+            del w_neg
+            grads = [g - self.lr * (gp - gn) / (2 * r) for g, gp, gn in zip(grads, g_pos, g_neg)]
+        else:
+            raise ValueError('No support {} hypergradient'.format(mode))
+        for p, g in zip(alpha, grads):
+            p.grad = g
+        return loss_val.detach()
+
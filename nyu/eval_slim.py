@@ -0,0 +1,83 @@
+import torch, time, os, sys
+import numpy as np
+from backbone import SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
+from utils import *
+
+from create_dataset import NYUv2, NYUv2Packed
+from prefetcher import CUDAPrefetcher
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import read_slim, load_slim
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Evaluate a slim SMTL checkpoint on NYUv2')
+    parser.add_argument('--gpu_id', default='0', help='gpu_id')
+    parser.add_argument('--model', default='SMTL', type=str, help='SMTL, SMTL_new')
+    parser.add_argument('--checkpoint', type=str, required=True, help='slim checkpoint saved by train.py --export')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the memory-mapped arrays of pack_dataset.py')
+    parser.add_argument('--batch_size', default=4, type=int, help='batch size')
+    return parser.parse_args()
+
+
+params = parse_args()
+print(params)
+
+os.environ["CUDA_VISIBLE_DEVICES"] = params.gpu_id
+
+dataset_path = '/data/dataset/nyuv2/'
+
+build_t = time.time()
+ckpt = read_slim(params.checkpoint)
+# only the encoders selected by the gate are built
+if params.model == 'SMTL':
+    model = SMTLmodel(version=ckpt['version'], pruned=ckpt['pruned'])
+elif params.model == 'SMTL_new':
+    model = SMTLmodel_new(version=ckpt['version'], pruned=ckpt['pruned'])
+else:
+    print("No correct model parameter!")
+    exit()
+model = load_slim(model, ckpt).cuda()
+del ckpt
+clear_pretrained_cache()
+print('model built in {:.1f}s, {} parameters'.format(time.time()-build_t, sum(p.numel() for p in model.parameters())))
+
+dataset_class = NYUv2Packed if params.packed else NYUv2
+nyuv2_test_set = dataset_class(root=dataset_path, mode='test', augmentation='False')
+
+nyuv2_test_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
+    dataset=nyuv2_test_set,
+    batch_size=params.batch_size,
+    shuffle=False,
+    num_workers=2,
+    pin_memory=True))
+
+print('LOSS FORMAT: SEMANTIC_LOSS MEAN_IOU PIX_ACC | DEPTH_LOSS ABS_ERR REL_ERR | NORMAL_LOSS MEAN MED <11.25 <22.5 <30')
+s_t = time.time()
+model.eval()
+val_metric = MetricAccumulator(12, model.class_nb, conf_slots=(1, 2), normal_slot=7)
+with torch.no_grad():  # operations inside don't track history
+    val_dataset = iter(nyuv2_test_loader)
+    val_batch = len(nyuv2_test_loader)
+    for k in range(val_batch):
+        val_data, val_label, val_depth, val_normal = val_dataset.next()
+        val_label = val_label.long()
+        val_pred = model.predict(val_data)
+        val_loss = [model_fit(val_pred[0], val_label, 'semantic'),
+                     model_fit(val_pred[1], val_depth, 'depth'),
+                     model_fit(val_pred[2], val_normal, 'normal')]
+
+        val_metric.update_conf(val_pred[0].argmax(1).flatten(), val_label.flatten())
+
+        val_metric.update(0, val_loss[0])
+        val_metric.update(3, val_loss[1])
+        val_metric.update(4, depth_error_tensor(val_pred[1], val_depth))
+        val_metric.update(6, val_loss[2])
+        val_metric.update_normal(val_pred[2], val_normal)
+        val_metric.step()
+
+    avg_cost = val_metric.summary()
+print('TEST: {:.4f} {:.4f} {:.4f} | {:.4f} {:.4f} {:.4f} | {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} {:.4f} || {:.4f}'
+      .format(*avg_cost.tolist(), time.time()-s_t))
@@ -0,0 +1,72 @@
+import os, time, json, fnmatch
+import numpy as np
+import torch
+from create_dataset import NYUv2, NYUv2Packed
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Pack NYUv2 into memory-mapped arrays')
+    parser.add_argument('--root', default='/data/dataset/nyuv2/', type=str, help='dataset root with train/ and val/')
+    parser.add_argument('--packed_root', default=None, type=str, help='output directory, default root/packed')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare the packed and per-file loaders')
+    parser.add_argument('--batch_size', default=4, type=int, help='batch size of the benchmark')
+    parser.add_argument('--num_workers', default=2, type=int, help='loader workers of the benchmark')
+    parser.add_argument('--num_batches', default=200, type=int, help='batches read per loader in the benchmark')
+    return parser.parse_args()
+
+
+def pack_split(src, dst, modalities):
+    num_samples = len(fnmatch.filter(os.listdir(src + '/image'), '*.npy'))
+    info = {'num_samples': num_samples}
+    os.makedirs(dst, exist_ok=True)
+    for m in modalities:
+        first = np.load(src + '/{}/0.npy'.format(m))
+        out = np.lib.format.open_memmap(os.path.join(dst, m + '.npy'), mode='w+',
+                                        dtype=first.dtype, shape=(num_samples,) + first.shape)
+        for i in range(num_samples):
+            out[i] = np.load(src + '/{}/{:d}.npy'.format(m, i))
+        out.flush()
+        del out
+        info[m] = {'shape': list(first.shape), 'dtype': str(first.dtype)}
+    return info
+
+
+def pack(root, packed_root, modalities):
+    index = {}
+    for split in ['train', 'val']:
+        s_t = time.time()
+        index[split] = pack_split(os.path.join(root, split), os.path.join(packed_root, split), modalities)
+        print('packed {}: {} samples in {:.1f}s'.format(split, index[split]['num_samples'], time.time()-s_t))
+    # index.json is written last, so an interrupted conversion is never picked up by the packed dataset
+    with open(os.path.join(packed_root, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+
+
+def benchmark(dataset, batch_size, num_workers, num_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True)
+    num_samples = 0
+    s_t = time.time()
+    for k, batch in enumerate(loader):
+        num_samples += batch[0].size(0)
+        if k + 1 == num_batches:
+            break
+    return num_samples / (time.time() - s_t)
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    packed_root = params.packed_root or os.path.join(params.root, 'packed')
+    if not os.path.exists(os.path.join(packed_root, 'index.json')):
+        pack(params.root, packed_root, NYUv2Packed.modalities)
+    if params.benchmark:
+        for name, dataset in [('per-file', NYUv2(root=params.root, mode='train')),
+                              ('packed', NYUv2Packed(root=params.root, mode='train', packed_root=packed_root))]:
+            speed = benchmark(dataset, params.batch_size, params.num_workers, params.num_batches)
+            print('{}: {:.1f} samples/s'.format(name, speed))
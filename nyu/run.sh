@@ -12,7 +12,9 @@ python -u train.py --gpu_id 6 --model AFA > out/afa.out
 
 python -u train.py --gpu_id 6 --model SMTL --version v1 > out/smtl_v1.out
 
-python -u train.py --gpu_id 6 --model SMTL --version v3 > out/smtl_v3.out
+python -u train.py --gpu_id 6 --model SMTL --version v3 --export out/smtl_v3_slim.pt > out/smtl_v3.out
+
+python -u eval_slim.py --gpu_id 6 --model SMTL --checkpoint out/smtl_v3_slim.pt > out/smtl_v3_slim.out
 
 python -u train.py --gpu_id 6 --model SMTL_new --version v1 > out/smtl_new_v1.out
 
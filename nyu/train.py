@@ -1,15 +1,20 @@
-import torch, time, os, random
+import torch, time, os, random, sys
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 import scipy.io as sio
 from backbone import DeepLabv3, Cross_Stitch, MTANDeepLabv3, AdaShare, SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
 from nddr_cnn import NDDRCNN
 from afa import AFANet
 from utils import *
 
-from create_dataset import NYUv2
+from create_dataset import NYUv2, NYUv2Packed, BatchRandomScaleCrop
+from prefetcher import CUDAPrefetcher
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 
 import argparse
 
@@ -21,11 +26,13 @@ def parse_args():
     parser = argparse.ArgumentParser(description= 'SMTL on NYUv2')
     parser.add_argument('--gpu_id', default='0', help='gpu_id') 
     parser.add_argument('--model', default='DMTL', type=str, help='DMTL, CROSS, MTAN, AdaShare, NDDRCNN, AFA, SMTL, SMTL_new')
-    parser.add_argument('--aug', type=str, default='False', help='data augmentation')
+    parser.add_argument('--aug', type=str, default='False', help='data augmentation: False, True (per sample in the loader), batch (per batch on the device)')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the memory-mapped arrays of pack_dataset.py')
     parser.add_argument('--train_mode', default='trainval', type=str, help='trainval, train')
     parser.add_argument('--total_epoch', default=200, type=int, help='training epoch')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
     return parser.parse_args()
 
 
@@ -36,6 +43,7 @@ os.environ["CUDA_VISIBLE_DEVICES"] = params.gpu_id
 
 dataset_path = '/data/dataset/nyuv2/'
 
+build_t = time.time()
 if params.model == 'DMTL':
     batch_size = 8
     model = DeepLabv3().cuda()
@@ -63,25 +71,29 @@ elif params.model == 'SMTL_new':
 else:
     print("No correct model parameter!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
 
-nyuv2_train_set = NYUv2(root=dataset_path, mode=params.train_mode, augmentation=params.aug)
-nyuv2_test_set = NYUv2(root=dataset_path, mode='test', augmentation='False')
+batch_aug = BatchRandomScaleCrop()
+dataset_class = NYUv2Packed if params.packed else NYUv2
+nyuv2_train_set = dataset_class(root=dataset_path, mode=params.train_mode, augmentation=params.aug)
+nyuv2_test_set = dataset_class(root=dataset_path, mode='test', augmentation='False')
 
-nyuv2_train_loader = torch.utils.data.DataLoader(
+nyuv2_train_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_train_set,
     batch_size=batch_size,
     shuffle=True,
     num_workers=2,
     pin_memory=True,
-    drop_last=True)
+    drop_last=True))
 
 
-nyuv2_test_loader = torch.utils.data.DataLoader(
+nyuv2_test_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_test_set,
     batch_size=batch_size,
     shuffle=False,
     num_workers=2,
-    pin_memory=True)
+    pin_memory=True))
 
 
 task_num = len(model.tasks)
@@ -96,16 +108,16 @@ avg_cost = torch.zeros([total_epoch, 24])
 lambda_weight = torch.ones([task_num, total_epoch]).cuda()
 for index in range(total_epoch):
     s_t = time.time()
-    cost = torch.zeros(24)
 
     # iteration for all batches
     model.train()
     train_dataset = iter(nyuv2_train_loader)
-    conf_mat = ConfMatrix(model.class_nb)
+    train_metric = MetricAccumulator(12, model.class_nb, conf_slots=(1, 2), normal_slot=7)
     for k in range(train_batch):
         train_data, train_label, train_depth, train_normal = train_dataset.next()
-        train_data, train_label = train_data.cuda(non_blocking=True), train_label.long().cuda(non_blocking=True)
-        train_depth, train_normal = train_depth.cuda(non_blocking=True), train_normal.cuda(non_blocking=True)
+        train_label = train_label.long()
+        if params.aug == 'batch':
+            train_data, train_label, train_depth, train_normal = batch_aug(train_data, train_label, train_depth, train_normal)
 
         train_pred = model(train_data)
 
@@ -125,44 +137,43 @@ for index in range(total_epoch):
         optimizer.step()
 
         # accumulate label prediction for every pixel in training images
-        conf_mat.update(train_pred[0].argmax(1).flatten(), train_label.flatten())
+        train_metric.update_conf(train_pred[0].argmax(1).flatten(), train_label.flatten())
 
-        cost[0] = train_loss[0].item()
-        cost[3] = train_loss[1].item()
-        cost[4], cost[5] = depth_error(train_pred[1], train_depth)
-        cost[6] = train_loss[2].item()
-        cost[7], cost[8], cost[9], cost[10], cost[11] = normal_error(train_pred[2], train_normal)
-        avg_cost[index, :12] += cost[:12] / train_batch
+        train_metric.update(0, train_loss[0])
+        train_metric.update(3, train_loss[1])
+        train_metric.update(4, depth_error_tensor(train_pred[1], train_depth))
+        train_metric.update(6, train_loss[2])
+        train_metric.update_normal(train_pred[2], train_normal)
+        train_metric.step()
 
     # compute mIoU and acc
-    avg_cost[index, 1], avg_cost[index, 2] = conf_mat.get_metrics()
+    avg_cost[index, :12] = train_metric.summary()
 
     # evaluating test data
     model.eval()
-    conf_mat = ConfMatrix(model.class_nb)
+    val_metric = MetricAccumulator(12, model.class_nb, conf_slots=(1, 2), normal_slot=7)
     with torch.no_grad():  # operations inside don't track history
         val_dataset = iter(nyuv2_test_loader)
         val_batch = len(nyuv2_test_loader)
         for k in range(val_batch):
             val_data, val_label, val_depth, val_normal = val_dataset.next()
-            val_data, val_label = val_data.cuda(non_blocking=True), val_label.long().cuda(non_blocking=True)
-            val_depth, val_normal = val_depth.cuda(non_blocking=True), val_normal.cuda(non_blocking=True)
+            val_label = val_label.long()
             val_pred = model.predict(val_data)
             val_loss = [model_fit(val_pred[0], val_label, 'semantic'),
                          model_fit(val_pred[1], val_depth, 'depth'),
                          model_fit(val_pred[2], val_normal, 'normal')]
 
-            conf_mat.update(val_pred[0].argmax(1).flatten(), val_label.flatten())
+            val_metric.update_conf(val_pred[0].argmax(1).flatten(), val_label.flatten())
 
-            cost[12] = val_loss[0].item()
-            cost[15] = val_loss[1].item()
-            cost[16], cost[17] = depth_error(val_pred[1], val_depth)
-            cost[18] = val_loss[2].item()
-            cost[19], cost[20], cost[21], cost[22], cost[23] = normal_error(val_pred[2], val_normal)
-            avg_cost[index, 12:] += cost[12:] / val_batch
+            val_metric.update(0, val_loss[0])
+            val_metric.update(3, val_loss[1])
+            val_metric.update(4, depth_error_tensor(val_pred[1], val_depth))
+            val_metric.update(6, val_loss[2])
+            val_metric.update_normal(val_pred[2], val_normal)
+            val_metric.step()
 
         # compute mIoU and acc
-        avg_cost[index, 13], avg_cost[index, 14] = conf_mat.get_metrics()
+        avg_cost[index, 12:] = val_metric.summary()
     
     scheduler.step()
     e_t = time.time()
@@ -188,4 +199,6 @@ for index in range(total_epoch):
                 avg_cost[index, 9], avg_cost[index, 10], avg_cost[index, 11], avg_cost[index, 12], avg_cost[index, 13],
                 avg_cost[index, 14], avg_cost[index, 15], avg_cost[index, 16], avg_cost[index, 17], avg_cost[index, 18],
                 avg_cost[index, 19], avg_cost[index, 20], avg_cost[index, 21], avg_cost[index, 22], avg_cost[index, 23], e_t-s_t))
-    
+
+if params.export is not None and (params.model == 'SMTL' or params.model == 'SMTL_new'):
+    export_slim(model, params.export)
@@ -1,13 +1,19 @@
-import torch, time, os, random
+import torch, time, os, random, sys
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 import scipy.io as sio
 from backbone_bilevel import SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
 from utils import *
+from meta_utils import MetaStep
 
-from create_dataset import NYUv2
+from create_dataset import NYUv2, NYUv2Packed, BatchRandomScaleCrop
+from prefetcher import CUDAPrefetcher
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 
 import argparse
 
@@ -19,11 +25,17 @@ def parse_args():
     parser = argparse.ArgumentParser(description= 'SMTL on NYUv2')
     parser.add_argument('--gpu_id', default='0', help='gpu_id') 
     parser.add_argument('--model', default='SMTL', type=str, help='SMTL, SMTL_new')
-    parser.add_argument('--aug', type=str, default='False', help='data augmentation')
+    parser.add_argument('--aug', type=str, default='False', help='data augmentation: False, True (per sample in the loader), batch (per batch on the device)')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the memory-mapped arrays of pack_dataset.py')
     parser.add_argument('--train_mode', default='train', type=str, help='trainval, train')
     parser.add_argument('--total_epoch', default=200, type=int, help='training epoch')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
+    parser.add_argument('--hypergrad', default='second_order', type=str, 
+                        help='second_order, first_order, finite_difference')
+    parser.add_argument('--profile_hypergrad', action='store_true', default=False, 
+                        help='time the hypergradient steps and record their peak memory (synchronizes every step)')
     return parser.parse_args()
 
 
@@ -44,36 +56,39 @@ def build_model():
     else:
         print("No correct model parameter!")
         exit()
+    clear_pretrained_cache()
     return model, batch_size
 
 model, batch_size = build_model()
 
-nyuv2_train_set = NYUv2(root=dataset_path, mode=params.train_mode, augmentation=params.aug)
-nyuv2_val_set = NYUv2(root=dataset_path, mode='val', augmentation=params.aug)
-nyuv2_test_set = NYUv2(root=dataset_path, mode='test', augmentation='False')
+batch_aug = BatchRandomScaleCrop()
+dataset_class = NYUv2Packed if params.packed else NYUv2
+nyuv2_train_set = dataset_class(root=dataset_path, mode=params.train_mode, augmentation=params.aug)
+nyuv2_val_set = dataset_class(root=dataset_path, mode='val', augmentation=params.aug)
+nyuv2_test_set = dataset_class(root=dataset_path, mode='test', augmentation='False')
 
-nyuv2_train_loader = torch.utils.data.DataLoader(
+nyuv2_train_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_train_set,
     batch_size=batch_size,
     shuffle=True,
     num_workers=2,
     pin_memory=True,
-    drop_last=True)
+    drop_last=True))
     
-nyuv2_val_loader = torch.utils.data.DataLoader(
+nyuv2_val_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_val_set,
     batch_size=batch_size,
     shuffle=True,
     num_workers=2,
     pin_memory=True,
-    drop_last=True)
+    drop_last=True))
 
-nyuv2_test_loader = torch.utils.data.DataLoader(
+nyuv2_test_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_test_set,
     batch_size=batch_size,
     shuffle=False,
     num_workers=2,
-    pin_memory=True)
+    pin_memory=True))
 
 
 task_num = len(model.tasks)
@@ -108,22 +123,14 @@ h.train()
 h_optimizer = torch.optim.Adam(h.parameters(), lr=1e-4)
 
 
-def set_param(curr_mod, name, param=None, mode='update'):
-    if '.' in name:
-        n = name.split('.')
-        module_name = n[0]
-        rest = '.'.join(n[1:])
-        for name, mod in curr_mod.named_children():
-            if module_name == name:
-                return set_param(mod, rest, param, mode=mode)
-    else:
-        if mode == 'update':
-            delattr(curr_mod, name)
-            setattr(curr_mod, name, param)
-        elif mode == 'get':
-            if hasattr(curr_mod, name):
-                p = getattr(curr_mod, name)
-                return p
+# one-step unrolled model for the outer loop, evaluated functionally on the live model
+meta_step = MetaStep(model, lr=1e-4)
+
+def weighted_loss(pred, targets, weight):
+    loss = [model_fit(pred[0], targets[0], 'semantic'),
+            model_fit(pred[1], targets[1], 'depth'),
+            model_fit(pred[2], targets[2], 'normal')]
+    return torch.sum(torch.stack(loss)*weight)
 
 print('LOSS FORMAT: SEMANTIC_LOSS MEAN_IOU PIX_ACC | DEPTH_LOSS ABS_ERR REL_ERR | NORMAL_LOSS MEAN MED <11.25 <22.5 <30')
 total_epoch = params.total_epoch
@@ -134,60 +141,37 @@ lambda_weight = torch.ones([task_num, total_epoch]).cuda()
 for index in range(total_epoch):
     s_t = time.time()
     cost = torch.zeros(24)
+    train_normal_hist = AngularErrorHistogram()
     # iteration for all batches
     model.train()
     train_dataset = iter(nyuv2_train_loader)
     val_dataset = iter(nyuv2_val_loader)
     conf_mat = ConfMatrix(model.class_nb)
+    meta_time, meta_memory = 0, 0
     for k in range(min(train_batch, val_batch)):
-        meta_model, _ = build_model()
-        meta_model.load_state_dict(model.state_dict())
-        
-        model_np = {}
-        for n, p in meta_model.named_parameters():
-            model_np[n] = p
-        
         train_data, train_label, train_depth, train_normal = train_dataset.next()
-        train_data, train_label = train_data.cuda(non_blocking=True), train_label.long().cuda(non_blocking=True)
-        train_depth, train_normal = train_depth.cuda(non_blocking=True), train_normal.cuda(non_blocking=True)
-        train_pred = meta_model(train_data, h)
-        train_loss = [model_fit(train_pred[0], train_label, 'semantic'),
-                      model_fit(train_pred[1], train_depth, 'depth'),
-                      model_fit(train_pred[2], train_normal, 'normal')]
-        loss_train = torch.zeros(3).cuda()
-        for i in range(3):
-            loss_train[i] = train_loss[i]
-        loss_sum = torch.sum(loss_train*lambda_weight[:, index])
-        
-        meta_model.zero_grad()
-        grads = torch.autograd.grad(loss_sum, (meta_model.parameters()), create_graph=True)
-        
-        for g_index, name in enumerate(model_np.keys()):
-            p = set_param(meta_model, name, mode='get')
-            if grads[g_index] == None:
-                print(g_index, name, grads[g_index])
-                continue
-            p_fast = p - 1e-4 * grads[g_index]
-            set_param(meta_model, name, param=p_fast, mode='update')
-            model_np[name] = p_fast
-        del grads
-        del model_np
+        train_label = train_label.long()
+        if params.aug == 'batch':
+            train_data, train_label, train_depth, train_normal = batch_aug(train_data, train_label, train_depth, train_normal)
         
         # update outer loop
         val_data, val_label, val_depth, val_normal = val_dataset.next()
-        val_data, val_label = val_data.cuda(non_blocking=True), val_label.long().cuda(non_blocking=True)
-        val_depth, val_normal = val_depth.cuda(non_blocking=True), val_normal.cuda(non_blocking=True)
-        valid_pred = meta_model(val_data, h)
-        valid_loss = [model_fit(valid_pred[0], val_label, 'semantic'),
-                      model_fit(valid_pred[1], val_depth, 'depth'),
-                      model_fit(valid_pred[2], val_normal, 'normal')]
-        loss_val = torch.zeros(3).cuda()
-        for i in range(3):
-            loss_val[i] = valid_loss[i]
-        loss_all = torch.sum(loss_val*lambda_weight[:, index])
+        val_label = val_label.long()
+        if params.aug == 'batch':
+            val_data, val_label, val_depth, val_normal = batch_aug(val_data, val_label, val_depth, val_normal)
+        if params.profile_hypergrad:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            meta_s_t = time.time()
         h_optimizer.zero_grad()
-        loss_all.backward()
+        meta_step.hypergrad(h, lambda pred, targets: weighted_loss(pred, targets, lambda_weight[:, index]),
+                            (train_data, h), (train_label, train_depth, train_normal),
+                            (val_data, h), (val_label, val_depth, val_normal), mode=params.hypergrad)
         h_optimizer.step()
+        if params.profile_hypergrad:
+            torch.cuda.synchronize()
+            meta_time += time.time() - meta_s_t
+            meta_memory = max(meta_memory, torch.cuda.max_memory_allocated())
         
         # update inner loop
         train_pred = model(train_data, h)
@@ -209,22 +193,27 @@ for index in range(total_epoch):
         cost[3] = train_loss[1].item()
         cost[4], cost[5] = depth_error(train_pred[1], train_depth)
         cost[6] = train_loss[2].item()
-        cost[7], cost[8], cost[9], cost[10], cost[11] = normal_error(train_pred[2], train_normal)
+        train_normal_hist.update(*normal_angle(train_pred[2], train_normal))
         avg_cost[index, :12] += cost[:12] / train_batch
 
     # compute mIoU and acc
     avg_cost[index, 1], avg_cost[index, 2] = conf_mat.get_metrics()
+    avg_cost[index, 7:12] = normal_metrics(train_normal_hist)
+    if params.profile_hypergrad:
+        # peak of the allocated memory within the hypergradient steps (including what was live before them)
+        print('{} hypergradient: {:.4f}s per step, peak memory {:.1f}MB'.format(params.hypergrad,
+              meta_time / min(train_batch, val_batch), meta_memory / 1024**2))
 
     # evaluating test data
     model.eval()
     conf_mat = ConfMatrix(model.class_nb)
+    test_normal_hist = AngularErrorHistogram()
     with torch.no_grad():  # operations inside don't track history
         test_dataset = iter(nyuv2_test_loader)
         test_batch = len(nyuv2_test_loader)
         for k in range(test_batch):
             test_data, test_label, test_depth, test_normal = test_dataset.next()
-            test_data, test_label = test_data.cuda(non_blocking=True), test_label.long().cuda(non_blocking=True)
-            test_depth, test_normal = test_depth.cuda(non_blocking=True), test_normal.cuda(non_blocking=True)
+            test_label = test_label.long()
             test_pred = model.predict(test_data, h)
             test_loss = [model_fit(test_pred[0], test_label, 'semantic'),
                          model_fit(test_pred[1], test_depth, 'depth'),
@@ -236,11 +225,12 @@ for index in range(total_epoch):
             cost[15] = test_loss[1].item()
             cost[16], cost[17] = depth_error(test_pred[1], test_depth)
             cost[18] = test_loss[2].item()
-            cost[19], cost[20], cost[21], cost[22], cost[23] = normal_error(test_pred[2], test_normal)
+            test_normal_hist.update(*normal_angle(test_pred[2], test_normal))
             avg_cost[index, 12:] += cost[12:] / test_batch
 
         # compute mIoU and acc
         avg_cost[index, 13], avg_cost[index, 14] = conf_mat.get_metrics()
+        avg_cost[index, 19:24] = normal_metrics(test_normal_hist)
     
     scheduler.step()
     e_t = time.time()
@@ -266,4 +256,6 @@ for index in range(total_epoch):
                 avg_cost[index, 9], avg_cost[index, 10], avg_cost[index, 11], avg_cost[index, 12], avg_cost[index, 13],
                 avg_cost[index, 14], avg_cost[index, 15], avg_cost[index, 16], avg_cost[index, 17], avg_cost[index, 18],
                 avg_cost[index, 19], avg_cost[index, 20], avg_cost[index, 21], avg_cost[index, 22], avg_cost[index, 23], e_t-s_t))
-    
+
+if params.export is not None:
+    export_slim(model, params.export, h=h)
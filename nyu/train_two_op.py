@@ -5,9 +5,11 @@ import torch.optim as optim
 import numpy as np
 import scipy.io as sio
 from backbone_bilevel import SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
 from utils import *
 
 from create_dataset import NYUv2
+from prefetcher import CUDAPrefetcher
 
 import argparse
 
@@ -44,6 +46,7 @@ def build_model():
     else:
         print("No correct model parameter!")
         exit()
+    clear_pretrained_cache()
     return model, batch_size
 
 model, batch_size = build_model()
@@ -52,21 +55,21 @@ nyuv2_train_set = NYUv2(root=dataset_path, mode=params.train_mode, augmentation=
 nyuv2_val_set = NYUv2(root=dataset_path, mode='val', augmentation=params.aug)
 nyuv2_test_set = NYUv2(root=dataset_path, mode='test', augmentation='False')
 
-nyuv2_train_loader = torch.utils.data.DataLoader(
+nyuv2_train_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_train_set,
     batch_size=batch_size,
     shuffle=True,
     num_workers=2,
     pin_memory=True,
-    drop_last=True)
+    drop_last=True))
     
 
-nyuv2_test_loader = torch.utils.data.DataLoader(
+nyuv2_test_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_test_set,
     batch_size=batch_size,
     shuffle=False,
     num_workers=2,
-    pin_memory=True)
+    pin_memory=True))
 
 
 task_num = len(model.tasks)
@@ -109,14 +112,14 @@ lambda_weight = torch.ones([task_num, total_epoch]).cuda()
 for index in range(total_epoch):
     s_t = time.time()
     cost = torch.zeros(24)
+    train_normal_hist = AngularErrorHistogram()
     # iteration for all batches
     model.train()
     train_dataset = iter(nyuv2_train_loader)
     conf_mat = ConfMatrix(model.class_nb)
     for k in range(train_batch):
         train_data, train_label, train_depth, train_normal = train_dataset.next()
-        train_data, train_label = train_data.cuda(non_blocking=True), train_label.long().cuda(non_blocking=True)
-        train_depth, train_normal = train_depth.cuda(non_blocking=True), train_normal.cuda(non_blocking=True)
+        train_label = train_label.long()
 
         train_pred = model(train_data, h)
 
@@ -143,22 +146,23 @@ for index in range(total_epoch):
         cost[3] = train_loss[1].item()
         cost[4], cost[5] = depth_error(train_pred[1], train_depth)
         cost[6] = train_loss[2].item()
-        cost[7], cost[8], cost[9], cost[10], cost[11] = normal_error(train_pred[2], train_normal)
+        train_normal_hist.update(*normal_angle(train_pred[2], train_normal))
         avg_cost[index, :12] += cost[:12] / train_batch
 
     # compute mIoU and acc
     avg_cost[index, 1], avg_cost[index, 2] = conf_mat.get_metrics()
+    avg_cost[index, 7:12] = normal_metrics(train_normal_hist)
 
     # evaluating test data
     model.eval()
     conf_mat = ConfMatrix(model.class_nb)
+    test_normal_hist = AngularErrorHistogram()
     with torch.no_grad():  # operations inside don't track history
         test_dataset = iter(nyuv2_test_loader)
         test_batch = len(nyuv2_test_loader)
         for k in range(test_batch):
             test_data, test_label, test_depth, test_normal = test_dataset.next()
-            test_data, test_label = test_data.cuda(non_blocking=True), test_label.long().cuda(non_blocking=True)
-            test_depth, test_normal = test_depth.cuda(non_blocking=True), test_normal.cuda(non_blocking=True)
+            test_label = test_label.long()
             test_pred = model.predict(test_data, h)
             test_loss = [model_fit(test_pred[0], test_label, 'semantic'),
                          model_fit(test_pred[1], test_depth, 'depth'),
@@ -170,11 +174,12 @@ for index in range(total_epoch):
             cost[15] = test_loss[1].item()
             cost[16], cost[17] = depth_error(test_pred[1], test_depth)
             cost[18] = test_loss[2].item()
-            cost[19], cost[20], cost[21], cost[22], cost[23] = normal_error(test_pred[2], test_normal)
+            test_normal_hist.update(*normal_angle(test_pred[2], test_normal))
             avg_cost[index, 12:] += cost[12:] / test_batch
 
         # compute mIoU and acc
         avg_cost[index, 13], avg_cost[index, 14] = conf_mat.get_metrics()
+        avg_cost[index, 19:24] = normal_metrics(test_normal_hist)
     
     scheduler.step()
     e_t = time.time()
@@ -5,9 +5,11 @@ import torch.optim as optim
 import numpy as np
 import scipy.io as sio
 from backbone import SMTLmodel_weight
+from resnet import clear_pretrained_cache
 from utils import *
 
 from create_dataset import NYUv2
+from prefetcher import CUDAPrefetcher
 
 from weighting_utils import weight_update
 from min_norm_solvers import MinNormSolver, gradient_normalizers
@@ -53,22 +55,23 @@ dataset_path = '/data/dataset/nyuv2/'
 nyuv2_train_set = NYUv2(root=dataset_path, mode=params.train_mode, augmentation=params.aug)
 nyuv2_test_set = NYUv2(root=dataset_path, mode='test', augmentation=False)
 
-nyuv2_test_loader = torch.utils.data.DataLoader(
+nyuv2_test_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_test_set,
     batch_size=batch_size,
     shuffle=False,
     num_workers=2,
-    pin_memory=True)
+    pin_memory=True))
 
-nyuv2_train_loader = torch.utils.data.DataLoader(
+nyuv2_train_loader = CUDAPrefetcher(torch.utils.data.DataLoader(
     dataset=nyuv2_train_set,
     batch_size=batch_size,
     shuffle=True,
     num_workers=2,
     pin_memory=True,
-    drop_last=True)
+    drop_last=True))
 
 model = SMTLmodel_weight(version=params.version, weighting=params.weighting).cuda()
+clear_pretrained_cache()
 task_num = len(model.tasks)
 scheduler = None
 init_loss = None
@@ -88,6 +91,7 @@ lambda_weight = torch.ones([task_num, total_epoch, train_batch]).cuda()
 for epoch in range(total_epoch):
     s_t = time.time()
     cost = torch.zeros(24)
+    train_normal_hist = AngularErrorHistogram()
 
     # iteration for all batches
     model.train()
@@ -97,8 +101,7 @@ for epoch in range(total_epoch):
 #         if batch_index > 1:
 #             break
         train_data, train_label, train_depth, train_normal = train_dataset.next()
-        train_data, train_label = train_data.cuda(non_blocking=True), train_label.long().cuda(non_blocking=True)
-        train_depth, train_normal = train_depth.cuda(non_blocking=True), train_normal.cuda(non_blocking=True)
+        train_label = train_label.long()
         
         train_pred = model.forward(train_data)
 
@@ -123,22 +126,23 @@ for epoch in range(total_epoch):
         cost[3] = train_loss[1].item()
         cost[4], cost[5] = depth_error(train_pred[1], train_depth)
         cost[6] = train_loss[2].item()
-        cost[7], cost[8], cost[9], cost[10], cost[11] = normal_error(train_pred[2], train_normal)
+        train_normal_hist.update(*normal_angle(train_pred[2], train_normal))
         avg_cost[epoch, :12] += cost[:12] / train_batch
 
     # compute mIoU and acc
     avg_cost[epoch, 1], avg_cost[epoch, 2] = conf_mat.get_metrics()
+    avg_cost[epoch, 7:12] = normal_metrics(train_normal_hist)
 
     # evaluating test data
     model.eval()
     conf_mat = ConfMatrix(model.class_nb)
+    test_normal_hist = AngularErrorHistogram()
     with torch.no_grad():  # operations inside don't track history
         val_dataset = iter(nyuv2_test_loader)
         val_batch = len(nyuv2_test_loader)
         for k in range(val_batch):
             val_data, val_label, val_depth, val_normal = val_dataset.next()
-            val_data, val_label = val_data.cuda(non_blocking=True), val_label.long().cuda(non_blocking=True)
-            val_depth, val_normal = val_depth.cuda(non_blocking=True), val_normal.cuda(non_blocking=True)
+            val_label = val_label.long()
 
             val_pred = model(val_data)
             val_loss = [model_fit(val_pred[0], val_label, 'semantic'),
@@ -151,11 +155,12 @@ for epoch in range(total_epoch):
             cost[15] = val_loss[1].item()
             cost[16], cost[17] = depth_error(val_pred[1], val_depth)
             cost[18] = val_loss[2].item()
-            cost[19], cost[20], cost[21], cost[22], cost[23] = normal_error(val_pred[2], val_normal)
+            test_normal_hist.update(*normal_angle(val_pred[2], val_normal))
             avg_cost[epoch, 12:] += cost[12:] / val_batch
 
         # compute mIoU and acc
         avg_cost[epoch, 13], avg_cost[epoch, 14] = conf_mat.get_metrics()
+        avg_cost[epoch, 19:24] = normal_metrics(test_normal_hist)
     
     scheduler.step()
     e_t = time.time()
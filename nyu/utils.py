@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from masked_losses import masked_l1_loss, masked_cosine_loss, masked_cross_entropy
+from angular_error import AngularErrorHistogram
 
 def model_fit(x_pred, x_output, task_type):
     device = x_pred.device
@@ -10,15 +11,15 @@ def model_fit(x_pred, x_output, task_type):
 
     if task_type == 'semantic':
         # semantic loss: depth-wise cross entropy
-        loss = F.nll_loss(x_pred, x_output, ignore_index=-1)
+        loss = masked_cross_entropy(x_pred, x_output, ignore_index=-1, log_probs=True)
 
     if task_type == 'depth':
         # depth loss: l1 norm
-        loss = torch.sum(torch.abs(x_pred - x_output) * binary_mask) / torch.nonzero(binary_mask, as_tuple=False).size(0)
+        loss = masked_l1_loss(x_pred, x_output, binary_mask)
 
     if task_type == 'normal':
         # normal loss: dot product
-        loss = 1 - torch.sum((x_pred * x_output) * binary_mask) / torch.nonzero(binary_mask, as_tuple=False).size(0)
+        loss = masked_cosine_loss(x_pred, x_output, binary_mask)
 
     return loss
 
@@ -32,41 +33,97 @@ class ConfMatrix(object):
             n = self.num_classes
             if self.mat is None:
                 self.mat = torch.zeros((n, n), dtype=torch.int64, device=pred.device)
-            with torch.no_grad():
-                k = (target >= 0) & (target < n)
-                inds = n * target[k].to(torch.int64) + pred[k]
-                self.mat += torch.bincount(inds, minlength=n ** 2).reshape(n, n)
+            k = (target >= 0) & (target < n)
+            # ignored pixels are counted in an extra bin instead of being selected out, and the counts are
+            # scattered into a fixed-size buffer: neither boolean indexing nor bincount waits on the host
+            inds = torch.where(k, n * target.to(torch.int64) + pred, torch.full_like(pred, n ** 2))
+            counts = torch.zeros(n ** 2 + 1, dtype=torch.int64, device=pred.device)
+            counts.scatter_add_(0, inds, torch.ones_like(inds))
+            self.mat += counts[:n ** 2].reshape(n, n)
 
-    def get_metrics(self):
+    def get_metrics_tensor(self):
         with torch.no_grad():
             h = self.mat.float()
             acc = torch.diag(h).sum() / h.sum()
             iu = torch.diag(h) / (h.sum(1) + h.sum(0) - torch.diag(h))
-            return torch.mean(iu).item(), acc.item()
+            return torch.stack([torch.mean(iu), acc])
 
+    def get_metrics(self):
+        miou, acc = self.get_metrics_tensor().tolist()
+        return miou, acc
 
-def depth_error(x_pred, x_output):
+
+def depth_error_tensor(x_pred, x_output):
+    # [abs_err, rel_err] over the valid pixels, left on the device
     with torch.no_grad():
-        device = x_pred.device
-        binary_mask = (torch.sum(x_output, dim=1) != 0).unsqueeze(1).to(device)
-        x_pred_true = x_pred.masked_select(binary_mask)
-        x_output_true = x_output.masked_select(binary_mask)
-        abs_err = torch.abs(x_pred_true - x_output_true)
-        rel_err = torch.abs(x_pred_true - x_output_true) / x_output_true
-        return (torch.sum(abs_err) / torch.nonzero(binary_mask, as_tuple=False).size(0)).item(), \
-               (torch.sum(rel_err) / torch.nonzero(binary_mask, as_tuple=False).size(0)).item()
+        binary_mask = (torch.sum(x_output, dim=1) != 0).unsqueeze(1)
+        num = binary_mask.sum().float()
+        abs_err = torch.abs(x_pred - x_output).masked_fill(~binary_mask, 0)
+        rel_err = abs_err / x_output.masked_fill(~binary_mask, 1)
+        return torch.stack([abs_err.sum(), rel_err.sum()]) / num
+
+
+def depth_error(x_pred, x_output):
+    abs_err, rel_err = depth_error_tensor(x_pred, x_output).tolist()
+    return abs_err, rel_err
 
 
-def normal_error(x_pred, x_output):
+def normal_angle(x_pred, x_output):
+    # per-pixel angular error in degrees and the mask of pixels with a ground-truth normal
     with torch.no_grad():
         binary_mask = (torch.sum(x_output, dim=1) != 0)
-        error = torch.acos(torch.clamp(torch.sum(x_pred * x_output, 1).masked_select(binary_mask), -1, 1))#.detach().cpu().numpy()
-    #     error = np.degrees(error)
-        error = torch.rad2deg(error)
-        return torch.mean(error).item(), torch.median(error).item(), \
-               torch.mean((error < 11.25)*1.0).item(), torch.mean((error < 22.5)*1.0).item(), \
-               torch.mean((error < 30)*1.0).item()
-    
+        error = torch.rad2deg(torch.acos(torch.clamp(torch.sum(x_pred * x_output, 1), -1, 1)))
+        return error, binary_mask
+
+
+def normal_metrics(hist):
+    # [mean, median, <11.25, <22.5, <30] of an AngularErrorHistogram, in the order of the cost slots
+    normal = hist.get_metrics()
+    return torch.tensor([normal['mean'], normal['median'], normal['11.25'], normal['22.5'], normal['30']])
+
+
+class MetricAccumulator(object):
+    """
+    Running per-batch averages of one epoch, kept on the device.
+    update() adds the losses/errors of a batch into fixed slots of a device vector and the label
+    predictions into a ConfMatrix; nothing is copied to the host until summary() is called.
+    With normal_slot, update_normal() streams the angular errors of all pixels into a histogram and
+    summary() writes [mean, median, <11.25, <22.5, <30] over the whole epoch from normal_slot on.
+    """
+    def __init__(self, num_slots, class_nb, conf_slots=(1, 2), normal_slot=None, device='cuda'):
+        self.sum = torch.zeros(num_slots, device=device)
+        self.conf_mat = ConfMatrix(class_nb)
+        self.conf_slots = list(conf_slots)
+        self.normal_slot = normal_slot
+        self.normal_hist = AngularErrorHistogram()
+        self.num_batches = 0
+
+    def update(self, slot, value):
+        # value: a loss or a vector of errors, written to slot, slot + 1, ...
+        value = value.detach().reshape(-1)
+        self.sum[slot:slot + value.numel()] += value
+
+    def update_conf(self, pred, target):
+        self.conf_mat.update(pred, target)
+
+    def update_normal(self, pred, target):
+        self.normal_hist.update(*normal_angle(pred, target))
+
+    def step(self):
+        self.num_batches += 1
+
+    def summary(self):
+        # the single host synchronization of the epoch
+        with torch.no_grad():
+            avg = self.sum / max(self.num_batches, 1)
+            if self.conf_mat.mat is not None:
+                avg[self.conf_slots] = self.conf_mat.get_metrics_tensor()
+            avg = avg.cpu()
+            if self.normal_slot is not None:
+                avg[self.normal_slot:self.normal_slot + 5] = normal_metrics(self.normal_hist)
+            return avg
+
+
 def set_param(curr_mod, name, param=None, mode='update'):
     if '.' in name:
         n = name.split('.')
@@ -4,6 +4,59 @@ import torch.nn.functional as F
 import resnet
 
 
+def domain_index(sizes, device):
+    # task index of every sample of the domain batches of the given sizes, concatenated in task order
+    return torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes)).to(device, non_blocking=True)
+
+
+def route(features, classifier_parameter, task_ids):
+    # all the task classifiers in one batched matmul (task_num x N x class_num), each sample keeps its own task's row
+    outputs = torch.matmul(features, classifier_parameter)
+    return outputs[task_ids, torch.arange(features.size(0), device=features.device)]
+
+
+class SMTLGate(object):
+    """
+    The gate and the multi-domain features shared by SMTL and SMTL_new (version, alpha, avgpool and the
+    shared / task-specific base networks and hidden layers are set by their constructors).
+    """
+    def get_train_gate(self, task_index=None):
+        # (shared, specific) weights as drawn in training, of one task or (task_num x 2) of all the tasks;
+        # one gumbel sample per task for SMTL-v3
+        alpha = self.alpha if task_index is None else self.alpha[task_index]
+        if self.version == 'v1':
+            return F.softmax(alpha, -1)     # SMTL-v1,  alpha_1 + alpha_2 = 1
+        elif self.version == 'v2':
+            return torch.exp(alpha) / (1 + torch.exp(alpha)) # SMTL-v2,  0 <= alpha <=1
+        elif self.version == 'v3':
+            # SMTL-v3, gumbel softmax
+            temp = torch.sigmoid(alpha)
+            temp_alpha = torch.stack([1-temp, temp], -1)
+            return F.gumbel_softmax(torch.log(temp_alpha), tau=0.1, hard=True)
+        else:
+            print("No correct version parameter!")
+            exit()
+
+    def get_gate(self):
+        # (shared, specific) weights of every task at inference, hard 0/1 decisions for SMTL-v3
+        if self.version == 'v3':
+            # SMTL-v3, converged decision of the gumbel softmax gate
+            return [[0, 1] if torch.sigmoid(a) >= 0.5 else [1, 0] for a in self.alpha]
+        # SMTL-v1 and v2 are deterministic, the weights drawn in training
+        return list(self.get_train_gate())
+
+    def features_multi(self, inputs):
+        # hidden features of the shared network on the concatenated batches and of each task network on its own batch
+        features_s = self.base_network_s(torch.cat(inputs))
+        features_s = torch.flatten(self.avgpool(features_s), 1)
+        hidden_features_s = self.hidden_layer_s(features_s)
+        hidden_features_t = []
+        for t, x in enumerate(inputs):
+            features_t = torch.flatten(self.avgpool(self.base_network_t[t](x)), 1)
+            hidden_features_t.append(self.hidden_layer_t[t](features_t))
+        return hidden_features_s, torch.cat(hidden_features_t)
+
+
 class DMTL(nn.Module):
     def __init__(self, task_num, base_net='resnet50', hidden_dim=1024, class_num=31):
         super(DMTL, self).__init__()
@@ -29,6 +82,18 @@ class DMTL(nn.Module):
         outputs = torch.mm(hidden_features, self.classifier_parameter[task_index])
         return outputs
 
+    def forward_multi(self, inputs):
+        """
+        inputs: the batches of all the tasks (domains), in task order
+        They are concatenated and go through the shared network once, the logits of the concatenated
+        batch are returned. In training mode the BatchNorm statistics are those of all the domains together.
+        """
+        task_ids = domain_index([x.size(0) for x in inputs], inputs[0].device)
+        features = self.base_network(torch.cat(inputs))
+        features = torch.flatten(self.avgpool(features), 1)
+        hidden_features = self.hidden_layer(features)
+        return route(hidden_features, self.classifier_parameter, task_ids)
+
     def predict(self, inputs, task_index):
         return self.forward(inputs, task_index)
         
@@ -231,14 +296,17 @@ class AdaShare(nn.Module):
         return outputs
         
 
-class SMTL(nn.Module):
-    def __init__(self, task_num, base_net='resnet50', hidden_dim=1024, class_num=31, version='v1'):
+class SMTL(SMTLGate, nn.Module):
+    def __init__(self, task_num, base_net='resnet50', hidden_dim=1024, class_num=31, version='v1', pruned=()):
         super(SMTL, self).__init__()
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared base network
-        self.base_network_s = resnet.__dict__[base_net](pretrained=True)
+        self.base_network_s = None if 'base_network_s.' in pruned else resnet.__dict__[base_net](pretrained=True)
         # task-specific base network
-        self.base_network_t = nn.ModuleList([resnet.__dict__[base_net](pretrained=True) for _ in range(task_num)])
-        self.avgpool = self.base_network_s.avgpool
+        self.base_network_t = nn.ModuleList([None if 'base_network_t.{}.'.format(i) in pruned else resnet.__dict__[base_net](pretrained=True)
+                                             for i in range(task_num)])
+        # the pooling of the resnets (parameter free), kept when the shared base network is pruned
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         # shared hidden layer
         self.hidden_layer_list_s = [nn.Linear(2048, hidden_dim),nn.BatchNorm1d(hidden_dim), nn.ReLU(), nn.Dropout(0.5)]
         self.hidden_layer_s = nn.Sequential(*self.hidden_layer_list_s)
@@ -282,49 +350,43 @@ class SMTL(nn.Module):
         features_t = torch.flatten(self.avgpool(features_t), 1)
         hidden_features_t = self.hidden_layer_t[task_index](features_t)
         
-        if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
-        elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
-        elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            temp_alpha = torch.stack([1-temp, temp])
-            temp_alpha = F.gumbel_softmax(torch.log(temp_alpha), tau=0.1, hard=True)
-        else:
-            print("No correct version parameter!")
-            exit()
+        temp_alpha = self.get_train_gate(task_index)
 
         hidden_features = temp_alpha[0] * hidden_features_s + temp_alpha[1] * hidden_features_t
         
         outputs = torch.mm(hidden_features, self.classifier_parameter[task_index])
         return outputs
     
+    def forward_multi(self, inputs):
+        """
+        inputs: the batches of all the tasks (domains), in task order
+        The shared network runs once on the concatenated batches, the logits of the concatenated batch are
+        returned. In training mode the BatchNorm statistics of the shared network are those of all the domains.
+        """
+        task_ids = domain_index([x.size(0) for x in inputs], inputs[0].device)
+        hidden_features_s, hidden_features_t = self.features_multi(inputs)
+        temp_alpha = self.get_train_gate()[task_ids]
+        hidden_features = temp_alpha[:, :1] * hidden_features_s + temp_alpha[:, 1:] * hidden_features_t
+        return route(hidden_features, self.classifier_parameter, task_ids)
+    
     def predict(self, inputs, task_index):
-        features_s = self.base_network_s(inputs)
-        features_s = torch.flatten(self.avgpool(features_s), 1)
-        hidden_features_s = self.hidden_layer_s(features_s)
-        
-        features_t = self.base_network_t[task_index](inputs)
-        features_t = torch.flatten(self.avgpool(features_t), 1)
-        hidden_features_t = self.hidden_layer_t[task_index](features_t)
-        
-        if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
-        elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
-        elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            if temp >= 0.5:
-                temp_alpha = [0, 1]
-            else:
-                temp_alpha = [1, 0]
+        # with the hard SMTL-v3 gate only the selected base network is run
+        temp_alpha = self.get_gate()[task_index]
+        hard = self.version == 'v3'
+        if not hard or temp_alpha[0]:
+            features_s = self.base_network_s(inputs)
+            features_s = torch.flatten(self.avgpool(features_s), 1)
+            hidden_features_s = self.hidden_layer_s(features_s)
+        
+        if not hard or temp_alpha[1]:
+            features_t = self.base_network_t[task_index](inputs)
+            features_t = torch.flatten(self.avgpool(features_t), 1)
+            hidden_features_t = self.hidden_layer_t[task_index](features_t)
+        
+        if hard:
+            hidden_features = hidden_features_t if temp_alpha[1] else hidden_features_s
         else:
-            print("No correct version parameter!")
-            exit()
-
-        hidden_features = temp_alpha[0] * hidden_features_s + temp_alpha[1] * hidden_features_t
+            hidden_features = temp_alpha[0] * hidden_features_s + temp_alpha[1] * hidden_features_t
         
         outputs = torch.mm(hidden_features, self.classifier_parameter[task_index])
         return outputs
@@ -333,14 +395,17 @@ class SMTL(nn.Module):
         return self.alpha
         
 
-class SMTL_new(nn.Module):
-    def __init__(self, task_num, base_net='resnet50', hidden_dim=1024, class_num=31, version='v1'):
+class SMTL_new(SMTLGate, nn.Module):
+    def __init__(self, task_num, base_net='resnet50', hidden_dim=1024, class_num=31, version='v1', pruned=()):
         super(SMTL_new, self).__init__()
+        # the encoders listed in pruned (state_dict prefixes of a slim checkpoint) are not built
         # shared base network
-        self.base_network_s = resnet.__dict__[base_net](pretrained=True)
+        self.base_network_s = None if 'base_network_s.' in pruned else resnet.__dict__[base_net](pretrained=True)
         # task-specific base network
-        self.base_network_t = nn.ModuleList([resnet.__dict__[base_net](pretrained=True) for _ in range(task_num)])
-        self.avgpool = self.base_network_s.avgpool
+        self.base_network_t = nn.ModuleList([None if 'base_network_t.{}.'.format(i) in pruned else resnet.__dict__[base_net](pretrained=True)
+                                             for i in range(task_num)])
+        # the pooling of the resnets (parameter free), kept when the shared base network is pruned
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         # shared hidden layer
         self.hidden_layer_list_s = [nn.Linear(2048, hidden_dim),nn.BatchNorm1d(hidden_dim), nn.ReLU(), nn.Dropout(0.5)]
         self.hidden_layer_s = nn.Sequential(*self.hidden_layer_list_s)
@@ -389,50 +454,45 @@ class SMTL_new(nn.Module):
         hidden_features_t = self.hidden_layer_t[task_index](features_t)
         outputs_t = torch.mm(hidden_features_t, self.classifier_parameter_t[task_index])
         
-        if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
-        elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
-        elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            temp_alpha = torch.stack([1-temp, temp])
-            temp_alpha = F.gumbel_softmax(torch.log(temp_alpha), tau=0.1, hard=True)
-        else:
-            print("No correct version parameter!")
-            exit()
+        temp_alpha = self.get_train_gate(task_index)
 
         outputs = temp_alpha[0] * outputs_s + temp_alpha[1] * outputs_t
         
         return outputs
     
+    def forward_multi(self, inputs):
+        """
+        inputs: the batches of all the tasks (domains), in task order
+        The shared network runs once on the concatenated batches, the logits of the concatenated batch are
+        returned. In training mode the BatchNorm statistics of the shared network are those of all the domains.
+        """
+        task_ids = domain_index([x.size(0) for x in inputs], inputs[0].device)
+        hidden_features_s, hidden_features_t = self.features_multi(inputs)
+        outputs_s = route(hidden_features_s, self.classifier_parameter_s, task_ids)
+        outputs_t = route(hidden_features_t, self.classifier_parameter_t, task_ids)
+        temp_alpha = self.get_train_gate()[task_ids]
+        return temp_alpha[:, :1] * outputs_s + temp_alpha[:, 1:] * outputs_t
+    
     def predict(self, inputs, task_index):
-        features_s = self.base_network_s(inputs)
-        features_s = torch.flatten(self.avgpool(features_s), 1)
-        hidden_features_s = self.hidden_layer_s(features_s)
-        outputs_s = torch.mm(hidden_features_s, self.classifier_parameter_s[task_index])
-        
-        features_t = self.base_network_t[task_index](inputs)
-        features_t = torch.flatten(self.avgpool(features_t), 1)
-        hidden_features_t = self.hidden_layer_t[task_index](features_t)
-        outputs_t = torch.mm(hidden_features_t, self.classifier_parameter_t[task_index])
-        
-        if self.version == 'v1':
-            temp_alpha = F.softmax(self.alpha[task_index], 0)     # SMTL-v1,  alpha_1 + alpha_2 = 1
-        elif self.version == 'v2':
-            temp_alpha = torch.exp(self.alpha[task_index]) / (1 + torch.exp(self.alpha[task_index])) # SMTL-v2,  0 <= alpha <=1
-        elif self.version == 'v3':
-            # below for SMTL-v3, gumbel softmax
-            temp = torch.sigmoid(self.alpha[task_index])
-            if temp >= 0.5:
-                temp_alpha = [0, 1]
-            else:
-                temp_alpha = [1, 0]
+        # with the hard SMTL-v3 gate only the selected base network is run
+        temp_alpha = self.get_gate()[task_index]
+        hard = self.version == 'v3'
+        if not hard or temp_alpha[0]:
+            features_s = self.base_network_s(inputs)
+            features_s = torch.flatten(self.avgpool(features_s), 1)
+            hidden_features_s = self.hidden_layer_s(features_s)
+            outputs_s = torch.mm(hidden_features_s, self.classifier_parameter_s[task_index])
+        
+        if not hard or temp_alpha[1]:
+            features_t = self.base_network_t[task_index](inputs)
+            features_t = torch.flatten(self.avgpool(features_t), 1)
+            hidden_features_t = self.hidden_layer_t[task_index](features_t)
+            outputs_t = torch.mm(hidden_features_t, self.classifier_parameter_t[task_index])
+        
+        if hard:
+            outputs = outputs_t if temp_alpha[1] else outputs_s
         else:
-            print("No correct version parameter!")
-            exit()
-
-        outputs = temp_alpha[0] * outputs_s + temp_alpha[1] * outputs_t
+            outputs = temp_alpha[0] * outputs_s + temp_alpha[1] * outputs_t
         
         return outputs
         
@@ -1,5 +1,6 @@
 from torch.utils.data import DataLoader, Dataset
 import os
+import json
 import torch
 import torch.nn.functional as F
 import fnmatch
@@ -7,14 +8,17 @@ import numpy as np
 import random
 import torchvision.transforms as transforms
 from PIL import Image
+from prefetcher import CUDAPrefetcher, Normalize
+
+# applied by the prefetcher on the device, the loaders return uint8 images (4x smaller copies)
+IMG_NORMALIZE = Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], key=0, scale=255)
 
 
 class office_Dataset(Dataset):
     def __init__(self, dataset, task, mode):
         self.transform = transforms.Compose([
                         transforms.Resize((224, 224)),
-                        transforms.ToTensor(),
-                        transforms.Normalize(mean=[0.485, 0.456, 0.406],std=[0.229, 0.224, 0.225]),
+                        transforms.PILToTensor(),
                         ])
         if mode != 'trval':
             f = open('./data_txt/{}/{}_{}.txt'.format(dataset, task, mode), 'r')
@@ -26,25 +30,67 @@ class office_Dataset(Dataset):
             self.img_list = f1.readlines() + f2.readlines()
             f1.close()
             f2.close()
-        if dataset == 'office-31':
-            self.root_path = '/data/dataset/office31/'
-        elif dataset == 'office-home':
-            self.root_path = '/data/dataset/office_home/'
-        
-    def __getitem__(self, i):
+        self.root_path = office_root(dataset)
+
+    def _item(self, i):
         img_path = self.img_list[i][:-1].split(' ')[0]
         y = int(self.img_list[i][:-1].split(' ')[1])
+        return img_path, y
+        
+    def __getitem__(self, i):
+        img_path, y = self._item(i)
         img = Image.open(self.root_path + img_path).convert('RGB')
         return self.transform(img), y
         
     def __len__(self):
         return len(self.img_list)
-    
-def office_dataloader(dataset, batchsize):
+
+
+class office_DatasetPacked(office_Dataset):
+    """
+    office_Dataset reading the images decoded and resized once by pack_dataset.py: packed_root/images.npy
+    holds every image of the dataset (all domains, all modes) as a uint8 3x224x224 row, the same tensor
+    as the per-file transform, and index.json maps the image paths to their rows.
+    """
+    def __init__(self, dataset, task, mode, packed_root=None):
+        super(office_DatasetPacked, self).__init__(dataset, task, mode)
+        self.packed_root = os.path.expanduser(packed_root or os.path.join(self.root_path, 'packed'))
+        with open(os.path.join(self.packed_root, 'index.json')) as f:
+            rows = {path: row for row, path in enumerate(json.load(f)['paths'])}
+        missing = [self._item(i)[0] for i in range(len(self)) if self._item(i)[0] not in rows]
+        assert not missing, '{} images of {} {} are not packed, re-run pack_dataset.py'.format(len(missing), task, mode)
+        self.rows = [rows[self._item(i)[0]] for i in range(len(self))]
+        # mapped on first access, so every DataLoader worker opens its own mapping
+        self.images = None
+
+    def __getitem__(self, i):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.packed_root, 'images.npy'), mmap_mode='r')
+        return torch.from_numpy(np.array(self.images[self.rows[i]])), self._item(i)[1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+
+def office_root(dataset):
     if dataset == 'office-31':
-        tasks = ['amazon', 'dslr', 'webcam']
+        return '/data/dataset/office31/'
     elif dataset == 'office-home':
-        tasks = ['Art', 'Clipart', 'Product', 'Real_World']
+        return '/data/dataset/office_home/'
+
+
+def office_tasks(dataset):
+    if dataset == 'office-31':
+        return ['amazon', 'dslr', 'webcam']
+    elif dataset == 'office-home':
+        return ['Art', 'Clipart', 'Product', 'Real_World']
+
+    
+def office_dataloader(dataset, batchsize, packed=False, num_workers=4):
+    tasks = office_tasks(dataset)
+    dataset_class = office_DatasetPacked if packed else office_Dataset
     data_loader = {}
     iter_data_loader = {}
     for k, d in enumerate(tasks):
@@ -53,23 +99,22 @@ def office_dataloader(dataset, batchsize):
         for mode in ['train', 'val', 'test', 'trval']:
             shuffle = False if mode == 'test' else True
             drop_last = False if mode == 'test' else True
-            txt_dataset = office_Dataset(dataset, d, mode)
+            txt_dataset = dataset_class(dataset, d, mode)
             print(d, mode, len(txt_dataset))
-            data_loader[k][mode] = DataLoader(txt_dataset, 
-                                              num_workers=0, 
-                                              pin_memory=True, 
-                                              batch_size=batchsize, 
-                                              shuffle=shuffle,
-                                              drop_last=drop_last)
+            data_loader[k][mode] = CUDAPrefetcher(DataLoader(txt_dataset, 
+                                                             num_workers=num_workers, 
+                                                             pin_memory=True, 
+                                                             batch_size=batchsize, 
+                                                             shuffle=shuffle,
+                                                             drop_last=drop_last),
+                                                  transform=IMG_NORMALIZE)
             iter_data_loader[k][mode] = iter(data_loader[k][mode])
     return data_loader, iter_data_loader
     
 
-def office_dataloader_other(dataset, batchsize):
-    if dataset == 'office-31':
-        tasks = ['amazon', 'dslr', 'webcam']
-    elif dataset == 'office-home':
-        tasks = ['Art', 'Clipart', 'Product', 'Real_World']
+def office_dataloader_other(dataset, batchsize, packed=False, num_workers=4):
+    tasks = office_tasks(dataset)
+    dataset_class = office_DatasetPacked if packed else office_Dataset
     data_loader = {}
     iter_data_loader = {}
     for k, d in enumerate(tasks):
@@ -79,13 +124,14 @@ def office_dataloader_other(dataset, batchsize):
             shuffle = False if mode == 'test' else True
             # drop_last = False if mode == 'test' else True
             drop_last = True
-            txt_dataset = office_Dataset(dataset, d, mode)
+            txt_dataset = dataset_class(dataset, d, mode)
             print(d, mode, len(txt_dataset))
-            data_loader[k][mode] = DataLoader(txt_dataset, 
-                                              num_workers=0, 
-                                              pin_memory=True, 
-                                              batch_size=batchsize, 
-                                              shuffle=shuffle,
-                                              drop_last=drop_last)
+            data_loader[k][mode] = CUDAPrefetcher(DataLoader(txt_dataset, 
+                                                             num_workers=num_workers, 
+                                                             pin_memory=True, 
+                                                             batch_size=batchsize, 
+                                                             shuffle=shuffle,
+                                                             drop_last=drop_last),
+                                                  transform=IMG_NORMALIZE)
             iter_data_loader[k][mode] = iter(data_loader[k][mode])
     return data_loader, iter_data_loader
\ No newline at end of file
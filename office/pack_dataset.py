@@ -0,0 +1,110 @@
+import os, time, json, hashlib
+import numpy as np
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from create_dataset import office_Dataset, office_DatasetPacked, office_root, office_tasks
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Decode and resize the office images once into a uint8 array')
+    parser.add_argument('--dataset', default='office-31', type=str, help='office-31, office-home')
+    parser.add_argument('--packed_root', default=None, type=str, help='output directory, default <dataset root>/packed')
+    parser.add_argument('--force', action='store_true', default=False, help='re-pack even if the cache is up to date')
+    parser.add_argument('--num_workers', default=8, type=int, help='decoding workers')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare the packed and per-file loaders')
+    parser.add_argument('--batch_size', default=32, type=int, help='batch size of the benchmark')
+    parser.add_argument('--num_batches', default=50, type=int, help='batches read per loader in the benchmark')
+    return parser.parse_args()
+
+
+class SourceImages(Dataset):
+    # the images of all domains and modes, decoded with the transform of office_Dataset
+    def __init__(self, root_path, paths, transform):
+        self.root_path = root_path
+        self.paths = paths
+        self.transform = transform
+
+    def __getitem__(self, i):
+        return self.transform(Image.open(self.root_path + self.paths[i]).convert('RGB'))
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def source_paths(dataset):
+    # every image listed by the split files, once, in a fixed order ('trval' is train + val)
+    paths = set()
+    for task in office_tasks(dataset):
+        for mode in ['train', 'val', 'test']:
+            db = office_Dataset(dataset, task, mode)
+            paths.update(db._item(i)[0] for i in range(len(db)))
+    return sorted(paths)
+
+
+def source_manifest(root_path, paths):
+    # checksum of the name, size and mtime of every source image
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(root_path + path)
+        h.update('{} {} {}\n'.format(path, st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def pack(dataset, packed_root, num_workers, force=False):
+    root_path = office_root(dataset)
+    paths = source_paths(dataset)
+    manifest = source_manifest(root_path, paths)
+    index_file = os.path.join(packed_root, 'index.json')
+    if not force and os.path.isfile(index_file):
+        with open(index_file) as f:
+            if json.load(f)['manifest'] == manifest:
+                print('{} is up to date'.format(packed_root))
+                return
+    os.makedirs(packed_root, exist_ok=True)
+    # images.npy is rewritten in place, the old index must not point into a half-written array
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    s_t = time.time()
+    source = SourceImages(root_path, paths, office_Dataset(dataset, office_tasks(dataset)[0], 'test').transform)
+    out = np.lib.format.open_memmap(os.path.join(packed_root, 'images.npy'), mode='w+', dtype=np.uint8,
+                                    shape=(len(paths), 3, 224, 224))
+    row = 0
+    for images in DataLoader(source, batch_size=64, shuffle=False, num_workers=num_workers):
+        out[row:row + len(images)] = images.numpy()
+        row += len(images)
+    out.flush()
+    del out
+    # index.json is written last and removed before the rewrite, so an interrupted conversion is never picked up
+    with open(index_file, 'w') as f:
+        json.dump({'paths': paths, 'manifest': manifest}, f)
+    print('packed {}: {} images in {:.1f}s'.format(dataset, len(paths), time.time()-s_t))
+
+
+def benchmark(dataset, batch_size, num_workers, num_batches):
+    loader = DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True)
+    num_samples = 0
+    s_t = time.time()
+    for k, batch in enumerate(loader):
+        num_samples += batch[0].size(0)
+        if k + 1 == num_batches:
+            break
+    return num_samples / (time.time() - s_t)
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    packed_root = params.packed_root or os.path.join(office_root(params.dataset), 'packed')
+    pack(params.dataset, packed_root, params.num_workers, force=params.force)
+    if params.benchmark:
+        task = office_tasks(params.dataset)[0]
+        for name, dataset in [('per-file', office_Dataset(params.dataset, task, 'trval')),
+                              ('packed', office_DatasetPacked(params.dataset, task, 'trval', packed_root=packed_root))]:
+            speed = benchmark(dataset, params.batch_size, params.num_workers, params.num_batches)
+            print('{}: {:.1f} samples/s'.format(name, speed))
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.nn as nn
 from torchvision.models.utils import load_state_dict_from_url
@@ -21,6 +22,33 @@ model_urls = {
 }
 
 
+# local directory of the checkpoints (<arch>.pth or the file name of model_urls), used instead of the
+# download cache when it holds the file, e.g. on nodes without network access
+PRETRAINED_DIR = os.environ.get('PRETRAINED_DIR')
+
+# checkpoints already read in this process: the models built afterwards copy the weights from memory,
+# so a multi-branch model reads each checkpoint from disk once instead of once per branch
+_pretrained_state_dicts = {}
+
+
+def load_pretrained(arch, progress=True):
+    if arch not in _pretrained_state_dicts:
+        paths = [os.path.join(PRETRAINED_DIR, name) for name in [arch + '.pth', os.path.basename(model_urls[arch])]] \
+                if PRETRAINED_DIR else []
+        paths = [path for path in paths if os.path.isfile(path)]
+        if len(paths) > 0:
+            state_dict = torch.load(paths[0], map_location='cpu')
+        else:
+            state_dict = load_state_dict_from_url(model_urls[arch], progress=progress)
+        _pretrained_state_dicts[arch] = state_dict
+    return _pretrained_state_dicts[arch]
+
+
+def clear_pretrained_cache():
+    # called once the models are built, so the checkpoints are not kept for the rest of the process
+    _pretrained_state_dicts.clear()
+
+
 def conv3x3(in_planes, out_planes, stride=1, groups=1, dilation=1):
     """3x3 convolution with padding"""
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -214,8 +242,8 @@ class ResNet(nn.Module):
 def _resnet(arch, block, layers, pretrained, progress, **kwargs):
     model = ResNet(block, layers, **kwargs)
     if pretrained:
-        state_dict = load_state_dict_from_url(model_urls[arch],
-                                              progress=progress)
+        # load_state_dict copies the cached tensors into the parameters of the new model
+        state_dict = load_pretrained(arch, progress=progress)
         model.load_state_dict(state_dict, strict=False)
     return model
 
@@ -1,10 +1,14 @@
-import torch, time, os, random
+import torch, time, os, random, sys
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
-from backbone import MTAN_ResNet, DMTL, AdaShare, SMTL, SMTL_new
+from backbone import MTAN_ResNet, DMTL, AdaShare, SMTL, SMTL_new, domain_index
+from resnet import clear_pretrained_cache
 from create_dataset import office_dataloader
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 import argparse
 torch.set_num_threads(3)
 
@@ -19,8 +23,11 @@ def parse_args():
     parser.add_argument('--gpu_id', default='0', help='gpu_id') 
     parser.add_argument('--model', default='DMTL', type=str, help='DMTL, MTAN, AdaShare, SMTL, SMTL_new')
     parser.add_argument('--train_mode', default='trval', type=str, help='trval, train')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the images decoded by pack_dataset.py')
+    parser.add_argument('--multi_domain', action='store_true', default=False, help='one forward of the concatenated domain batches (DMTL, SMTL, SMTL_new)')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
     return parser.parse_args()
 
 params = parse_args()
@@ -36,6 +43,7 @@ else:
     print("No correct dataset parameter!")
     exit()
 
+build_t = time.time()
 if params.model == 'DMTL':
     batchsize = 64
     model = DMTL(task_num=task_num, class_num=class_num).cuda()
@@ -54,8 +62,21 @@ elif params.model == 'SMTL_new':
 else:
     print("No correct model parameter!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
     
-data_loader, iter_data_loader = office_dataloader(params.dataset, batchsize=batchsize)
+data_loader, iter_data_loader = office_dataloader(params.dataset, batchsize=batchsize, packed=params.packed)
+
+if params.multi_domain and not (hasattr(model, 'forward_multi') and params.task_index > task_num):
+    print("--multi_domain needs multi-task training of DMTL, SMTL or SMTL_new!")
+    exit()
+
+def get_batch(task_index):
+    try:
+        return iter_data_loader[task_index][params.train_mode].next()
+    except:
+        iter_data_loader[task_index][params.train_mode] = iter(data_loader[task_index][params.train_mode])
+        return iter_data_loader[task_index][params.train_mode].next()
 
 optimizer = optim.Adam(model.parameters(), lr=1e-4, weight_decay=1e-5)
 
@@ -70,16 +91,21 @@ for epoch in range(total_epoch):
     s_t = time.time()
     model.train()
     for batch_index in range(train_batch):
-        loss_train = torch.zeros(task_num).cuda()
-        for task_index in range(task_num):
-            try:
-                train_data, train_label = iter_data_loader[task_index][params.train_mode].next()
-            except:
-                iter_data_loader[task_index][params.train_mode] = iter(data_loader[task_index][params.train_mode])
-                train_data, train_label = iter_data_loader[task_index][params.train_mode].next()
-            train_data, train_label = train_data.cuda(non_blocking=True), train_label.cuda(non_blocking=True)
-            loss_train[task_index] = loss_fn(model(train_data, task_index), train_label)
-            avg_cost[epoch, task_index] += loss_train[task_index].item()
+        if params.multi_domain:
+            train_data, train_label = zip(*[get_batch(task_index) for task_index in range(task_num)])
+            sizes = [y.size(0) for y in train_label]
+            task_ids = domain_index(sizes, train_label[0].device)
+            # per-domain mean of the cross entropy, as loss_fn on each domain batch
+            losses = F.cross_entropy(model.forward_multi(list(train_data)), torch.cat(train_label), reduction='none')
+            loss_train = torch.zeros(task_num, device=losses.device).index_add_(0, task_ids, losses)
+            loss_train = loss_train / torch.tensor(sizes, dtype=losses.dtype).to(losses.device, non_blocking=True)
+            avg_cost[epoch] += loss_train.detach().cpu()
+        else:
+            loss_train = torch.zeros(task_num).cuda()
+            for task_index in range(task_num):
+                train_data, train_label = get_batch(task_index)
+                loss_train[task_index] = loss_fn(model(train_data, task_index), train_label)
+                avg_cost[epoch, task_index] += loss_train[task_index].item()
         
         if params.task_index > task_num:    
             loss = torch.sum(loss_train*lambda_weight[:, epoch])
@@ -101,7 +127,7 @@ for epoch in range(total_epoch):
         for mode_index, mode in enumerate(['val', 'test']):
             for k in range(task_num):
                 for test_it, test_data in enumerate(data_loader[k][mode]):
-                    x_test, y_test = test_data[0].cuda(non_blocking=True), test_data[1].cuda(non_blocking=True)
+                    x_test, y_test = test_data[0], test_data[1]
                     y_pred = model.predict(x_test, k)
                     loss_t = loss_fn(y_pred, y_test)
                     loss_data_count[mode_index, k] += loss_t.item()
@@ -139,4 +165,7 @@ for epoch in range(total_epoch):
         # for single task
         if (right_num[1]/count[1])[params.task_index] > best_test_acc:
             best_test_acc = (right_num[1]/count[1])[params.task_index]
-            print('!! -- -- epoch {}; best test acc {}'.format(epoch, right_num[1]/count[1]))
\ No newline at end of file
+            print('!! -- -- epoch {}; best test acc {}'.format(epoch, right_num[1]/count[1]))
+
+if params.export is not None and (params.model == 'SMTL' or params.model == 'SMTL_new'):
+    export_slim(model, params.export)
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 from backbone import Cross_Stitch
+from resnet import clear_pretrained_cache
 from create_dataset import office_dataloader_other
 import argparse
 torch.set_num_threads(3)
@@ -19,6 +20,7 @@ def parse_args():
     parser.add_argument('--gpu_id', default='0', help='gpu_id') 
     parser.add_argument('--model', default='Cross', type=str, help='Cross')
     parser.add_argument('--train_mode', default='trval', type=str, help='trval, train')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the images decoded by pack_dataset.py')
     return parser.parse_args()
 
 params = parse_args()
@@ -34,6 +36,7 @@ else:
     print("No correct dataset parameter!")
     exit()
 
+build_t = time.time()
 if params.model == 'Cross':
     batchsize = 32
     model = Cross_Stitch(task_num=task_num, class_num=class_num).cuda()
@@ -43,8 +46,10 @@ elif params.model == 'MTAN':
 else:
     print("No correct model parameter!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
     
-data_loader, iter_data_loader = office_dataloader_other(params.dataset, batchsize=batchsize)
+data_loader, iter_data_loader = office_dataloader_other(params.dataset, batchsize=batchsize, packed=params.packed)
 
 optimizer = optim.Adam(model.parameters(), lr=1e-4, weight_decay=1e-5)
 
@@ -68,7 +73,6 @@ for epoch in range(total_epoch):
             except:
                 iter_data_loader[task_index][params.train_mode] = iter(data_loader[task_index][params.train_mode])
                 train_data, train_label = iter_data_loader[task_index][params.train_mode].next()
-            train_data, train_label = train_data.cuda(non_blocking=True), train_label.cuda(non_blocking=True)
             
             train_datas[task_index] = train_data
             train_labels[task_index] = train_label
@@ -99,7 +103,7 @@ for epoch in range(total_epoch):
             y_tests = [0 for _ in range(task_num)]
             for k in range(task_num):
                 for test_it, test_data in enumerate(data_loader[k][mode]):
-                    x_test, y_test = test_data[0].cuda(non_blocking=True), test_data[1].cuda(non_blocking=True)
+                    x_test, y_test = test_data[0], test_data[1]
                     x_tests[k] = x_test
                     y_tests[k] = y_test
                     
@@ -0,0 +1,99 @@
+import os
+import torch
+import torch.nn as nn
+
+# (shared, task-specific) submodule names of the SMTL models in this repo
+ENCODERS = [('backbone_s', 'backbone_t'), ('base_network_s', 'base_network_t'), ('bert_s', 'bert_t')]
+HEADS = [('decoders_s', 'decoders_t'), ('hidden_layer_s', 'hidden_layer_t'), ('fc_s', 'fc_t')]
+
+
+def get_branch_usage(model, h=None):
+    """
+    return (use_s, use_t): whether each task reads the shared / its task-specific branch at inference
+    only the hard SMTL-v3 gate switches a branch off, v1 and v2 always use both
+    """
+    gate = model.get_gate() if h is None else model.get_gate(h)
+    if model.version != 'v3':
+        return [True] * len(gate), [True] * len(gate)
+    return [bool(g[0]) for g in gate], [bool(g[1]) for g in gate]
+
+
+def get_pruned_prefixes(model, use_s, use_t):
+    # state_dict prefixes of the submodules that no task reads
+    children = dict(model.named_children())
+    prefixes = []
+    for name_s, name_t in ENCODERS + HEADS:
+        if name_s in children:
+            if isinstance(children[name_s], nn.ModuleList):
+                # one shared-side head per task
+                prefixes += ['{}.{}.'.format(name_s, i) for i in range(len(use_s)) if not use_s[i]]
+            elif not any(use_s):
+                prefixes.append(name_s + '.')
+        if name_t in children:
+            prefixes += ['{}.{}.'.format(name_t, i) for i in range(len(use_t)) if not use_t[i]]
+    return prefixes
+
+
+def _numel_bytes(state_dict):
+    numel = sum(v.numel() for v in state_dict.values())
+    nbytes = sum(v.numel() * v.element_size() for v in state_dict.values())
+    return numel, nbytes
+
+
+def export_slim(model, path, h=None):
+    """
+    save a checkpoint of a trained SMTL model holding only the encoders and heads its gate selects
+    h: the gate module (Model_alpha) of the bilevel models, whose alpha lives outside the model
+    """
+    use_s, use_t = get_branch_usage(model, h)
+    prefixes = get_pruned_prefixes(model, use_s, use_t)
+    state_dict = model.state_dict()
+    slim_state_dict = {k: v for k, v in state_dict.items() if not k.startswith(tuple(prefixes))}
+    ckpt = {'version': model.version,
+            'use_s': use_s,
+            'use_t': use_t,
+            'pruned': prefixes,
+            'state_dict': slim_state_dict}
+    if h is not None:
+        ckpt['h'] = h.state_dict()
+    torch.save(ckpt, path)
+
+    full_numel, full_bytes = _numel_bytes(state_dict)
+    slim_numel, slim_bytes = _numel_bytes(slim_state_dict)
+    report = {'full_params': full_numel, 'slim_params': slim_numel,
+              'full_bytes': full_bytes, 'slim_bytes': slim_bytes,
+              'file_bytes': os.path.getsize(path)}
+    print('export {}: shared used by {}, specific used by {}, pruned {}'.format(
+          path, use_s, use_t, [p[:-1] for p in prefixes]))
+    print('params {} -> {} ({:.1f}% saved), {:.1f}MB -> {:.1f}MB, file {:.1f}MB'.format(
+          full_numel, slim_numel, 100. * (1 - slim_numel / full_numel),
+          full_bytes / 1024**2, slim_bytes / 1024**2, report['file_bytes'] / 1024**2))
+    return report
+
+
+def read_slim(path, map_location='cpu'):
+    # a checkpoint written by export_slim, read before the model is built: its 'pruned' list is the pruned
+    # argument of the SMTL constructors, so the encoders that no task reads are never built nor loaded
+    return torch.load(path, map_location=map_location)
+
+
+def load_slim(model, ckpt, h=None):
+    """
+    load a checkpoint read by read_slim into a model built with pruned=ckpt['pruned'], e.g.
+        ckpt = read_slim(path)
+        model = SMTLmodel(version=ckpt['version'], pruned=ckpt['pruned'])
+        load_slim(model, ckpt)
+    the pruned heads are small and built anyway, they are dropped from the model here
+    """
+    assert ckpt['version'] == model.version, 'checkpoint is SMTL-{}, model is SMTL-{}'.format(ckpt['version'], model.version)
+    for prefix in ckpt['pruned']:
+        names = prefix[:-1].split('.')
+        parent = model
+        for n in names[:-1]:
+            parent = getattr(parent, n)
+        # a None child is skipped by state_dict, load_state_dict, .cuda() and parameters()
+        parent._modules[names[-1]] = None
+    model.load_state_dict(ckpt['state_dict'])
+    if h is not None:
+        h.load_state_dict(ckpt['h'])
+    return model
@@ -0,0 +1,148 @@
+import os, time, json, hashlib
+import numpy as np
+import torch
+import cv2
+from create_dataset_taskonomy import Taskonomy, TaskonomyPacked
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Pack Taskonomy into pre-resized memory-mapped shards')
+    parser.add_argument('--dataroot', default='/data/baijiongl/taskonomy-tiny/', type=str, help='dataset root with train.txt/test.txt')
+    parser.add_argument('--packed_root', default=None, type=str, help='output directory, default dataroot/packed')
+    parser.add_argument('--max_broken', default=0.01, type=float, help='abort the packing when a larger fraction of samples is broken')
+    parser.add_argument('--verify', action='store_true', default=False, help='check the sha1 of the shards')
+    parser.add_argument('--benchmark', action='store_true', default=False, help='compare the packed and per-file loaders')
+    parser.add_argument('--batch_size', default=64, type=int, help='batch size of the benchmark')
+    parser.add_argument('--num_workers', default=4, type=int, help='loader workers of the benchmark')
+    parser.add_argument('--num_batches', default=50, type=int, help='batches read per loader in the benchmark')
+    return parser.parse_args()
+
+
+# raw PNG values after the nearest resize to 256x256 done by the loader
+MODALITIES = {'rgb': ([256, 256, 3], 'uint8'),
+              'segment_semantic': ([256, 256], 'uint8'),
+              'normal': ([256, 256, 3], 'uint8'),
+              'depth_zbuffer': ([256, 256], 'uint16'),
+              'keypoints2d': ([256, 256], 'uint16'),
+              'edge_texture': ([256, 256], 'uint16')}
+
+
+def read_sample(db, item):
+    # the resized raw arrays of a sample, None if a file is missing, corrupt or of an unexpected format
+    try:
+        raw = []
+        for x, m in zip(db._read(item), TaskonomyPacked.modalities):
+            shape, dtype = MODALITIES[m]
+            # the values are checked, not the dtype PIL returns: Pillow opens the 16-bit PNGs as int32 (mode I)
+            if x.dtype.kind not in 'ui' or x.size == 0 or x.min() < 0 or x.max() > np.iinfo(dtype).max:
+                raise ValueError('{} is {} out of the range of {}'.format(m, x.dtype, dtype))
+            x = cv2.resize(x.astype(dtype), (256, 256), interpolation=cv2.INTER_NEAREST)
+            if list(x.shape) != shape:
+                raise ValueError('{} is {}'.format(m, x.shape))
+            raw.append(x)
+        # the loader must be able to decode what is packed
+        db._decode(*raw)
+    except Exception as e:
+        print('Error in loading {}: {}'.format(db.groups[item].strip(), e))
+        return None
+    return raw
+
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pack_building(db, items, dst):
+    os.makedirs(dst, exist_ok=True)
+    out = {m: np.lib.format.open_memmap(os.path.join(dst, m + '.npy'), mode='w+', dtype=dtype,
+                                        shape=(len(items),) + tuple(shape))
+           for m, (shape, dtype) in MODALITIES.items()}
+    samples, broken = [], []
+    for i, item in enumerate(items):
+        raw = read_sample(db, item)
+        if raw is None:
+            # the slot stays empty and is never referenced
+            samples.append(None)
+            broken.append(db.groups[item].strip())
+            continue
+        for x, m in zip(raw, TaskonomyPacked.modalities):
+            out[m][i] = x
+        samples.append(db.groups[item].strip())
+    for m in out:
+        out[m].flush()
+    del out
+    return {'num_samples': len(items), 'samples': samples,
+            'sha1': {m: sha1_file(os.path.join(dst, m + '.npy')) for m in MODALITIES}}, broken
+
+
+def pack(dataroot, packed_root, max_broken=0.01):
+    manifest = {'modalities': {m: {'shape': shape, 'dtype': dtype} for m, (shape, dtype) in MODALITIES.items()},
+                'buildings': {}, 'broken': []}
+    for mode in ['train', 'test']:
+        db = Taskonomy(dataroot=dataroot, mode=mode, augmentation=False)
+        # shards are grouped by building, in the order of the split files
+        buildings = {}
+        for item, gr in enumerate(db.groups):
+            buildings.setdefault(gr.split('/')[1], []).append(item)
+        for building, items in buildings.items():
+            s_t = time.time()
+            name = '{}_{}'.format(mode, building)
+            manifest['buildings'][name], broken = pack_building(db, items, os.path.join(packed_root, name))
+            manifest['broken'] += broken
+            print('packed {}: {} samples, {} broken in {:.1f}s'.format(name, len(items), len(broken), time.time()-s_t))
+    # a systematic read failure (e.g. a Pillow returning another dtype) must not leave an empty packed dataset
+    num_samples = sum(info['num_samples'] for info in manifest['buildings'].values())
+    if len(manifest['broken']) > max_broken * num_samples or len(manifest['broken']) == num_samples:
+        raise RuntimeError('{} of {} samples are broken, no manifest.json written'.format(len(manifest['broken']), num_samples))
+    # manifest.json is written last, so an interrupted conversion is never picked up by the packed dataset
+    with open(os.path.join(packed_root, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def verify(packed_root):
+    with open(os.path.join(packed_root, 'manifest.json')) as f:
+        manifest = json.load(f)
+    ok = True
+    for name, info in manifest['buildings'].items():
+        for m, sha1 in info['sha1'].items():
+            if sha1_file(os.path.join(packed_root, name, m + '.npy')) != sha1:
+                print('{}/{}.npy does not match its checksum'.format(name, m))
+                ok = False
+    return ok
+
+
+def benchmark(dataset, batch_size, num_workers, num_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True)
+    num_samples = 0
+    s_t = time.time()
+    for k, (data, _) in enumerate(loader):
+        num_samples += data.size(0)
+        if k + 1 == num_batches:
+            break
+    return num_samples / (time.time() - s_t)
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    packed_root = params.packed_root or os.path.join(params.dataroot, 'packed')
+    if not os.path.exists(os.path.join(packed_root, 'manifest.json')):
+        pack(params.dataroot, packed_root, params.max_broken)
+    if params.verify:
+        print('shards: {}'.format('ok' if verify(packed_root) else 'CORRUPTED'))
+    if params.benchmark:
+        for name, dataset in [('per-file', Taskonomy(dataroot=params.dataroot, mode='train', augmentation=True)),
+                              ('packed', TaskonomyPacked(dataroot=params.dataroot, mode='train', augmentation=True,
+                                                         packed_root=packed_root))]:
+            speed = benchmark(dataset, params.batch_size, params.num_workers, params.num_batches)
+            print('{}: {:.1f} samples/s'.format(name, speed))
@@ -0,0 +1,149 @@
+import torch
+
+
+def map_batch(fn, batch):
+    """apply fn to every tensor of a nested batch (tuples, lists, dicts), the other leaves are kept as they are"""
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, dict):
+        return {k: map_batch(fn, v) for k, v in batch.items()}
+    if isinstance(batch, tuple) and hasattr(batch, '_fields'):
+        return type(batch)(*[map_batch(fn, v) for v in batch])
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(map_batch(fn, v) for v in batch)
+    return batch
+
+
+class Normalize(object):
+    """
+    (x / scale - mean) / std over the channels of batch[key], on the device of the batch
+    e.g. Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225], key=0, scale=255) for uint8 images
+    """
+    def __init__(self, mean, std, key=0, scale=1.):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.key = key
+        self.scale = scale
+
+    def __call__(self, batch):
+        x = batch[self.key]
+        mean, std = self.mean.to(x.device, non_blocking=True), self.std.to(x.device, non_blocking=True)
+        x = (x.float() / self.scale - mean) / std
+        if isinstance(batch, dict):
+            return dict(batch, **{self.key: x})
+        out = list(batch)
+        out[self.key] = x
+        return tuple(out) if isinstance(batch, tuple) else out
+
+
+class PinnedRing(object):
+    """
+    num_buffers sets of page-locked host buffers the batches are staged in before an asynchronous copy
+    (the tensors that the DataLoader already pinned are sent as they are). A set is reused once the
+    copy issued from it num_buffers batches earlier has completed, the buffers only grow.
+    """
+    def __init__(self, num_buffers=2):
+        self.buffers = [[] for _ in range(num_buffers)]
+        self.events = [None] * num_buffers
+        self.index = 0
+
+    def stage(self, batch):
+        if self.events[self.index] is not None:
+            self.events[self.index].synchronize()
+        buffers = self.buffers[self.index]
+        count = [0]
+
+        def pin(t):
+            if t.device.type != 'cpu' or t.is_pinned():
+                return t
+            i = count[0]
+            count[0] += 1
+            if i == len(buffers):
+                buffers.append(None)
+            if buffers[i] is None or buffers[i].dtype != t.dtype or buffers[i].numel() < t.numel():
+                buffers[i] = torch.empty(t.numel(), dtype=t.dtype, pin_memory=True)
+            buf = buffers[i][:t.numel()].view(t.shape)
+            buf.copy_(t)
+            return buf
+        return map_batch(pin, batch)
+
+    def record(self, stream):
+        # called once the copies out of the current set are queued on stream
+        self.events[self.index] = stream.record_event()
+        self.index = (self.index + 1) % len(self.buffers)
+
+
+class CUDAPrefetcher(object):
+    """
+    Wraps a DataLoader so that its batches come out on the device: while the current step runs, the
+    next batch is staged in pinned memory, copied on a side stream and optionally transformed there
+    (e.g. Normalize). Works on arbitrarily nested batches. len() and iter() behave like the loader,
+    and the iterators keep the old .next() method, so it can replace a DataLoader where it is built.
+    Without CUDA (or with a cpu device) the batches are passed through, only the transform is applied.
+    """
+    def __init__(self, loader, device='cuda', transform=None, num_buffers=2):
+        self.loader = loader
+        self.device = torch.device(device if torch.cuda.is_available() else 'cpu')
+        self.transform = transform
+        # shared by the iterators of all epochs, so the pinned buffers are allocated once
+        self.ring = PinnedRing(num_buffers) if self.device.type == 'cuda' else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        return PrefetchIterator(self)
+
+
+class PrefetchIterator(object):
+    def __init__(self, prefetcher):
+        self.prefetcher = prefetcher
+        # the loader is started on the first next(), not when the iterator is created
+        self.loader = None
+        self.stream = None
+        self.batch = None
+
+    def preload(self):
+        p = self.prefetcher
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        if p.ring is None:
+            self.batch = batch if p.transform is None else p.transform(batch)
+            return
+        batch = p.ring.stage(batch)
+        with torch.cuda.stream(self.stream):
+            batch = map_batch(lambda t: t.to(p.device, non_blocking=True), batch)
+            if p.transform is not None:
+                batch = p.transform(batch)
+        p.ring.record(self.stream)
+        self.batch = batch
+
+    def __next__(self):
+        p = self.prefetcher
+        if self.loader is None:
+            self.loader = iter(p.loader)
+            if p.ring is not None:
+                self.stream = torch.cuda.Stream(device=p.device)
+            self.preload()
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        if p.ring is not None:
+            stream = torch.cuda.current_stream(p.device)
+            stream.wait_stream(self.stream)
+            # allocated on the side stream, used and freed on the current one
+            map_batch(lambda t: t.record_stream(stream) if t.is_cuda else None, batch)
+        self.preload()
+        return batch
+
+    next = __next__
+
+    def __iter__(self):
+        return self
@@ -1,16 +1,21 @@
-import torch, time, os, random
+import torch, time, os, random, sys
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 import scipy.io as sio
 from backbone import DeepLabv3, Cross_Stitch, MTANDeepLabv3, AdaShare, SMTLmodel, SMTLmodel_new
+from resnet import clear_pretrained_cache
 from nddr_cnn import NDDRCNN
 from afa import AFANet
 from tqdm import tqdm
 
-from create_dataset_taskonomy import Taskonomy, data_prefetcher
-from utils_taskonomy import compute_loss, PerformanceMeter
+from create_dataset_taskonomy import Taskonomy, TaskonomyPacked
+from prefetcher import CUDAPrefetcher
+from utils_taskonomy import TaskonomyLoss, PerformanceMeter
+# slim_export.py is shared by the experiments, it lives in the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slim_export import export_slim
 
 from torch.cuda.amp import autocast, GradScaler
 
@@ -24,11 +29,13 @@ def parse_args():
     parser = argparse.ArgumentParser(description= 'SMTL for Taskonomy-small')
     parser.add_argument('--model', default='DMTL', type=str, help='DMTL, CROSS, MTAN, AdaShare, NDDRCNN, AFA, SMTL, SMTL_new')
     parser.add_argument('--aug', action='store_true', default=False, help='data augmentation')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the pre-resized shards of pack_dataset.py')
     parser.add_argument('--task_index', default=10, type=int, help='for STL: 0,1,2,3,4')
     parser.add_argument('--gpu_id', default='0', help='gpu_id') 
     parser.add_argument('--total_epoch', default=200, type=int, help='training epoch')
     # for SMTL
     parser.add_argument('--version', default='v1', type=str, help='v1 (a1+a2=1), v2 (0<=a<=1), v3 (gumbel softmax)')
+    parser.add_argument('--export', default=None, type=str, help='path of the slim SMTL checkpoint saved after training')
     return parser.parse_args()
 
 params = parse_args()
@@ -41,12 +48,14 @@ tasks = ['seg', 'depth', 'sn', 'keypoint', 'edge']
 if params.task_index < len(tasks):
     tasks = [tasks[params.task_index]] 
    
-taskonomy_train_set = Taskonomy(dataroot=dataset_path, mode='train', augmentation=params.aug)
-taskonomy_test_set = Taskonomy(dataroot=dataset_path, mode='test', augmentation=False)
+dataset_class = TaskonomyPacked if params.packed else Taskonomy
+taskonomy_train_set = dataset_class(dataroot=dataset_path, mode='train', augmentation=params.aug)
+taskonomy_test_set = dataset_class(dataroot=dataset_path, mode='test', augmentation=False)
 
 print('train data', len(taskonomy_train_set))
 print('test data', len(taskonomy_test_set))
 
+build_t = time.time()
 if params.model == 'DMTL':
     batch_size = 230
     model = DeepLabv3(tasks=tasks).cuda()
@@ -74,6 +83,8 @@ elif params.model == 'SMTL_new':
 else:
     print("No correct model parameter!")
     exit()
+clear_pretrained_cache()
+print('model built in {:.1f}s'.format(time.time()-build_t))
 
 taskonomy_test_loader = torch.utils.data.DataLoader(
     dataset=taskonomy_test_set,
@@ -90,11 +101,12 @@ taskonomy_train_loader = torch.utils.data.DataLoader(
     pin_memory=True,
     drop_last=True)
 
-train_prefetcher = data_prefetcher(taskonomy_train_loader)
-test_prefetcher = data_prefetcher(taskonomy_test_loader)
+train_prefetcher = CUDAPrefetcher(taskonomy_train_loader)
+test_prefetcher = CUDAPrefetcher(taskonomy_test_loader)
 
 optimizer = optim.Adam(model.parameters(), lr=1e-4, weight_decay=1e-5)
 scaler = GradScaler()
+criterion = TaskonomyLoss(dataset_path).cuda()
 
 print('LOSS FORMAT: SEMANTIC_LOSS MEAN_IOU PIX_ACC | DEPTH_LOSS ABS_ERR REL_ERR | NORMAL_LOSS MEAN MED <11.25 <22.5 <30 | KEYPOINT_LOSS ABS_ERR | EDGE_LOSS ABS_ERR')
 total_epoch = params.total_epoch
@@ -106,20 +118,19 @@ for epoch in range(total_epoch):
 
     # iteration for all batches
     model.train()
+    train_dataset = iter(train_prefetcher)
     performance_meter = PerformanceMeter(tasks, dataset_path)
     # for batch_index in tqdm(range(train_batch)):
     for batch_index in range(train_batch):
         # if batch_index > 1:
         #     break
         
-        train_data, train_gt_dict = train_prefetcher.next()
-        train_data = train_data.cuda()
-        # train_gt_dict = train_gt_dict.cuda()
+        train_data, train_gt_dict = train_dataset.next()
         
         optimizer.zero_grad()
         with autocast():
             train_pred = model.forward(train_data)
-            loss_train = compute_loss(train_pred, train_gt_dict, dataset_path)
+            loss_train = criterion(train_pred, train_gt_dict)
                 
         scaler.scale(sum(loss_train)).backward()
         scaler.step(optimizer)
@@ -133,14 +144,13 @@ for epoch in range(total_epoch):
     model.eval()
     with torch.no_grad():  # operations inside don't track history
         val_batch = len(taskonomy_test_loader)
+        val_dataset = iter(test_prefetcher)
         performance_meter = PerformanceMeter(tasks, dataset_path)
         for k in range(val_batch):
             # if k > 1:
             #     break
             
-            val_data, val_gt_dict = test_prefetcher.next()
-            val_data = val_data.cuda()
-            # val_gt_dict = val_gt_dict.cuda()
+            val_data, val_gt_dict = val_dataset.next()
 
             val_pred = model.predict(val_data)
             performance_meter.update(val_pred, val_gt_dict)
@@ -163,4 +173,7 @@ for epoch in range(total_epoch):
         print('!!!TEST:', eval_results_val)
 
     e_t = time.time()
-    print('TIME:', e_t-s_t)
\ No newline at end of file
+    print('TIME:', e_t-s_t)
+
+if params.export is not None and (params.model == 'SMTL' or params.model == 'SMTL_new'):
+    export_slim(model, params.export)
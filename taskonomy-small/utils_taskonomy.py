@@ -4,103 +4,21 @@ import torch, os
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from sklearn.metrics import confusion_matrix
-
-
-def get_seg_loss(seg_pred, seg, seg_num_class, dataroot):
-    weight = torch.from_numpy(np.load(os.path.join(dataroot, 'semseg_prior_factor.npy'))).cuda().float()
-    loss_fn = nn.CrossEntropyLoss(weight=weight, ignore_index=255)
-    prediction = seg_pred.permute(0, 2, 3, 1).contiguous().view(-1, seg_num_class)
-    batch_size = seg_pred.shape[0]
-    new_shape = seg_pred.shape[-2:]
-    seg_resize = F.interpolate(seg.float(), size=new_shape)
-    gt = seg_resize.permute(0, 2, 3, 1).contiguous().view(-1)
-    loss = loss_fn(prediction, gt.long())
-    return loss
-
-def get_sn_loss(sn_pred, normal, normal_mask=None):
-    prediction = sn_pred.permute(0, 2, 3, 1).contiguous().view(-1, 3)
-    new_shape = sn_pred.shape[-2:]
-    sn_resize = F.interpolate(normal.float(), size=new_shape)
-    gt = sn_resize.permute(0, 2, 3, 1).contiguous().view(-1, 3)
-    labels = (gt.max(dim=1)[0] < 255)
-    if normal_mask is not None:
-        normal_mask_resize = F.interpolate(normal_mask.float(), size=new_shape)
-        gt_mask = normal_mask_resize.permute(0, 2, 3, 1).contiguous().view(-1, 3)
-#         print('/'*10, labels.shape, gt_mask.shape)
-        labels = labels*(gt_mask[:,0].int() == 1)
-
-    prediction = prediction[labels]
-    gt = gt[labels]
-
-    prediction = F.normalize(prediction)
-    gt = F.normalize(gt)
-    cosine_similiarity = nn.CosineSimilarity()
-    
-    return 1 - cosine_similiarity(prediction, gt).mean()
-
-
-def get_depth_loss(depth_pred, depth, depth_mask=None):
-    new_shape = depth_pred.shape[-2:]
-    depth_resize = F.interpolate(depth.float(), size=new_shape)
-    if depth_mask is not None:
-        depth_mask_resize = F.interpolate(depth_mask.float(), size=new_shape)
-
-    binary_mask = (depth_resize != 255) * (depth_mask_resize.int() == 1)
-
-    depth_output = depth_pred.masked_select(binary_mask)
-    depth_gt = depth_resize.masked_select(binary_mask)
-
-    l1_loss = nn.L1Loss()
-    return l1_loss(depth_output, depth_gt)
-
-
-def get_keypoint_loss(keypoint_pred, keypoint):
-    new_shape = keypoint_pred.shape[-2:]
-    keypoint_resize = F.interpolate(keypoint.float(), size=new_shape)
-    binary_mask = keypoint_resize != 255
-
-    keypoint_output = keypoint_pred.masked_select(binary_mask)
-    keypoint_gt = keypoint_resize.masked_select(binary_mask)
-    l1_loss = nn.L1Loss()
-    return l1_loss(keypoint_output, keypoint_gt)
-
-
-def get_edge_loss(edge_pred, edge):
-    new_shape = edge_pred.shape[-2:]
-    edge_resize = F.interpolate(edge.float(), size=new_shape)
-    binary_mask = edge_resize != 255
-    edge_output = edge_pred.masked_select(binary_mask)
-    edge_gt = edge_resize.masked_select(binary_mask)
-    l1_loss = nn.L1Loss()
-    return l1_loss(edge_output, edge_gt)
+from angular_error import AngularErrorHistogram
+from confusion_meter import ConfusionMatrixMeter
 
 
 def seg_error(seg_output, seg, seg_num_class, dataroot):
+    # predicted and ground-truth labels of every pixel, left on the device;
+    # labels >= seg_num_class (e.g. 255) are ignored by the confusion meter
     with torch.no_grad():
         gt = seg.view(-1)
-        labels = gt < seg_num_class
-        gt = gt[labels].int()
-
-        logits = seg_output.permute(0, 2, 3, 1).contiguous().view(-1, seg_num_class)
-        logits = logits[labels]
-
-    #     weight = torch.from_numpy(np.load(os.path.join(dataroot, 'semseg_prior_factor.npy'))).cuda().float()
-    #     loss_fn = nn.CrossEntropyLoss(weight=weight, ignore_index=255)
-    #     err = loss_fn(logits, gt.long())
-
-        prediction = torch.argmax(seg_output, dim=1)
-        prediction = prediction.unsqueeze(1)
-
-        # pixel acc
-        prediction = prediction.view(-1)
-        prediction = prediction[labels].int()
-        pixelAcc = (gt == prediction).float().mean()
-
-        return prediction.cpu().numpy(), gt.cpu().numpy(), pixelAcc.cpu().numpy()
+        prediction = torch.argmax(seg_output, dim=1).view(-1)
+        return prediction, gt
 
 def normal_error(sn_output, normal, normal_mask=None):
-    # normalized, ignored gt and prediction
+    # per-pixel cosine similarity of the normalized gt and prediction, and the mask of the non-ignored pixels
+    # both stay on the device, the ignored pixels are masked instead of selected out
     with torch.no_grad():
         prediction = sn_output.permute(0, 2, 3, 1).contiguous().view(-1, 3)
         gt = normal.permute(0, 2, 3, 1).contiguous().view(-1, 3)
@@ -110,16 +28,13 @@ def normal_error(sn_output, normal, normal_mask=None):
             gt_mask = normal_mask.permute(0, 2, 3, 1).contiguous().view(-1, 3)
             labels = labels*(gt_mask[:,0].int() == 1)
 
-        gt = gt[labels]
-        prediction = prediction[labels]
-
         gt = F.normalize(gt.float(), dim=1)
-        prediction = F.normalize(prediction, dim=1)
+        prediction = F.normalize(prediction.float(), dim=1)
 
     #     cosine_similiarity = nn.CosineSimilarity()
         cos_similarity = F.cosine_similarity(gt, prediction)
 
-        return cos_similarity.cpu().numpy()
+        return cos_similarity, labels
 
 def depth_error(depth_output, depth, depth_mask):
     with torch.no_grad():
@@ -161,22 +76,71 @@ def edge_error(edge_output, edge):
         abs_err = torch.abs(edge_output_true - edge_gt_true).mean()
         return abs_err.cpu().numpy()
 
-def compute_loss(pred_dict, gt_dict, dataroot):
-    loss_train = torch.zeros(len(pred_dict)).cuda()
-    seg_num_class = 17
-    for i, (tk, pred) in enumerate(pred_dict.items()):
-        if tk == 'seg':
-            loss_train[i] = get_seg_loss(pred, gt_dict['seg'], seg_num_class, dataroot)
-        if tk == 'depth':
-            loss_train[i] = get_depth_loss(pred, gt_dict['depth'], gt_dict['depth_mask'])
-        if tk == 'sn':
-            loss_train[i] = get_sn_loss(pred, gt_dict['normal'], gt_dict['normal_mask'])
-        if tk == 'keypoint':
-            loss_train[i] = get_keypoint_loss(pred, gt_dict['keypoint'])
-        if tk == 'edge':
-            loss_train[i] = get_edge_loss(pred, gt_dict['edge'])
-    return loss_train
-            
+
+class TaskonomyLoss(nn.Module):
+    """
+    The five Taskonomy task losses with their constant state built once per run.
+    The semantic class prior is loaded once into a buffer (moved by .cuda() with the module), the ground
+    truth is only resampled when its resolution differs from the prediction, and the ignored pixels are
+    masked out of device-side sums instead of being selected out, so a call does no file I/O and no host sync.
+    """
+    def __init__(self, dataroot):
+        super(TaskonomyLoss, self).__init__()
+        weight = torch.from_numpy(np.load(os.path.join(dataroot, 'semseg_prior_factor.npy'))).float()
+        self.register_buffer('seg_weight', weight)
+
+    @staticmethod
+    def _resize(gt, shape):
+        gt = gt.float()
+        if gt.shape[-2:] != shape:
+            gt = F.interpolate(gt, size=shape)
+        return gt
+
+    @staticmethod
+    def _masked_mean(x, mask):
+        mask = mask.float()
+        return torch.sum(x * mask) / torch.sum(mask).clamp(min=1)
+
+    def seg_loss(self, seg_pred, seg):
+        gt = self._resize(seg, seg_pred.shape[-2:])[:, 0].long()
+        return F.cross_entropy(seg_pred.float(), gt, weight=self.seg_weight, ignore_index=255)
+
+    def sn_loss(self, sn_pred, normal, normal_mask=None):
+        gt = self._resize(normal, sn_pred.shape[-2:])
+        labels = gt.max(dim=1)[0] < 255
+        if normal_mask is not None:
+            labels = labels & (self._resize(normal_mask, sn_pred.shape[-2:])[:, 0].int() == 1)
+        cos = F.cosine_similarity(F.normalize(sn_pred.float(), dim=1), F.normalize(gt, dim=1), dim=1)
+        return 1 - self._masked_mean(cos, labels)
+
+    def depth_loss(self, depth_pred, depth, depth_mask=None):
+        gt = self._resize(depth, depth_pred.shape[-2:])
+        binary_mask = gt != 255
+        if depth_mask is not None:
+            binary_mask = binary_mask & (self._resize(depth_mask, depth_pred.shape[-2:]).int() == 1)
+        return self._masked_mean(torch.abs(depth_pred.float() - gt), binary_mask)
+
+    def l1_loss(self, pred, gt):
+        # keypoint and edge: l1 over the pixels that are not 255
+        gt = self._resize(gt, pred.shape[-2:])
+        return self._masked_mean(torch.abs(pred.float() - gt), gt != 255)
+
+    def forward(self, pred_dict, gt_dict):
+        # one loss per predicted task, stacked in the order of pred_dict
+        losses = []
+        for tk, pred in pred_dict.items():
+            if tk == 'seg':
+                losses.append(self.seg_loss(pred, gt_dict['seg']))
+            elif tk == 'depth':
+                losses.append(self.depth_loss(pred, gt_dict['depth'], gt_dict['depth_mask']))
+            elif tk == 'sn':
+                losses.append(self.sn_loss(pred, gt_dict['normal'], gt_dict['normal_mask']))
+            elif tk == 'keypoint':
+                losses.append(self.l1_loss(pred, gt_dict['keypoint']))
+            elif tk == 'edge':
+                losses.append(self.l1_loss(pred, gt_dict['edge']))
+        return torch.stack(losses)
+
 
 class PerformanceMeter(object):
     def __init__(self, tasks, dataroot):
@@ -187,11 +151,10 @@ class PerformanceMeter(object):
         self.dataroot = dataroot
         self.num_seg_cls = 17
         if 'seg' in self.tasks:
-            self.records['seg'] = {'mIoUs': [], 'pixelAccs': [],  'errs': [], 
-                                   'conf_mat': np.zeros((self.num_seg_cls, self.num_seg_cls)),
-                                   'labels': np.arange(self.num_seg_cls)}
+            self.records['seg'] = {'mIoUs': [], 'errs': [],
+                                   'conf_meter': ConfusionMatrixMeter(self.num_seg_cls, ignore_index=255)}
         if 'sn' in self.tasks:
-            self.records['sn'] = {'cos_similaritys': []}
+            self.records['sn'] = {'angle_hist': AngularErrorHistogram()}
         if 'depth' in self.tasks:
             self.records['depth'] = {'abs_errs': [], 'rel_errs': [], 'sq_rel_errs': [], 'ratios': [], 'rms': [], 'rms_log': []}
         if 'keypoint' in self.tasks:
@@ -201,15 +164,12 @@ class PerformanceMeter(object):
             
     def update(self, pred_dict, gt_dict):
         if 'seg' in self.tasks:
-            prediction, gt, pixelAcc = seg_error(pred_dict['seg'], gt_dict['seg'], self.num_seg_cls, self.dataroot)
-            new_mat = confusion_matrix(gt, prediction, labels=self.records['seg']['labels'])
-            assert (self.records['seg']['conf_mat'].shape == new_mat.shape)
-            self.records['seg']['conf_mat'] += new_mat
-            self.records['seg']['pixelAccs'].append(pixelAcc)
+            prediction, gt = seg_error(pred_dict['seg'], gt_dict['seg'], self.num_seg_cls, self.dataroot)
+            self.records['seg']['conf_meter'].update(prediction, gt)
 #             self.records['seg']['errs'].append(err)
         if 'sn' in self.tasks:
-            cos_similarity = normal_error(pred_dict['sn'], gt_dict['normal'], gt_dict['normal_mask'])
-            self.records['sn']['cos_similaritys'].append(cos_similarity)
+            cos_similarity, labels = normal_error(pred_dict['sn'], gt_dict['normal'], gt_dict['normal_mask'])
+            self.records['sn']['angle_hist'].update_cos(cos_similarity, labels)
         if 'depth' in self.tasks:
             abs_err, rel_err, sq_rel_err, ratio, rms, rms_log = depth_error(pred_dict['depth'], gt_dict['depth'], gt_dict['depth_mask'])
             self.records['depth']['abs_errs'].append(abs_err)
@@ -229,6 +189,7 @@ class PerformanceMeter(object):
     def get_score(self):
         if 'seg' in self.tasks:
             self.val_metrics['seg'] = {}
+            self.records['seg']['conf_mat'] = self.records['seg']['conf_meter'].get_confusion_matrix()
             jaccard_perclass = []
             for i in range(self.num_seg_cls):
                 if not self.records['seg']['conf_mat'][i, i] == 0:
@@ -239,22 +200,19 @@ class PerformanceMeter(object):
 
             self.val_metrics['seg']['mIoU'] = np.sum(jaccard_perclass) / len(jaccard_perclass)
 
-            self.val_metrics['seg']['Pixel Acc'] = (np.array(self.records['seg']['pixelAccs']) * np.array(self.batch_size)).sum() / sum(self.batch_size)
+            _, self.val_metrics['seg']['Pixel Acc'] = self.records['seg']['conf_meter'].get_metrics()
 
 #             self.val_metrics['seg']['err'] = (np.array(self.records['seg']['errs']) * np.array(self.batch_size)).sum() / sum(self.batch_size)
 
         if 'sn' in self.tasks:
             self.val_metrics['sn'] = {}
-            overall_cos = np.clip(np.concatenate(self.records['sn']['cos_similaritys']), -1, 1)
-
-            angles = np.arccos(overall_cos) / np.pi * 180.0
-#             self.val_metrics['sn']['cosine_similarity'] = overall_cos.mean()
-            self.val_metrics['sn']['Angle Mean'] = np.mean(angles)
-            self.val_metrics['sn']['Angle Median'] = np.median(angles)
-#             self.val_metrics['sn']['Angle RMSE'] = np.sqrt(np.mean(angles ** 2))
-            self.val_metrics['sn']['Angle 11.25'] = np.mean(np.less_equal(angles, 11.25)) * 100
-            self.val_metrics['sn']['Angle 22.5'] = np.mean(np.less_equal(angles, 22.5)) * 100
-            self.val_metrics['sn']['Angle 30'] = np.mean(np.less_equal(angles, 30.0)) * 100
+            angles = self.records['sn']['angle_hist'].get_metrics()
+            self.val_metrics['sn']['Angle Mean'] = angles['mean']
+            self.val_metrics['sn']['Angle Median'] = angles['median']
+#             self.val_metrics['sn']['Angle RMSE'] = angles['rmse']
+            self.val_metrics['sn']['Angle 11.25'] = angles['11.25'] * 100
+            self.val_metrics['sn']['Angle 22.5'] = angles['22.5'] * 100
+            self.val_metrics['sn']['Angle 30'] = angles['30'] * 100
 #             self.val_metrics['sn']['Angle 45'] = np.mean(np.less_equal(angles, 45.0)) * 100
 
         if 'depth' in self.tasks:
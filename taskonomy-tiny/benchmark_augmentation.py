@@ -0,0 +1,88 @@
+import time, resource
+import numpy as np
+import torch
+from create_dataset_taskonomy import Taskonomy
+
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser(description= 'Per-sample latency and worker memory of the Taskonomy augmentation')
+    parser.add_argument('--dataroot', default='/raid/zy_lab/gpx/dataset/taskonomy-tiny/', type=str, help='dataset root with train.txt/test.txt')
+    parser.add_argument('--num_samples', default=64, type=int, help='decoded samples the augmentation is timed on')
+    parser.add_argument('--repeat', default=10, type=int, help='augmentations timed per sample')
+    parser.add_argument('--batch_size', default=64, type=int, help='batch size of the loader run')
+    parser.add_argument('--num_workers', default=4, type=int, help='loader workers whose peak RSS is reported')
+    parser.add_argument('--num_batches', default=20, type=int, help='batches read per loader run')
+    return parser.parse_args()
+
+
+class TaskonomyReference(Taskonomy):
+    # the previous augmentation path: full-size __scale__ and __mirror__ copies, then a float64 canvas to crop from
+    @staticmethod
+    def __random_scale_mirror_crop__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p, crop_h, crop_w, ignore_label=255):
+        maps = Taskonomy.__scale__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p)
+        maps = Taskonomy.__mirror__(*maps)
+        return Taskonomy.__random_crop_and_pad_image_and_labels__(*maps, crop_h, crop_w, ignore_label)
+
+
+class PeakRSS(torch.utils.data.Dataset):
+    # returns the id and the peak RSS (kB) of the worker that loaded each sample along with it
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        worker = torch.utils.data.get_worker_info()
+        return self.dataset[item], torch.tensor([worker.id if worker is not None else -1,
+                                                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss])
+
+
+def latency(dataset, samples, repeat):
+    # milliseconds per augmented sample, the decoding is left out
+    times = []
+    for maps in samples:
+        for _ in range(repeat):
+            # __mirror__ negates the normals of its input in place, each call gets its own copy
+            inputs = [x.copy() for x in maps]
+            s_t = time.perf_counter()
+            dataset.__random_scale_mirror_crop__(*inputs, dataset.crop_h, dataset.crop_w)
+            times.append(time.perf_counter() - s_t)
+    times = np.array(times) * 1000
+    return times.mean(), np.median(times)
+
+
+def peak_rss(dataset, batch_size, num_workers, num_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset=PeakRSS(dataset),
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True)
+    rss = {}
+    for k, (_, info) in enumerate(loader):
+        for worker, kb in info.tolist():
+            rss[worker] = max(rss.get(worker, 0), kb)
+        if k + 1 == num_batches:
+            break
+    return [rss[w] / 1024 for w in sorted(rss)]
+
+
+if __name__ == '__main__':
+    params = parse_args()
+    print(params)
+    datasets = [('reference', TaskonomyReference(dataroot=params.dataroot, mode='train', augmentation=True)),
+                ('warp', Taskonomy(dataroot=params.dataroot, mode='train', augmentation=True))]
+    samples = []
+    for item in range(params.num_samples):
+        img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p = datasets[1][1]._load(item)
+        # the dtypes seen by the augmentation in __getitem__
+        samples.append([img_p, seg_p, seg_mask.astype('float32'), sn_p, depth_p, depth_mask.astype('float32'),
+                        keypoint_p, edge_p])
+    for name, dataset in datasets:
+        mean, median = latency(dataset, samples, params.repeat)
+        print('{}: {:.2f} ms/sample (median {:.2f})'.format(name, mean, median))
+    for name, dataset in datasets:
+        rss = peak_rss(dataset, params.batch_size, params.num_workers, params.num_batches)
+        print('{}: peak RSS per worker {} MB'.format(name, ', '.join('{:.0f}'.format(r) for r in rss)))
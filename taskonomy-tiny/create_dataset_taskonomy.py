@@ -1,6 +1,6 @@
 # modify from https://github.com/sunxm2357/AdaShare/blob/master/dataloaders/taskonomy_dataloader.py
 import os
-# import json
+import json
 import numpy as np
 import torch
 import random
@@ -14,31 +14,6 @@ import torch.nn.functional as F
 
 # os.environ["CUDA_VISIBLE_DEVICES"] = '1'
 
-class data_prefetcher():
-    def __init__(self, loader):
-        self.inital_loader = loader
-        self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        self.preload()
-
-    def preload(self):
-        try:
-            self.next_input, self.gt_dict = next(self.loader)
-        except StopIteration:
-            self.loader = iter(self.inital_loader)
-            self.preload()
-            return
-        with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.gt_dict = {key: val.cuda(non_blocking=True) for (key,val) in self.gt_dict.items()}
-
-    def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        target = self.gt_dict
-        self.preload()
-        return input, target
-
 class Taskonomy(torch.utils.data.Dataset):
     def __init__(self, dataroot, mode, crop_h=None, crop_w=None, augmentation=False):
 #         print(self.name())
@@ -141,6 +116,53 @@ class Taskonomy(torch.utils.data.Dataset):
 
         return img_crop, seg_crop, seg_mask_crop, sn_crop, depth_crop, depth_mask_crop, keypoint_crop, edge_crop
 
+    @staticmethod
+    def __random_scale_mirror_crop__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p, crop_h, crop_w, ignore_label=255):
+        """
+           __scale__, __mirror__ and __random_crop_and_pad_image_and_labels__ folded into one affine warp per map:
+           every output is written once, directly at the crop size and in the dtype of its input, instead of
+           going through full-size resized / mirrored copies and a float64 canvas of all the maps.
+           The outputs are new arrays of each sample, which the loader keeps alive until the batch is collated.
+           The random draws and the padding (0 for the image, ignore_label for the labels) are the same. The
+           labels are sampled on the pixel centers of the bilinear image, so at nearest-neighbour boundaries they
+           can differ by one pixel from cv2.resize, and the image weights are quantized to 1/32 by cv2.warpAffine.
+        """
+        scale = random.random() + 0.5
+        h, w = img_p.shape[:2]
+        h_new, w_new = int(h * scale), int(w * scale)
+        flip = random.random() > 0.5
+        pad_h, pad_w = max(h_new, crop_h), max(w_new, crop_w)
+        offset_h, offset_w = (pad_h - h_new) // 2, (pad_w - w_new) // 2
+        start_h, start_w = np.random.randint(0, pad_h - crop_h + 1), np.random.randint(0, pad_w - crop_w + 1)
+        # crop pixel -> pixel of the scaled (and mirrored) image -> source pixel
+        y0, x0 = start_h - offset_h, start_w - offset_w
+        ry, rx = h / h_new, w / w_new
+        if flip:
+            mx, bx = -rx, rx * (w_new - x0 - 0.5) - 0.5
+        else:
+            mx, bx = rx, rx * (x0 + 0.5) - 0.5
+        M = np.array([[mx, 0., bx], [0., ry, ry * (y0 + 0.5) - 0.5]])
+        # the part of the crop covered by the scaled image, the rest is padding
+        top, bottom = max(-y0, 0), min(h_new - y0, crop_h)
+        left, right = max(-x0, 0), min(w_new - x0, crop_w)
+
+        outputs = []
+        for i, x in enumerate([img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p]):
+            out = np.empty((crop_h, crop_w) + x.shape[2:], dtype=x.dtype)
+            flags = (cv2.INTER_LINEAR if i == 0 else cv2.INTER_NEAREST) | cv2.WARP_INVERSE_MAP
+            # replicate: the border pixels of the image must not be blended with the padding value
+            out = cv2.warpAffine(np.ascontiguousarray(x), M, (crop_w, crop_h), dst=out, flags=flags,
+                                 borderMode=cv2.BORDER_REPLICATE)
+            if i == 3 and flip:
+                out[:, :, 0] *= -1
+            fill = 0 if i == 0 else ignore_label
+            out[:top] = fill
+            out[bottom:] = fill
+            out[:, :left] = fill
+            out[:, right:] = fill
+            outputs.append(out)
+        return tuple(outputs)
+
     def semantic_segment_rebalanced(self, img, new_dims=(256, 256)):
         '''
         Segmentation
@@ -247,54 +269,69 @@ class Taskonomy(torch.utils.data.Dataset):
         target_mask[target_mask < 0.99] = 0.
         return target_mask
 
+    def _paths(self, item):
+        img_path = os.path.join(self.dataroot, self.groups[item][:-1]) 
+        seg_path, sn_path, depth_path, keypoint_path, edge_path = img_path.replace('rgb', 'segment_semantic'), \
+                                                                  img_path.replace('rgb', 'normal'), \
+                                                                  img_path.replace('rgb', 'depth_zbuffer'), \
+                                                                  img_path.replace('rgb', 'keypoints2d'), \
+                                                                  img_path.replace('rgb', 'edge_texture')
+        seg_path = list(seg_path)
+        seg_path.pop(-13)
+        seg_path = ''.join(seg_path)
+        return img_path, seg_path, sn_path, depth_path, keypoint_path, edge_path
+
+    def _read(self, item):
+        # the raw PNGs of a sample: rgb, segment_semantic, normal, depth_zbuffer, keypoints2d, edge_texture
+        return [np.array(Image.open(os.path.join(self.dataroot, path))) for path in self._paths(item)]
+
+    def _decode(self, img, seg, sn, depth, keypoint, edge):
+        """
+        the network inputs and targets of a sample from its raw PNG arrays, at the original 512x512
+        or already nearest-resized to 256x256 (the packed shards): every resize below is nearest, so it
+        commutes with the per-pixel rescaling and both give the same result
+        """
+        img = img.astype('float32')[:, :, ::-1]
+        img_p = cv2.resize(img, (256, 256), interpolation=cv2.INTER_NEAREST)
+        seg_p, seg_mask = self.semantic_segment_rebalanced(seg)
+        sn = sn.astype('float32') / 255
+        sn_p = self.resize_rescale_image(sn)
+        depth = depth.astype('float32')
+        depth_p = self.resize_and_rescale_image_log(depth)
+        depth_mask = self.make_depth_mask(depth)
+        keypoint = keypoint.astype('float32') / (2 ** 16)
+        keypoint_p = self.resize_rescale_image(keypoint, current_scale=(0, 0.005))
+        edge = edge.astype('float32') / (2 ** 16)
+        edge_p = self.resize_rescale_image(edge, current_scale=(0, 0.08))
+        return img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p
+
+    def _load(self, item):
+        return self._decode(*self._read(item))
+
     def __getitem__(self, item):
         # TODO RGB -> BGR
         while True:
-            img_path = os.path.join(self.dataroot, self.groups[item][:-1]) 
-            seg_path, sn_path, depth_path, keypoint_path, edge_path = img_path.replace('rgb', 'segment_semantic'), \
-                                                                      img_path.replace('rgb', 'normal'), \
-                                                                      img_path.replace('rgb', 'depth_zbuffer'), \
-                                                                      img_path.replace('rgb', 'keypoints2d'), \
-                                                                      img_path.replace('rgb', 'edge_texture')
-            seg_path = list(seg_path)
-            seg_path.pop(-13)
-            seg_path = ''.join(seg_path)
-
+            img_path = self._paths(item)[0]
             try:
-                img = np.array(Image.open(os.path.join(self.dataroot, img_path))).astype('float32')[:, :, ::-1]
-                img_p = cv2.resize(img, (256, 256), interpolation=cv2.INTER_NEAREST)
-                seg = np.array(Image.open(os.path.join(self.dataroot, seg_path)))
-                seg_p, seg_mask = self.semantic_segment_rebalanced(seg)
-                sn = np.array(Image.open(os.path.join(self.dataroot, sn_path))).astype('float32') / 255
-                sn_p = self.resize_rescale_image(sn)
-                depth = np.array(Image.open(os.path.join(self.dataroot, depth_path))).astype('float32')
-                depth_p = self.resize_and_rescale_image_log(depth)
-                depth_mask = self.make_depth_mask(depth)
-                keypoint = np.array(Image.open(os.path.join(self.dataroot, keypoint_path))).astype('float32') / (2 ** 16)
-                keypoint_p = self.resize_rescale_image(keypoint, current_scale=(0, 0.005))
-                edge = np.array(Image.open(os.path.join(self.dataroot, edge_path))).astype('float32') / (2 ** 16)
-                edge_p = self.resize_rescale_image(edge, current_scale=(0, 0.08))
+                img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p = self._load(item)
             except:
                 print('Error in loading %s' % img_path)
                 item += 1
             else:
                 break
 
-        seg_p = seg_p.astype('float32')
-        seg_mask = seg_mask.astype('float32')
-        sn_p = sn_p.astype('float32')
-        depth_mask = depth_mask.astype('float32')
+        # seg_p keeps its uint8 labels, the other maps are float32 (no copy when they already are)
+        seg_mask = seg_mask.astype('float32', copy=False)
+        sn_p = sn_p.astype('float32', copy=False)
+        depth_mask = depth_mask.astype('float32', copy=False)
 
         if self.augmentation:
             img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p = \
-                self.__scale__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p)
-            img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p =\
-                self.__mirror__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p)
-            img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p = \
-                self.__random_crop_and_pad_image_and_labels__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p, self.crop_h, self.crop_w)
+                self.__random_scale_mirror_crop__(img_p, seg_p, seg_mask, sn_p, depth_p, depth_mask, keypoint_p, edge_p, self.crop_h, self.crop_w)
 
-        img_p = img_p.astype('float32')
-        img_p = img_p - self.IMG_MEAN
+        # img_p is a fresh array of this sample, the mean is removed in place
+        img_p = img_p.astype('float32', copy=False)
+        img_p -= self.IMG_MEAN
         if depth_mask.ndim == 2:
             depth_mask = depth_mask[:,:,np.newaxis]
         sn_mask = np.tile(depth_mask, [1, 1, 3])
@@ -329,3 +366,61 @@ class Taskonomy(torch.utils.data.Dataset):
 
     def name(self):
         return 'Taskonomy'
+
+
+class TaskonomyPacked(Taskonomy):
+    """
+    Taskonomy read from the shards written by pack_dataset.py: per building, one memory-mapped array
+    per modality holding the raw PNG values already nearest-resized to 256x256 (uint8 / uint16).
+    Samples that failed to load at packing time are listed in manifest.json and left out of the
+    dataset once, instead of being retried every epoch.
+    """
+    modalities = ['rgb', 'segment_semantic', 'normal', 'depth_zbuffer', 'keypoints2d', 'edge_texture']
+
+    def __init__(self, dataroot, mode, crop_h=None, crop_w=None, augmentation=False, packed_root=None):
+        super(TaskonomyPacked, self).__init__(dataroot, mode, crop_h=crop_h, crop_w=crop_w, augmentation=augmentation)
+        self.packed_root = os.path.expanduser(packed_root or os.path.join(dataroot, 'packed'))
+        with open(os.path.join(self.packed_root, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self._validate()
+        location = {}
+        for building, info in self.manifest['buildings'].items():
+            for i, line in enumerate(info['samples']):
+                # broken samples keep an empty slot (None) in their shard
+                if line is not None:
+                    location[line] = (building, i)
+        groups = [gr for gr in self.groups if gr.strip() in location]
+        broken = set(self.manifest['broken'])
+        missing = [gr for gr in self.groups if gr.strip() not in location and gr.strip() not in broken]
+        assert not missing, '{} samples of {}.txt are not packed, re-run pack_dataset.py'.format(len(missing), mode)
+        if len(groups) != len(self.groups):
+            print('{} broken samples left out'.format(len(self.groups) - len(groups)))
+        self.groups = groups
+        self.location = [location[gr.strip()] for gr in self.groups]
+        # mapped on first access, so every DataLoader worker opens its own mapping
+        self.arrays = None
+
+    def _validate(self):
+        # every shard must exist with the shape and dtype of the manifest (a truncated shard fails to map)
+        for building, info in self.manifest['buildings'].items():
+            for m in self.modalities:
+                arr = np.load(os.path.join(self.packed_root, building, m + '.npy'), mmap_mode='r')
+                expected = [info['num_samples']] + self.manifest['modalities'][m]['shape']
+                assert list(arr.shape) == expected and str(arr.dtype) == self.manifest['modalities'][m]['dtype'], \
+                    '{}/{}.npy does not match manifest.json'.format(building, m)
+                del arr
+
+    def _open(self):
+        return {b: {m: np.load(os.path.join(self.packed_root, b, m + '.npy'), mmap_mode='r') for m in self.modalities}
+                for b in self.manifest['buildings']}
+
+    def _read(self, item):
+        if self.arrays is None:
+            self.arrays = self._open()
+        building, i = self.location[item]
+        return [self.arrays[building][m][i] for m in self.modalities]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state